@@ -1,203 +1,522 @@
+import time
+
+# startup timings, the imports are the first stage, see startup_report
+_started = time.perf_counter()
+
+import functools
+import math
 import uuid
 
 import dash
 import dash_bootstrap_components as dbc
-import numpy as np
-import openai
-import pandas as pd
-import plotly.graph_objs as go
-from dash import dash_table, dcc, html
+import flask
+from dash import ctx, dcc, html, no_update
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
+from dotenv import load_dotenv
 
 from dashboardai.api import (
     check_string_in_list,
-    combine_prompts,
-    combine_prompts_graph,
-    create_dataframe_definition_prompt,
-    create_table_definition_prompt,
-    handle_response,
+    get_completion_cache,
     handle_response_graph,
-    send_to_openai,
 )
+from dashboardai.backends import get_backend
+from dashboardai.cache import ChartCodeCache, ResultCache
+from dashboardai.callbacks import answer_graph_question, answer_table_question
 from dashboardai.data import (
-    create_sqlite_db,
-    get_sqlite_table_info,
-    parse_contents,
-    query_sqlite_db,
+    QueryAborted,
+    QueryRejected,
+    build_count_query,
+    build_page_query,
+    decode_dataframe,
+    describe_tables,
+    encode_dataframe,
+    get_dataset_hash,
+    get_query_limits,
+    load_default_dataset,
+    parse_uploads,
+    quote_identifier,
+    to_dataframe,
 )
+from dashboardai.jobs import JobManager
+from dashboardai.metrics import metrics
+from dashboardai.registry import EngineCache, FileCache, get_dataset_store
 from dashboardai.visualizations import generate_table
 
-# load the gapminder data to a dataframe
-df = pd.read_csv(
-    "https://raw.githubusercontent.com/plotly/datasets/master/gapminderDataFiveYear.csv"
-)
-
-import os
-
-from dotenv import load_dotenv
+STARTUP = {"imports_seconds": time.perf_counter() - _started}
 
-# Load environment variables
-load_dotenv(override=True)
+# plain figure dict, plotly.graph_objs is only needed once a graph is generated
+DEMO_FIGURE = {
+    "data": [
+        {"type": "scatter", "x": [1, 2, 3, 4, 5], "y": [2, 4, 1, 6, 3], "mode": "lines"}
+    ],
+    "layout": {"title": {"text": "My Line Chart"}},
+}
 
-# Configure OpenAI API key
-openai.api_key = os.getenv("OPENAI_API_KEY")
 
-import plotly.graph_objs as go
+# uploaded tables stay on the server, the browser only keeps the session id and metadata,
+# in memory or on disk shared by the workers, selected with DASHBOARDAI_DATASET_STORE
+registry = get_dataset_store()
+# parsed files by content hash, a file uploaded again by any session is not parsed again
+parsed_files = FileCache()
+# sqlite or duckdb, selected with DASHBOARDAI_SQL_BACKEND
+backend = get_backend()
+# one database per uploaded dataset, reused by every query of the session
+databases = EngineCache()
+# results of generated queries, shared by every session with the same upload
+results = ResultCache()
+# compiled chart code, reused when a question is asked again on data with the same columns
+charts = ChartCodeCache()
+# questions are answered in background jobs, at most DASHBOARDAI_JOB_WORKERS at a time, the jobs live in this
+# process so the polls of a session must reach the same worker, see the README
+jobs = JobManager()
 
-x = [1, 2, 3, 4, 5]
-y = [2, 4, 1, 6, 3]
 
-data = [go.Scatter(x=x, y=y, mode="lines")]
+# callbacks of the app, registered with every app built by create_app
+_callbacks = []
 
-layout = go.Layout(title="My Line Chart")
 
-fig2 = go.Figure(data=data, layout=layout)
+def app_callback(*args, **kwargs):
+    """Decorator collecting a callback with the arguments of dash.Dash.callback, see create_app."""
 
+    def register(function):
+        _callbacks.append((args, kwargs, function))
+        return function
 
-# Define a function to convert the contents of an uploaded file to a pandas dataframe
+    return register
 
 
-app = dash.Dash(external_stylesheets=[dbc.themes.BOOTSTRAP])
-app.layout = dbc.Container(
-    [
-        dcc.Store(id="memory"),
-        dcc.Store(id="table-results"),
-        dbc.Row(
-            [
-                dbc.Col(
-                    # file picker component in dcc
-                    dcc.Upload(
-                        id="upload-data",
-                        children=html.Div(
-                            ["Drag and Drop or ", html.A("Select Files")]
-                        ),
-                        style={
-                            "width": "100%",
-                            "height": "60px",
-                            "lineHeight": "60px",
-                            "borderWidth": "1px",
-                            "borderStyle": "dashed",
-                            "borderRadius": "5px",
-                            "textAlign": "center",
-                            "margin": "10px",
-                        },
-                        # Allow multiple files to be uploaded
-                        multiple=True,
-                        # set maximum file size to 100 mb
-                        max_size=100000000,
-                    )
-                )
-            ]
-        ),
-        dbc.Row(
+def serve_layout():
+    """Builds the layout on every page load, the default dataset is loaded for the first one."""
+    started = time.perf_counter()
+    with metrics.span("layout"):
+        layout = dbc.Container(
             [
-                dbc.Col(
+                dcc.Store(id="memory"),
+                dcc.Store(id="table-results"),
+                dcc.Store(id="table-query"),
+                dcc.Store(id="table-job"),
+                dcc.Store(id="graph-job"),
+                # poll the background jobs of the session while they are running
+                dcc.Interval(id="table-poll", interval=500, disabled=True),
+                dcc.Interval(id="graph-poll", interval=500, disabled=True),
+                dbc.Row(
                     [
-                        # table component in dash_table
-                        html.Div(id="table", children=[generate_table(df)]),
-                        dbc.Input(
-                            id="chat_input_table",
-                            type="text",
-                            placeholder="Enter a value...",
-                            debounce=True,
-                            style={"width": "100%"},
-                        ),
-                    ],
-                    width=6,
+                        dbc.Col(
+                            # file picker component in dcc
+                            dcc.Upload(
+                                id="upload-data",
+                                children=html.Div(
+                                    ["Drag and Drop or ", html.A("Select Files")]
+                                ),
+                                style={
+                                    "width": "100%",
+                                    "height": "60px",
+                                    "lineHeight": "60px",
+                                    "borderWidth": "1px",
+                                    "borderStyle": "dashed",
+                                    "borderRadius": "5px",
+                                    "textAlign": "center",
+                                    "margin": "10px",
+                                },
+                                # Allow multiple files to be uploaded
+                                multiple=True,
+                                # set maximum file size to 100 mb
+                                max_size=100000000,
+                            )
+                        )
+                    ]
                 ),
-                dbc.Col(
+                dbc.Row([dbc.Col(html.Div(id="upload-status"))]),
+                dbc.Row(
                     [
-                        dcc.Graph(id="graph2", figure=fig2),
-                        # text input component in dbc
-                        dbc.Input(
-                            id="chat_input_graph",
-                            type="text",
-                            placeholder="Enter a value...",
-                            debounce=True,
-                            style={"width": "100%"},
+                        dbc.Col(
+                            [
+                                # table component in dash_table
+                                html.Div(
+                                    id="table",
+                                    children=[generate_table(load_default_dataset())],
+                                ),
+                                dbc.Input(
+                                    id="chat_input_table",
+                                    type="text",
+                                    placeholder="Enter a value...",
+                                    debounce=True,
+                                    style={"width": "100%"},
+                                ),
+                            ],
+                            width=6,
+                        ),
+                        dbc.Col(
+                            [
+                                dcc.Graph(id="graph2", figure=DEMO_FIGURE),
+                                # text input component in dbc
+                                dbc.Input(
+                                    id="chat_input_graph",
+                                    type="text",
+                                    placeholder="Enter a value...",
+                                    debounce=True,
+                                    style={"width": "100%"},
+                                ),
+                            ],
+                            width=6,
                         ),
                     ],
-                    width=6,
+                    align="center",
                 ),
-            ],
-            align="center",
-        ),
-    ]
-)
+            ]
+        )
+    STARTUP.setdefault("first_layout_seconds", time.perf_counter() - started)
+    return layout
 
 
-@app.callback(
+@app_callback(
     Output("memory", "data"),
-    [Input("upload-data", "contents"), State("upload-data", "filename")],
+    Output("upload-status", "children"),
+    [
+        Input("upload-data", "contents"),
+        State("upload-data", "filename"),
+        State("memory", "data"),
+    ],
 )
-def make_sqlite_db(contents, filename):
+def make_sqlite_db(contents, filename, memory):
     print("Upload callback triggered")  # Debug print
     print(f"Contents: {contents is not None}")  # Debug print
     print(f"Filename: {filename}")  # Debug print
 
     if contents is not None:
-        dfs = {
-            name.rsplit(".", 1)[0]: parse_contents(content, name).to_dict("records")
-            for content, name in zip(contents, filename)
+        # keep the session id of the browser tab so a new upload adds to the dataset of the session
+        session_id = memory["session_id"] if memory else uuid.uuid4().hex
+        previous = registry.get(session_id) if memory else None
+        # files of the session by name, with their hash and tables
+        sources = dict(memory.get("sources", {})) if previous is not None else {}
+        dfs, files, errors, drop = {}, [], [], set()
+        with metrics.span("upload", bytes=sum(len(c) for c in contents)):
+            for result in parse_uploads(contents, filename, cache=parsed_files):
+                dfs.update(result["tables"])
+                files.extend(result["stats"])
+                errors.extend(result["errors"])
+                if result["tables"]:
+                    # a changed file replaces only its own tables
+                    old = sources.get(result["filename"], {}).get("tables", [])
+                    drop.update(set(old) - set(result["tables"]))
+                    sources[result["filename"]] = {
+                        "hash": result["file_hash"],
+                        "tables": list(result["tables"]),
+                    }
+        if not dfs:
+            return memory, html.Div(errors or ["No file selected"])
+        tables = {name: df for name, df in (previous or {}).items() if name not in drop}
+        tables.update(dfs)
+        # the tables of a file are stored once, whichever session uploads it
+        keys = {
+            table: get_dataset_hash([(table, source["hash"])])
+            for source in sources.values()
+            for table in source["tables"]
         }
+        registry.put(session_id, tables, keys)
+        content_hash = get_dataset_hash(
+            sorted((name, source["hash"]) for name, source in sources.items())
+        )
+        if previous is None:
+            # the tables of an expired dataset may still be loaded
+            databases.invalidate(session_id)
+        # load only the new tables into the database of the session, if it has one
+        databases.update(
+            session_id,
+            content_hash,
+            lambda database: database.load(
+                [{"name": name, "data": df} for name, df in dfs.items()], drop
+            ),
+        )
         print(f"Processed dataframes: {list(dfs.keys())}")  # Debug print
-        return dfs
-    return None  # Add explicit return for when contents is None
+        reused = sum(stats["cached"] for stats in files)
+        status = [f"Loaded tables: {', '.join(dfs)}"]
+        if reused:
+            status[0] += f" ({reused} already uploaded before)"
+        status += [
+            html.Div(
+                f"{stats['table']}: {stats['memory_bytes'] / 1e6:.1f} MB in memory"
+                f" ({stats['memory_before_bytes'] / 1e6:.1f} MB before compaction)"
+            )
+            for stats in files
+        ]
+        status += [html.Div(f"Could not load {error}") for error in errors]
+        uploaded = {stats["filename"] for stats in files}
+        if previous is not None:
+            files = [
+                stats for stats in memory["files"] if stats["filename"] not in uploaded
+            ] + files
+        return {
+            "session_id": session_id,
+            "content_hash": content_hash,
+            "sources": sources,
+            "tables": describe_tables(tables),
+            "files": files,
+            "errors": errors,
+        }, html.Div(status)
+    return None, None  # Add explicit return for when contents is None
+
+
+def get_database(memory, dfs):
+    """Returns the cached database of the session, loading the tables on the first query."""
+    return databases.get(
+        memory["session_id"],
+        memory["content_hash"],
+        lambda: backend.create(
+            [{"name": name, "data": data} for name, data in dfs.items()]
+        ),
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def count_rows(session_id, content_hash, query, columns, filter_query):
+    """Counts the rows of a filtered result once, the count is reused for every page."""
+    dfs = registry.get(session_id)
+    if dfs is None:
+        # the session was evicted between the page query and the count
+        raise PreventUpdate
+    memory = {"session_id": session_id, "content_hash": content_hash}
+    count_query, params = build_count_query(query, columns, filter_query)
+    timeout = get_query_limits()["timeout"]
+    result = get_database(memory, dfs).query(count_query, params, timeout=timeout)
+    return int(result.iloc[0, 0])
 
 
-@app.callback(
+@app_callback(
     Output("table", "children"),
     Output("table-results", "data"),
-    [Input("chat_input_table", "value"), State("memory", "data")],
+    Output("table-query", "data"),
+    Output("table-job", "data"),
+    Output("table-poll", "disabled"),
+    [
+        Input("chat_input_table", "value"),
+        Input("table-poll", "n_intervals"),
+        State("memory", "data"),
+        State("table-job", "data"),
+    ],
 )
-def update_table(text_input, dfs):
+def update_table(text_input, n_intervals, memory, job_id):
     print("Update table callback triggered")  # Debug print
-    print(f"DFs available: {dfs}")  # Debug print
 
+    if ctx.triggered_id == "table-poll":
+        # the question runs as a background job, show its result once it is done
+        if job_id is None:
+            return no_update, no_update, no_update, None, True
+        status = jobs.status(job_id)
+        if status["status"] in ("pending", "running"):
+            raise PreventUpdate
+        if status["status"] in ("cancelled", "unknown"):
+            return no_update, no_update, no_update, None, True
+        if status["status"] == "failed":
+            print(f"Error in update_table: {status['error']}")  # Debug print
+            if isinstance(status["error"], QueryRejected):
+                error = html.Div([str(status["error"])])
+            elif isinstance(status["error"], QueryAborted):
+                error = html.Div([f"{status['error']}, please ask a narrower question"])
+            else:
+                error = html.Div([f"Error processing data: {status['error']}"])
+            return error, None, None, None, True
+        answer = status["result"]
+        table, payload, table_query = show_table(answer["query"], answer["result"])
+        notes = [html.Div(warning) for warning in answer["warnings"]]
+        if answer["truncated"]:
+            notes.append(html.Div(f"Result truncated to {len(answer['result'])} rows"))
+        if notes:
+            table = html.Div(notes + [table])
+        return table, payload, table_query, None, True
+
+    if memory is None:
+        return html.Div(["No file selected"]), None, None, None, True
+    dfs = registry.get(memory["session_id"])
     if dfs is None:
-        return html.Div(["No file selected"]), None
+        return (
+            html.Div(["The uploaded data has expired, please upload it again"]),
+            None,
+            None,
+            None,
+            True,
+        )
+    print(f"Tables available: {list(dfs.keys())}")  # Debug print
     try:
-        if text_input == "":
-            dfs = [{"name": name, "data": pd.DataFrame(dfs[name])} for name in dfs]
-            return generate_table(dfs[0]["data"]), dfs[0]["data"].to_dict("records")
-        else:
-            engine = create_sqlite_db(
-                [{"name": name, "data": pd.DataFrame(dfs[name])} for name in dfs]
-            )
-            db_schema = get_sqlite_table_info(engine)
-            fixed_sql_prompt = create_table_definition_prompt(db_schema)
-            prompt = combine_prompts(fixed_sql_prompt, text_input)
-            response = send_to_openai(prompt, stop=[";", "#"])
-            proposed_query_postprocessed = handle_response(response)
-            result = query_sqlite_db(engine, proposed_query_postprocessed)
-            return generate_table(result), result.to_dict("records")
+        if not text_input:
+            name, result = next(iter(dfs.items()))
+            query = f"SELECT * FROM {quote_identifier(name)}"
+            return show_table(query, to_dataframe(result)) + (None, True)
+        database = get_database(memory, dfs)
     except Exception as e:
         print(f"Error in update_table: {str(e)}")  # Debug print
-        return html.Div([f"Error processing data: {str(e)}"]), None
+        return html.Div([f"Error processing data: {str(e)}"]), None, None, None, True
+    job_id = jobs.submit(
+        memory["session_id"],
+        "table",
+        answer_table_question,
+        database,
+        text_input,
+        memory["content_hash"],
+        results,
+    )
+    running = html.Div(["Answering: ", html.I(text_input)])
+    return running, no_update, no_update, job_id, False
+
 
+def show_table(query, result):
+    """Returns the table, the results and the query of update_table for a query result."""
+    # only the first page goes to the browser, the other pages are queried by update_table_page
+    with metrics.span("render", rows=len(result)):
+        table = generate_table(result, mode="custom", row_count=len(result))
+    # the results go to the browser columnar and compressed, for update_graph, see encode_dataframe
+    with metrics.span("serialize", rows=len(result)):
+        payload = encode_dataframe(result)
+    table_query = {"query": query, "row_count": len(result)}
+    return table, payload, table_query
 
-@app.callback(
+
+@app_callback(
+    Output("data-table", "data"),
+    Output("data-table", "page_count"),
+    [
+        Input("data-table", "page_current"),
+        Input("data-table", "sort_by"),
+        Input("data-table", "filter_query"),
+        State("data-table", "page_size"),
+        State("data-table", "columns"),
+        State("table-query", "data"),
+        State("memory", "data"),
+    ],
+    prevent_initial_call=True,
+)
+def update_table_page(
+    page_current, sort_by, filter_query, page_size, columns, table_query, memory
+):
+    if table_query is None or memory is None:
+        raise PreventUpdate
+    dfs = registry.get(memory["session_id"])
+    if dfs is None:
+        raise PreventUpdate
+    columns = tuple(c["id"] for c in columns)
+    timeout = get_query_limits()["timeout"]
+    row_count = table_query["row_count"]
+    try:
+        query, params = build_page_query(
+            table_query["query"],
+            columns,
+            page_current or 0,
+            page_size,
+            sort_by,
+            filter_query,
+        )
+        with metrics.span("page") as span:
+            page = get_database(memory, dfs).query(query, params, timeout=timeout)
+            span["rows"] = len(page)
+        if filter_query:
+            row_count = count_rows(
+                memory["session_id"],
+                memory["content_hash"],
+                table_query["query"],
+                columns,
+                filter_query,
+            )
+    except (QueryAborted, ValueError) as e:
+        # keep the current page rather than failing the callback, a ValueError is a filter
+        # the table cannot parse
+        print(f"Error in update_table_page: {e}")  # Debug print
+        raise PreventUpdate from e
+    return page.to_dict("records"), max(1, math.ceil(row_count / page_size))
+
+
+@app_callback(
     Output("graph2", "figure"),
-    [Input("chat_input_graph", "value"), State("table-results", "data")],
+    Output("graph-job", "data"),
+    Output("graph-poll", "disabled"),
+    [
+        Input("chat_input_graph", "value"),
+        Input("graph-poll", "n_intervals"),
+        State("table-results", "data"),
+        State("memory", "data"),
+        State("graph-job", "data"),
+    ],
 )
-def update_graph(text_input, results):
-    if results is None or text_input == "":
-        return {}
-    else:
-        data = pd.DataFrame(results)
-        fixed_prompt = create_dataframe_definition_prompt(data)
-        prompt = combine_prompts_graph(fixed_prompt, text_input)
-        response = send_to_openai(prompt, stop=["fig.show()"])
-        # proposed_query_postprocessed = handle_response_graph(response)
-        fig = go.Figure()
-        print("##################")
-        print(prompt)
-        print(response["choices"][0]["text"])
-        query = response["choices"][0]["text"].replace("fig.show()", "")
-        # exec(proposed_query_postprocessed)
-        exec(query)
-        return fig
+def update_graph(text_input, n_intervals, results, memory, job_id):
+    if ctx.triggered_id == "graph-poll":
+        if job_id is None:
+            return no_update, None, True
+        status = jobs.status(job_id)
+        if status["status"] in ("pending", "running"):
+            raise PreventUpdate
+        if status["status"] == "done":
+            return status["result"], None, True
+        if status["status"] == "failed":
+            print(f"Error in update_graph: {status['error']}")  # Debug print
+            return {}, None, True
+        return no_update, None, True
+    if results is None or not text_input:
+        return {}, None, True
+    session_id = memory["session_id"] if memory else "default"
+    try:
+        with metrics.span("deserialize") as span:
+            data = decode_dataframe(results)
+            span["rows"] = len(data)
+    except ValueError as e:
+        print(f"Error in update_graph: {e}")  # Debug print
+        return {}, None, True
+    job_id = jobs.submit(
+        session_id, "graph", answer_graph_question, data, text_input, charts
+    )
+    return no_update, job_id, False
+
+
+metrics.add_collector("dataset_store", registry.stats)
+metrics.add_collector("engine_cache", databases.stats)
+metrics.add_collector("file_cache", parsed_files.stats)
+metrics.add_collector("result_cache", results.stats)
+metrics.add_collector("chart_cache", charts.stats)
+metrics.add_collector("completion_cache", lambda: get_completion_cache().stats())
+metrics.add_collector("jobs", jobs.stats)
+metrics.add_collector("startup", lambda: dict(STARTUP))
+
+
+def serve_metrics():
+    """Stage latencies, payload sizes and cache stats in the Prometheus text format."""
+    return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def create_app():
+    """
+    Builds the Dash app with the callbacks of this module, the layout is built per page load by
+    serve_layout.
+
+    :return: dash.Dash
+    """
+    started = time.perf_counter()
+    # Load environment variables, e.g. OPENAI_API_KEY
+    load_dotenv(override=True)
+    # the data table is replaced by update_table, so its paging callback may not find it in the layout
+    app = dash.Dash(
+        external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_callback_exceptions=True
+    )
+    app.layout = serve_layout
+    for args, kwargs, function in _callbacks:
+        app.callback(*args, **kwargs)(function)
+    app.server.add_url_rule("/metrics", "metrics", serve_metrics)
+    STARTUP["app_seconds"] = time.perf_counter() - started
+    return app
+
+
+def startup_report():
+    """
+    Returns how long the app took to come up: imports_seconds for the imports of this module,
+    app_seconds for create_app and first_layout_seconds for the layout of the first page load.
+    The values are also served as gauges at /metrics.
+    """
+    return dict(STARTUP)
+
+
+app = create_app()
+# WSGI entry point, e.g. gunicorn app:server
+server = app.server
 
 
 if __name__ == "__main__":
+    print(f"Startup: {startup_report()}")  # Debug print
     app.run_server(debug=True)
@@ -0,0 +1,296 @@
+"""
+Load test driver simulating concurrent sessions against the Dash callback endpoints.
+
+Every session uploads a synthetic CSV file, asks a table question and then a graph question on its
+result, polling the background jobs like the browser does. Without --url the app is started in this
+process with the fake completion provider, so no API key is needed:
+
+    python -m benchmarks.load --sessions 20 --concurrency 8 --latency 0.5
+    python -m benchmarks.load --url http://localhost:8050 --sessions 50
+
+The report has the throughput, the p50/p95/p99 latencies per step and the saturation of the job
+workers sampled from /metrics.
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.pipeline import make_dataset, to_upload
+
+CALLBACK_PATH = "/_dash-update-component"
+
+# outputs, inputs and states of the callbacks of app.py
+UPLOAD = {
+    "outputs": [("memory", "data"), ("upload-status", "children")],
+    "inputs": [("upload-data", "contents")],
+    "state": [("upload-data", "filename"), ("memory", "data")],
+}
+TABLE = {
+    "outputs": [
+        ("table", "children"),
+        ("table-results", "data"),
+        ("table-query", "data"),
+        ("table-job", "data"),
+        ("table-poll", "disabled"),
+    ],
+    "inputs": [("chat_input_table", "value"), ("table-poll", "n_intervals")],
+    "state": [("memory", "data"), ("table-job", "data")],
+}
+GRAPH = {
+    "outputs": [
+        ("graph2", "figure"),
+        ("graph-job", "data"),
+        ("graph-poll", "disabled"),
+    ],
+    "inputs": [("chat_input_graph", "value"), ("graph-poll", "n_intervals")],
+    "state": [("table-results", "data"), ("memory", "data"), ("graph-job", "data")],
+}
+
+
+def percentile(values, q):
+    """Returns the q-th percentile of values with linear interpolation, None for no values."""
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def make_payload(callback, inputs, state, changed):
+    """
+    Returns the JSON body of a callback request, like the one sent by the Dash renderer.
+
+    :param callback: one of UPLOAD, TABLE or GRAPH
+    :param inputs: values of the inputs, in order
+    :param state: values of the states, in order
+    :param changed: index of the input that triggered the callback
+    :return: dict
+    """
+    outputs = [{"id": i, "property": p} for i, p in callback["outputs"]]
+    return {
+        "output": "..{}..".format(
+            "...".join(f"{i}.{p}" for i, p in callback["outputs"])
+        ),
+        "outputs": outputs,
+        "inputs": [
+            {"id": i, "property": p, "value": v}
+            for (i, p), v in zip(callback["inputs"], inputs)
+        ],
+        "state": [
+            {"id": i, "property": p, "value": v}
+            for (i, p), v in zip(callback["state"], state)
+        ],
+        "changedPropIds": ["{}.{}".format(*callback["inputs"][changed])],
+    }
+
+
+class Session:
+    """One simulated browser tab: upload, table question and graph question."""
+
+    def __init__(self, url, contents, filename, poll_interval=0.05, timeout=120):
+        self.url = url.rstrip("/")
+        self.contents = contents
+        self.filename = filename
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.http = requests.Session()
+        self.requests = []
+
+    def call(self, callback, inputs, state, changed=0):
+        start = time.perf_counter()
+        response = self.http.post(
+            self.url + CALLBACK_PATH,
+            json=make_payload(callback, inputs, state, changed),
+            timeout=self.timeout,
+        )
+        self.requests.append(time.perf_counter() - start)
+        if response.status_code == 204:
+            return None
+        response.raise_for_status()
+        return response.json()["response"]
+
+    def poll(self, callback, job_key, inputs, state):
+        # the job id is the last state, the poll interval the second input
+        deadline = time.monotonic() + self.timeout
+        n_intervals = 0
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            n_intervals += 1
+            response = self.call(callback, inputs[:1] + [n_intervals], state, 1)
+            if response is not None:
+                return response
+        raise TimeoutError(f"{job_key} did not finish in {self.timeout} seconds")
+
+    def run(self, table_question, graph_question):
+        """Runs the session and returns the duration of each step in seconds."""
+        timings = {}
+        start = time.perf_counter()
+        response = self.call(UPLOAD, [[self.contents]], [[self.filename], None])
+        memory = response["memory"]["data"]
+        timings["upload"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        response = self.call(TABLE, [table_question, None], [memory, None])
+        job_id = response["table-job"]["data"]
+        response = self.poll(TABLE, "table-job", [table_question], [memory, job_id])
+        results = response.get("table-results", {}).get("data")
+        timings["table"] = time.perf_counter() - start
+        if results is None:
+            raise RuntimeError("the table question failed")
+
+        start = time.perf_counter()
+        response = self.call(GRAPH, [graph_question, None], [results, memory, None])
+        job_id = response["graph-job"]["data"]
+        self.poll(GRAPH, "graph-job", [graph_question], [results, memory, job_id])
+        timings["graph"] = time.perf_counter() - start
+        return timings
+
+
+def sample_saturation(url, stop, interval, samples):
+    """Appends the running and pending jobs read from /metrics to samples until stop is set."""
+    http = requests.Session()
+    while not stop.wait(interval):
+        try:
+            text = http.get(url.rstrip("/") + "/metrics", timeout=5).text
+        except requests.RequestException:
+            continue
+        values = dict(re.findall(r"^dashboardai_jobs_(\w+) (\S+)$", text, re.MULTILINE))
+        if "running" in values:
+            samples.append({key: float(value) for key, value in values.items()})
+
+
+def run_load(
+    url,
+    sessions=10,
+    concurrency=4,
+    rows=10_000,
+    columns=10,
+    poll_interval=0.05,
+    table_question="show the first rows",
+    graph_question="scatter plot of the first two columns",
+):
+    """
+    Runs sessions simulated sessions, concurrency of them at the same time.
+
+    :param url: base url of the app
+    :param sessions: number of sessions
+    :param concurrency: number of sessions running at the same time
+    :param rows: rows of the uploaded dataset
+    :param columns: columns of the uploaded dataset
+    :param poll_interval: seconds between the polls of a job
+    :return: report dict with throughput, latency percentiles, errors and worker saturation
+    """
+    contents, _ = to_upload(make_dataset(rows, columns), "csv")
+    timings, requests_seconds, errors = [], [], []
+    samples, stop = [], threading.Event()
+    sampler = threading.Thread(
+        target=sample_saturation, args=(url, stop, 0.1, samples), daemon=True
+    )
+    sampler.start()
+
+    def run_session(i):
+        session = Session(url, contents, f"data_{i}.csv", poll_interval)
+        try:
+            timings.append(session.run(table_question, graph_question))
+        except Exception as e:
+            errors.append(f"{type(e).__name__}: {e}")
+        requests_seconds.extend(session.requests)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run_session, range(sessions)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    sampler.join()
+
+    report = {
+        "sessions": sessions,
+        "concurrency": concurrency,
+        "seconds": elapsed,
+        "sessions_per_second": len(timings) / elapsed,
+        "requests_per_second": len(requests_seconds) / elapsed,
+        "errors": errors,
+        "latency": {},
+    }
+    steps = {step: [t[step] for t in timings] for step in ("upload", "table", "graph")}
+    steps["request"] = requests_seconds
+    for step, values in steps.items():
+        report["latency"][step] = {
+            f"p{q}": percentile(values, q) for q in (50, 95, 99)
+        } | {"count": len(values)}
+    if samples:
+        workers = samples[-1].get("max_workers") or 1
+        report["saturation"] = {
+            "max_workers": workers,
+            "mean_running": statistics.mean(s["running"] for s in samples) / workers,
+            "max_running": max(s["running"] for s in samples) / workers,
+            "max_pending": max(s.get("pending", 0) for s in samples),
+        }
+    return report
+
+
+def start_app(latency):
+    """Starts app.py with the fake completion provider on a free local port and returns its url."""
+    os.environ["DASHBOARDAI_LLM_PROVIDER"] = "fake"
+    os.environ["DASHBOARDAI_LLM_FAKE_LATENCY_SECONDS"] = str(latency)
+    # every session asks the same questions, the caches would answer all but the first
+    os.environ.setdefault("DASHBOARDAI_LLM_CACHE", "false")
+    os.environ.setdefault("DASHBOARDAI_CHART_CACHE_ENTRIES", "0")
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    from werkzeug.serving import make_server
+
+    import app
+
+    server = make_server("127.0.0.1", 0, app.app.server, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--url", help="url of a running app, started in process if not given"
+    )
+    parser.add_argument("--sessions", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--columns", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.5, help="fake LLM latency")
+    parser.add_argument("--poll-interval", type=float, default=0.05)
+    parser.add_argument(
+        "--output", help="JSON file for the report, stdout if not given"
+    )
+    args = parser.parse_args(argv)
+
+    url = args.url or start_app(args.latency)
+    report = run_load(
+        url,
+        args.sessions,
+        args.concurrency,
+        args.rows,
+        args.columns,
+        args.poll_interval,
+    )
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 1 if report["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
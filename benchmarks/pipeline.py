@@ -0,0 +1,320 @@
+"""
+Benchmarks of the ingest -> query -> render hot path on synthetic datasets.
+
+Every benchmark is timed on datasets of every size of the grid of rows and columns, combinations
+with more than --max-cells cells are skipped. The LLM is stubbed, the SQL pipeline answers with
+generated queries. The results are written as JSON and can be compared with a previous run:
+
+    python -m benchmarks.pipeline --rows 10000 100000 --columns 5 50 --output bench.json
+    python -m benchmarks.pipeline --compare bench.json
+"""
+
+import argparse
+import base64
+import io
+import json
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from plotly.utils import PlotlyJSONEncoder
+
+from dashboardai import callbacks
+from dashboardai.backends import get_backend
+from dashboardai.data import (
+    PAYLOAD_FORMATS,
+    compact_dtypes,
+    create_sqlite_db,
+    decode_dataframe,
+    encode_dataframe,
+    get_sqlite_table_info,
+    parse_contents,
+    query_sqlite_db,
+)
+from dashboardai.registry import get_dataframe_nbytes
+from dashboardai.visualizations import generate_table
+
+DEFAULT_ROWS = (10_000, 100_000, 1_000_000, 10_000_000)
+DEFAULT_COLUMNS = (5, 50, 500)
+# the sheets of xlsx files hold at most 1048576 rows and openpyxl is slow, larger files are skipped
+XLSX_MAX_CELLS = 2_000_000
+
+
+def make_dataset(rows, columns, seed=0):
+    """
+    Returns a synthetic dataframe cycling through integer, float, category and date columns.
+
+    :param rows: number of rows
+    :param columns: number of columns
+    :param seed: seed of the random generator
+    :return: pandas dataframe
+    """
+    rng = np.random.default_rng(seed)
+    data = {}
+    for i in range(columns):
+        kind = i % 4
+        if kind == 0:
+            data[f"int_{i}"] = rng.integers(0, 1000, rows)
+        elif kind == 1:
+            data[f"float_{i}"] = rng.normal(100, 25, rows).round(3)
+        elif kind == 2:
+            data[f"category_{i}"] = rng.choice(["north", "south", "east", "west"], rows)
+        else:
+            start = np.datetime64("2020-01-01")
+            data[f"date_{i}"] = start + rng.integers(0, 1500, rows).astype(
+                "timedelta64[D]"
+            )
+    return pd.DataFrame(data)
+
+
+def make_queries(df, table="data"):
+    """
+    Returns representative queries on a dataset: a page of the table, a filter with an order, an
+    aggregation by a category and a distinct count.
+
+    :param df: dataframe of make_dataset
+    :param table: name of the table
+    :return: dict of query names and SQL
+    """
+    numbers = [c for c in df.columns if c.startswith(("int_", "float_"))]
+    categories = [c for c in df.columns if c.startswith("category_")] or numbers
+    number, category = numbers[0], categories[0]
+    return {
+        "page": f'SELECT * FROM "{table}" LIMIT 10',
+        "filter_order": f'SELECT * FROM "{table}" WHERE "{number}" > 500 '
+        f'ORDER BY "{number}" DESC LIMIT 1000',
+        "group_by": f'SELECT "{category}", COUNT(*) AS n, AVG("{number}") AS mean '
+        f'FROM "{table}" GROUP BY "{category}"',
+        "count_distinct": f'SELECT COUNT(DISTINCT "{number}") AS n FROM "{table}"',
+    }
+
+
+def to_upload(df, extension):
+    """Returns a dataframe encoded like the contents of a dcc.Upload, see parse_contents."""
+    buffer = io.BytesIO()
+    if extension == "csv":
+        df.to_csv(buffer, index=False)
+        mime = "text/csv"
+    else:
+        df.to_excel(buffer, index=False)
+        mime = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    encoded = base64.b64encode(buffer.getvalue()).decode("ascii")
+    return f"data:{mime};base64,{encoded}", len(buffer.getvalue())
+
+
+def measure(fn, repeats):
+    """Runs fn repeats times and returns the fastest run in seconds and the last result."""
+    best, result = float("inf"), None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def stub_llm(query):
+    """Returns a replacement of send_to_openai answering every prompt with query."""
+    # handle_response prefixes answers starting with a space with Select
+    text = (
+        " " + query.split(" ", 1)[1] if query.upper().startswith("SELECT ") else query
+    )
+
+    def send_to_openai(prompt, stop, max_tokens=1000, use_cache=True):
+        return {"choices": [{"text": text}]}
+
+    return send_to_openai
+
+
+def run_dataset(rows, columns, repeats=3, formats=("csv", "xlsx")):
+    """
+    Runs every benchmark on one synthetic dataset.
+
+    :param rows: number of rows
+    :param columns: number of columns
+    :param repeats: runs per benchmark, the fastest counts
+    :param formats: upload formats to parse, csv and xlsx
+    :return: list of result dicts with the keys benchmark, rows, columns and seconds
+    """
+    df = make_dataset(rows, columns)
+    results = []
+
+    def record(benchmark, seconds, **extra):
+        results.append(
+            {
+                "benchmark": benchmark,
+                "rows": rows,
+                "columns": columns,
+                "seconds": seconds,
+            }
+            | extra
+        )
+
+    for extension in formats:
+        if extension == "xlsx" and rows * columns > XLSX_MAX_CELLS:
+            continue
+        contents, nbytes = to_upload(df, extension)
+        seconds, _ = measure(
+            lambda: parse_contents(contents, f"data.{extension}"), repeats
+        )
+        record(f"parse_{extension}", seconds, bytes=nbytes)
+
+    seconds, compacted = measure(lambda: compact_dtypes(df), repeats)
+    record(
+        "compact_dtypes",
+        seconds,
+        memory_before_bytes=get_dataframe_nbytes(df),
+        memory_bytes=get_dataframe_nbytes(compacted),
+    )
+
+    tables = [{"name": "data", "data": df}]
+    seconds, engine = measure(lambda: create_sqlite_db(tables), 1)
+    record("create_sqlite_db", seconds)
+    seconds, _ = measure(lambda: get_sqlite_table_info(engine), repeats)
+    record("get_sqlite_table_info", seconds)
+
+    for name, query in make_queries(df).items():
+        seconds, result = measure(lambda: query_sqlite_db(engine, query), repeats)
+        record(f"query_sqlite_db[{name}]", seconds, result_rows=len(result))
+    engine.dispose()
+
+    database = get_backend("sqlite").create(tables)
+    query = make_queries(df)["group_by"]
+    send_to_openai = callbacks.send_to_openai
+    callbacks.send_to_openai = stub_llm(query)
+    try:
+        seconds, _ = measure(
+            lambda: callbacks.answer_table_question(None, database, "counts by region"),
+            repeats,
+        )
+    finally:
+        callbacks.send_to_openai = send_to_openai
+    record("answer_table_question", seconds)
+    database.dispose()
+
+    # the results in the table-results Store, serialized to JSON like Dash does
+    for payload_format in PAYLOAD_FORMATS:
+        seconds, text = measure(
+            lambda: json.dumps(
+                encode_dataframe(df, payload_format), cls=PlotlyJSONEncoder
+            ),
+            repeats,
+        )
+        record(f"encode_results[{payload_format}]", seconds, bytes=len(text))
+        seconds, _ = measure(lambda: decode_dataframe(json.loads(text)), repeats)
+        record(f"decode_results[{payload_format}]", seconds, bytes=len(text))
+
+    seconds, _ = measure(lambda: generate_table(df), repeats)
+    record("generate_table[native]", seconds)
+    seconds, _ = measure(
+        lambda: generate_table(df, mode="custom", row_count=len(df)), repeats
+    )
+    record("generate_table[custom]", seconds)
+    return results
+
+
+def run_benchmarks(
+    rows, columns, repeats=3, max_cells=50_000_000, formats=("csv", "xlsx")
+):
+    """
+    Runs the benchmarks on the grid of dataset sizes.
+
+    :param rows: numbers of rows
+    :param columns: numbers of columns
+    :param repeats: runs per benchmark, the fastest counts
+    :param max_cells: datasets with more cells are skipped
+    :param formats: upload formats to parse
+    :return: dict with the keys meta (versions and machine) and results
+    """
+    results = []
+    for n_rows in rows:
+        for n_columns in columns:
+            if n_rows * n_columns > max_cells:
+                print(f"skipped {n_rows} x {n_columns}", file=sys.stderr)
+                continue
+            print(f"running {n_rows} x {n_columns}", file=sys.stderr)
+            results += run_dataset(n_rows, n_columns, repeats, formats)
+    return {"meta": get_meta(), "results": results}
+
+
+def get_meta():
+    """Returns the versions and the machine the benchmarks ran on."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def compare(baseline, current, threshold=1.2):
+    """
+    Compares two runs and returns the benchmarks that got slower by more than threshold.
+
+    :param baseline: results of run_benchmarks
+    :param current: results of run_benchmarks
+    :param threshold: ratio of the durations counted as a regression
+    :return: list of (benchmark, rows, columns, ratio) tuples
+    """
+
+    def key(result):
+        return result["benchmark"], result["rows"], result["columns"]
+
+    before = {key(result): result["seconds"] for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        seconds = before.get(key(result))
+        if seconds and result["seconds"] / seconds > threshold:
+            regressions.append(key(result) + (result["seconds"] / seconds,))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--rows", type=int, nargs="+", default=DEFAULT_ROWS)
+    parser.add_argument("--columns", type=int, nargs="+", default=DEFAULT_COLUMNS)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max-cells", type=int, default=50_000_000)
+    parser.add_argument("--formats", nargs="+", default=["csv", "xlsx"])
+    parser.add_argument(
+        "--output", help="JSON file for the results, stdout if not given"
+    )
+    parser.add_argument("--compare", help="JSON file of a previous run")
+    parser.add_argument("--threshold", type=float, default=1.2)
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(
+        args.rows, args.columns, args.repeats, args.max_cells, tuple(args.formats)
+    )
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        for benchmark, rows, columns, ratio in regressions:
+            print(
+                f"regression {benchmark} {rows}x{columns}: {ratio:.2f}x",
+                file=sys.stderr,
+            )
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
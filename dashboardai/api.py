@@ -1,8 +1,22 @@
+import difflib
+import functools
+import math
 import os
+import re
+import threading
 
-import openai
 from dotenv import load_dotenv
 
+from dashboardai import providers
+from dashboardai.cache import CompletionCache, make_completion_key
+from dashboardai.config import get_setting
+
+MODEL = "text-davinci-003"
+
+_completion_cache = None
+_provider = None
+_completion_cache_lock = threading.Lock()
+
 
 def check_string_in_list(string, list_of_strings):
     """
@@ -15,22 +29,183 @@ def check_string_in_list(string, list_of_strings):
     return any(item.lower() in string.lower() for item in list_of_strings)
 
 
-def create_table_definition_prompt(schema):
+def create_table_definition_prompt(schema, database="sqlite"):
     """This function creates a prompt for the OpenAI API to generate SQL queries.
 
     Args:
-        df (dataframe): pd.DataFrame object to automtically extract the table columns
-        table_name (string): Name of the table within the database
+        schema (dict): Table names as keys and lists of column dicts as values
+        database (string): SQL dialect the queries are written for, sqlite or duckdb
 
         Returns: string containing the prompt for OpenAI
     """
 
-    prompt = "### sqlite database, with its properties: \n"
+    lines = [f"### {database} database, with its properties: \n"]
     for table_name, columns in schema.items():
-        prompt += "# {}({}) \n".format(
-            table_name, ",".join([c["name"] for c in columns])
+        lines.append(
+            "# {}({}) \n".format(table_name, ",".join([c["name"] for c in columns]))
         )
-    return prompt
+    return "".join(lines)
+
+
+def tokenize(string):
+    """Splits a question or an identifier into lower case words.
+
+    snake_case, camelCase and digits are split, so lifeExp gives life and exp.
+
+    Args:
+        string (string): Question, table or column name
+
+    Returns:
+        list: Lower case words
+    """
+    string = re.sub(r"([a-z])([A-Z])", r"\1 \2", str(string))
+    return [word.lower() for word in re.findall(r"[A-Za-z]+|\d+", string)]
+
+
+def estimate_tokens(string):
+    """Estimates the number of LLM tokens of a string, about four characters per token.
+
+    Args:
+        string (string): Prompt text
+
+    Returns:
+        int: Estimated number of tokens
+    """
+    return math.ceil(len(string) / 4)
+
+
+def score_word(word, question_words):
+    """Scores how well a word of a table or column name matches the words of a question.
+
+    Args:
+        word (string): Lower case word of a name
+        question_words (set): Words of the question, see tokenize
+
+    Returns:
+        float: 1 for an exact match, 0.7 for a prefix match, up to 0.8 for a fuzzy match, else 0
+    """
+    if word in question_words:
+        return 1.0
+    best = 0.0
+    for candidate in question_words:
+        if min(len(word), len(candidate)) >= 3 and (
+            candidate.startswith(word) or word.startswith(candidate)
+        ):
+            best = max(best, 0.7)
+            continue
+        matcher = difflib.SequenceMatcher(None, word, candidate)
+        if matcher.real_quick_ratio() >= 0.8 and matcher.quick_ratio() >= 0.8:
+            ratio = matcher.ratio()
+            if ratio >= 0.8:
+                best = max(best, 0.8 * ratio)
+    return best
+
+
+def score_name(name, question, question_words, word_scores=None, words=None):
+    """Scores how relevant a table or column name is for a question.
+
+    A name contained in the question scores highest (see check_string_in_list), then every word
+    of the name scores for an exact, prefix or fuzzy match with a word of the question.
+
+    Args:
+        name (string): Table or column name
+        question (string): Question of the user
+        question_words (set): Words of the question, see tokenize
+        word_scores (dict): Optional memo of score_word results, shared across names
+        words (list): Optional words of the name, computed with tokenize if not given
+
+    Returns:
+        float: Relevance score, 0 if the name is unrelated to the question
+    """
+    if word_scores is None:
+        word_scores = {}
+    score = 2.0 if check_string_in_list(question, [str(name)]) else 0.0
+    for word in tokenize(name) if words is None else words:
+        if word not in word_scores:
+            word_scores[word] = score_word(word, question_words)
+        score += word_scores[word]
+    return score
+
+
+class SchemaIndex:
+    """Relevance index over the table and column names of a schema.
+
+    The index is built once per version of a dataset and prunes the schema prompt to the tables
+    and columns that are most relevant for a question, within a token budget.
+    """
+
+    def __init__(self, schema, database="sqlite"):
+        self.schema = schema
+        self.database = database
+        self.prompt = create_table_definition_prompt(schema, database)
+        self.tokens = estimate_tokens(self.prompt)
+        self.columns = sum(len(columns) for columns in schema.values())
+        self._words = {table: tokenize(table) for table in schema}
+        for columns in schema.values():
+            for column in columns:
+                self._words.setdefault(column["name"], tokenize(column["name"]))
+
+    def prune(self, question, max_tokens):
+        """Returns the schema prompt for a question, restricted to max_tokens.
+
+        The full prompt is returned when it fits the budget. Otherwise tables and columns are
+        added by decreasing relevance while the budget allows it, keeping their original order
+        in the prompt. The stats report the prompt size before and after pruning.
+
+        Args:
+            question (string): Question of the user
+            max_tokens (int): Token budget of the schema prompt
+
+        Returns:
+            tuple: Prompt string and dict with tokens_before, tokens_after, columns_before and
+                columns_after
+        """
+        if self.tokens <= max_tokens:
+            return self.prompt, self._stats(self.tokens, self.columns)
+
+        question_words = set(tokenize(question))
+        word_scores = {}
+        entries = []
+        for table, columns in self.schema.items():
+            table_score = score_name(
+                table, question, question_words, word_scores, self._words[table]
+            )
+            for column in columns:
+                name = column["name"]
+                score = score_name(
+                    name, question, question_words, word_scores, self._words[name]
+                )
+                entries.append((score + table_score, table, column))
+        # stable sort, equally relevant columns keep their order
+        entries.sort(key=lambda entry: -entry[0])
+
+        budget = max_tokens * 4 - len(create_table_definition_prompt({}, self.database))
+        selected = {}
+        for score, table, column in entries:
+            cost = len(column["name"]) + 1
+            if table not in selected:
+                cost += len(f"# {table}() \n")
+            if cost > budget:
+                continue
+            budget -= cost
+            selected.setdefault(table, set()).add(id(column))
+
+        schema = {
+            table: [c for c in columns if id(c) in selected[table]]
+            for table, columns in self.schema.items()
+            if table in selected
+        }
+        prompt = create_table_definition_prompt(schema, self.database)
+        columns = sum(len(columns) for columns in schema.values())
+        return prompt, self._stats(estimate_tokens(prompt), columns)
+
+    def _stats(self, tokens, columns):
+        return {
+            "tokens_before": self.tokens,
+            "tokens_after": tokens,
+            "columns_before": self.columns,
+            "columns_after": columns,
+        }
 
 
 def combine_prompts(fixed_sql_prompt, user_query):
@@ -47,25 +222,64 @@ def combine_prompts(fixed_sql_prompt, user_query):
     return fixed_sql_prompt + final_user_input
 
 
-def send_to_openai(prompt, stop, max_tokens=500):
-    """Send the prompt to OpenAI
+def get_completion_cache():
+    """Returns the completion cache shared by every request.
+
+    The cache is created on first use from the settings DASHBOARDAI_LLM_CACHE_PATH (an empty
+    value keeps the cache in memory only), DASHBOARDAI_LLM_CACHE_TTL_SECONDS,
+    DASHBOARDAI_LLM_CACHE_MEMORY_ENTRIES and DASHBOARDAI_LLM_CACHE_DISK_ENTRIES.
+
+    Returns:
+        CompletionCache: Shared cache
+    """
+    global _completion_cache
+    with _completion_cache_lock:
+        if _completion_cache is None:
+            path = get_setting("llm_cache_path", ".dashboardai/completions.sqlite")
+            _completion_cache = CompletionCache(path=path or None)
+        return _completion_cache
+
+
+def get_provider():
+    """Returns the completion provider shared by every request, see dashboardai.providers.get_provider.
+
+    Returns:
+        OpenAIProvider or FakeProvider: Provider selected with DASHBOARDAI_LLM_PROVIDER
+    """
+    global _provider
+    with _completion_cache_lock:
+        if _provider is None:
+            _provider = providers.get_provider()
+        return _provider
+
+
+def send_to_openai(prompt, stop, max_tokens=1000, use_cache=True):
+    """Send the prompt to OpenAI, or the provider configured with DASHBOARDAI_LLM_PROVIDER
+
+    Completions are cached on the provider, model, prompt, stop sequences and max_tokens, so that the
+    canned answers of the fake provider are never returned for the real one. The cache can be
+    bypassed per call with use_cache or globally with DASHBOARDAI_LLM_CACHE=false.
 
     Args:
         prompt (string): Prompt to send to OpenAI
+        stop (list): Stop sequences
+        max_tokens (int): Maximum number of tokens to generate
+        use_cache (bool): Look the response up in the completion cache
 
     Returns:
         string: Response from OpenAI
     """
-    response = openai.Completion.create(
-        engine="text-davinci-003",
-        prompt=prompt,
-        temperature=0,
-        max_tokens=1000,
-        top_p=1.0,
-        frequency_penalty=0.0,
-        presence_penalty=0.0,
-        stop=stop,
-    )
+    provider = get_provider()
+    use_cache = use_cache and get_setting("llm_cache", True)
+    if use_cache:
+        cache = get_completion_cache()
+        key = make_completion_key(MODEL, prompt, stop, max_tokens, provider.name)
+        response = cache.get(key)
+        if response is not None:
+            return response
+    response = provider.complete(MODEL, prompt, stop, max_tokens)
+    if use_cache:
+        cache.set(key, response)
     return response
 
 
@@ -100,9 +314,16 @@ def create_dataframe_definition_prompt(df):
 
         Returns: string containing the prompt for OpenAI
     """
-    prompt = "### the variable data that is a pandas dataframe, with properties: \n"
-    prompt += "# {} \n".format(get_column_names(df))
-    return prompt
+    return _dataframe_definition_prompt(tuple(df.columns))
+
+
+@functools.lru_cache(maxsize=1024)
+def _dataframe_definition_prompt(columns):
+    # results with the same columns share the prompt
+    return (
+        "### the variable data that is a pandas dataframe, with properties: \n"
+        + "# {} \n".format(",".join(columns))
+    )
 
 
 def combine_prompts_graph(fixed_prompt, user_query):
@@ -113,22 +334,46 @@ def combine_prompts_graph(fixed_prompt, user_query):
 
 
 def remove_semicolons_in_brackets(input_str):
-    output_str = ""
-    inside_brackets = False
+    """Removes the semicolons inside round brackets in a single pass.
+
+    Brackets and semicolons inside string literals are left alone, so a title like 'a (b; c)' is kept.
+
+    Args:
+        input_str (str): Code that may contain semicolons inside brackets
+
+    Returns:
+        str: Code without semicolons inside brackets
+
+    Raises:
+        ValueError: When the brackets are unbalanced
+    """
+    output = []
     bracket_count = 0
+    quote = None
+    escaped = False
     for char in input_str:
-        if char == "(":
-            inside_brackets = True
+        if quote is not None:
+            # inside a string literal, only look for its end
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif char == "(":
             bracket_count += 1
         elif char == ")":
-            inside_brackets = False
             bracket_count -= 1
-        elif inside_brackets and char == ";":
+            if bracket_count < 0:
+                break
+        elif char == ";" and bracket_count > 0:
             continue
-        output_str += char
+        output.append(char)
     if bracket_count != 0:
         raise ValueError("Unbalanced brackets in input string")
-    return output_str
+    return "".join(output)
 
 
 def handle_response_graph(response):
@@ -136,17 +381,19 @@ def handle_response_graph(response):
     "fig.add_trace(go.Scatter(x=data['debt'], y=data['income'], mode='markers'))\nfig.show()\n\n"
     "fig.add_trace(go.Scatter(x=data['debt'], y=data['income'], mode='markers', name='Debt vs Income'))\nfig.update_layout(title='Debt vs Income', xaxis_title='Debt', yaxis_title='Income')\nfig.show()\n\n"
 
+    The lines are kept, so loops and conditions in the code stay valid Python.
+
     Args:
         response (openAi response): Response json from OpenAI
 
     Returns:
-        string: Proposed SQL query
+        string: Proposed Python code
     """
     query = response["choices"][0]["text"]
-    query = query.replace("\n", ";").replace("fig.show()", "").strip(";")
+    query = query.replace("fig.show()", "")
     query = remove_semicolons_in_brackets(query)
 
-    return query
+    return query.strip("; \n")
 
 
 def single_semicolon(input_str):
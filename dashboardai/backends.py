@@ -0,0 +1,308 @@
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from dashboardai.config import get_setting
+from dashboardai.data import (
+    create_duckdb,
+    create_sqlite_db,
+    create_sqlite_index,
+    drop_sqlite_index,
+    get_duckdb_nbytes,
+    get_duckdb_table_info,
+    get_index_columns,
+    get_index_limits,
+    get_sqlite_nbytes,
+    get_sqlite_table_info,
+    load_duckdb_tables,
+    load_sqlite_tables,
+    query_duckdb,
+    query_sqlite_db,
+    quote_identifier,
+    validate_duckdb_query,
+    validate_sqlite_query,
+)
+from dashboardai.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# the indexes are built one at a time, next to the queries of the other sessions
+_index_pool = ThreadPoolExecutor(1, thread_name_prefix="dashboardai-index")
+
+
+def count_rows(dataframes):
+    """Returns the total number of rows of a list of dicts with keys name and data."""
+    return sum(len(dataframe["data"]) for dataframe in dataframes)
+
+
+class Database:
+    """
+    A dataset loaded into a backend. Wraps the native connection of the backend and serializes
+    the queries on it, so that one database can be shared by every request of a session.
+
+    The columns generated queries filter, join and group on are counted, see record_usage. On backends
+    with indexes a column used min_uses times is indexed in the background, as long as its table has
+    min_rows rows and the indexes of the database take less than max_bytes.
+    """
+
+    def __init__(
+        self, backend, connection, min_uses=None, min_rows=None, max_bytes=None
+    ):
+        self.backend = backend
+        self.connection = connection
+        limits = get_index_limits()
+        self.min_uses = limits["min_uses"] if min_uses is None else min_uses
+        self.min_rows = limits["min_rows"] if min_rows is None else min_rows
+        self.max_bytes = limits["max_bytes"] if max_bytes is None else max_bytes
+        self._lock = threading.Lock()
+        self._memo = {}
+        self._usage = Counter()
+        # (table, column) -> bytes of the index, None while it is built, 0 when it failed or was over max_bytes
+        self._indexes = {}
+        self._index_lock = threading.Lock()
+        self._closed = False
+
+    def table_info(self):
+        """
+        Returns the tables with their column names and datatypes, see get_sqlite_table_info.
+        The tables of a database never change, so the schema is read once and then returned from memory.
+        The returned dict is shared and must not be modified.
+        """
+        return self.memoize("table_info", self._read_table_info)
+
+    def memoize(self, key, factory):
+        """
+        Returns the value stored under key, computing it with factory() on first use.
+        Values derived from the schema, like prompts, live as long as this version of the dataset.
+
+        :param key: name of the value
+        :param factory: function without arguments computing the value
+        :return: value
+        """
+        try:
+            return self._memo[key]
+        except KeyError:
+            return self._memo.setdefault(key, factory())
+
+    def query(self, query, params=None, **limits):
+        """
+        Executes a query with optional ? parameters and returns the result as a pandas dataframe.
+        The limits timeout, max_rows, max_bytes and cancelled are passed to the backend, see query_sqlite_db.
+        """
+        return self._locked(self.backend.query, query, params, **limits)
+
+    def nbytes(self):
+        """Returns the memory taken by the database in bytes, without the dataframes it only scans."""
+        return self._locked(self.backend.nbytes)
+
+    def row_counts(self):
+        """
+        Returns the number of rows of every table, counted once like the schema is read once.
+        The returned dict is shared and must not be modified.
+        """
+        return self.memoize(
+            "row_counts",
+            lambda: {
+                name: int(
+                    self.query(f"SELECT COUNT(*) FROM {quote_identifier(name)}").iloc[
+                        0, 0
+                    ]
+                )
+                for name in self.table_info()
+            },
+        )
+
+    def validate(self, query, **limits):
+        """
+        Checks a generated query before it runs and returns warnings about its cost.
+        The limits max_cost and scan_rows are passed to the backend, see validate_sqlite_query.
+
+        :raises QueryRejected: if the query is not a read-only SELECT or too expensive
+        """
+        return self._locked(self.backend.validate, query, self.row_counts(), **limits)
+
+    def record_usage(self, query):
+        """
+        Counts the columns a generated query filters, joins or groups on, see get_index_columns, and
+        starts to build the indexes of the columns that reached min_uses.
+
+        :param query: query string
+        :return: True if one of the columns is indexed already
+        """
+        if not self.min_uses or not self.backend.indexes:
+            return False
+        columns = get_index_columns(query, self.table_info())
+        row_counts = self.row_counts()
+        indexed = False
+        with self._index_lock:
+            for key in columns:
+                self._usage[key] += 1
+                indexed = indexed or bool(self._indexes.get(key))
+                if (
+                    key not in self._indexes
+                    and self._usage[key] >= self.min_uses
+                    and row_counts.get(key[0], 0) >= self.min_rows
+                    and self._index_bytes() < self.max_bytes
+                ):
+                    self._indexes[key] = None
+                    _index_pool.submit(self._create_index, *key, row_counts[key[0]])
+        return indexed
+
+    def indexes(self):
+        """Returns the automatic indexes of the database, a dict of (table, column) keys and bytes."""
+        with self._index_lock:
+            return {key: nbytes for key, nbytes in self._indexes.items() if nbytes}
+
+    def _create_index(self, table, column, rows):
+        key = (table, column)
+        with self._lock:
+            # the table may have been replaced or the database disposed in the meantime
+            if self._closed or key not in self._indexes:
+                return
+            with metrics.span("index", rows=rows) as span:
+                try:
+                    nbytes = self.backend.create_index(self.connection, table, column)
+                except Exception:
+                    logger.exception("index on %s.%s failed", table, column)
+                    nbytes = 0
+                with self._index_lock:
+                    if self._index_bytes() + nbytes > self.max_bytes:
+                        # too large, the column is not indexed again
+                        self.backend.drop_index(self.connection, table, column)
+                        nbytes = 0
+                    self._indexes[key] = nbytes
+                span["bytes"] = nbytes
+
+    def _index_bytes(self):
+        return sum(nbytes or 0 for nbytes in self._indexes.values())
+
+    def load(self, dataframes, drop=()):
+        """
+        Adds tables to the database, replacing tables with the same name, and removes the tables in drop.
+        The memoized schema and prompts are computed again on their next use.
+
+        :param dataframes: list of dicts with keys name and data
+        :param drop: names of tables to remove
+        """
+        tables = {dataframe["name"] for dataframe in dataframes} | set(drop)
+        with metrics.span("load", rows=count_rows(dataframes)), self._lock:
+            self.backend.load(self.connection, dataframes, drop)
+            self._memo.clear()
+            # the indexes of the replaced tables are gone, pending builds on them are skipped
+            with self._index_lock:
+                for key in [key for key in self._usage if key[0] in tables]:
+                    del self._usage[key]
+                    self._indexes.pop(key, None)
+
+    def dispose(self):
+        """Releases the connection of the backend."""
+        with self._lock:
+            self._closed = True
+            self.backend.close(self.connection)
+
+    def _read_table_info(self):
+        with metrics.span("schema"):
+            return self._locked(self.backend.table_info)
+
+    def _locked(self, method, *args, **kwargs):
+        with self._lock:
+            return method(self.connection, *args, **kwargs)
+
+
+class SQLiteBackend:
+    """In-memory sqlite database, the tables are copied into it with pandas.to_sql()."""
+
+    name = "sqlite"
+    indexes = True
+
+    def create(self, dataframes):
+        """
+        Loads a list of dicts with keys name (the table name) and data (pandas dataframes).
+
+        :param dataframes: list of dicts with keys name and data
+        :return: Database
+        """
+        with metrics.span("load", rows=count_rows(dataframes)):
+            return Database(self, create_sqlite_db(dataframes))
+
+    def load(self, connection, dataframes, drop=()):
+        load_sqlite_tables(connection, dataframes, drop)
+
+    def table_info(self, connection):
+        return get_sqlite_table_info(connection)
+
+    def query(self, connection, query, params=None, **limits):
+        return query_sqlite_db(connection, query, params, **limits)
+
+    def validate(self, connection, query, row_counts, max_cost=None, scan_rows=None):
+        return validate_sqlite_query(connection, query, row_counts, max_cost, scan_rows)
+
+    def create_index(self, connection, table, column):
+        return create_sqlite_index(connection, table, column)
+
+    def drop_index(self, connection, table, column):
+        drop_sqlite_index(connection, table, column)
+
+    def nbytes(self, connection):
+        return get_sqlite_nbytes(connection)
+
+    def close(self, connection):
+        connection.dispose()
+
+
+class DuckDBBackend:
+    """In-memory DuckDB database, the dataframes are registered as views without copying them."""
+
+    name = "duckdb"
+    # views cannot be indexed, the columnar scans skip row groups with their min/max statistics instead
+    indexes = False
+
+    def create(self, dataframes):
+        """
+        Loads a list of dicts with keys name (the table name) and data (pandas dataframes or pyarrow tables).
+
+        :param dataframes: list of dicts with keys name and data
+        :return: Database
+        """
+        with metrics.span("load", rows=count_rows(dataframes)):
+            return Database(self, create_duckdb(dataframes))
+
+    def load(self, connection, dataframes, drop=()):
+        load_duckdb_tables(connection, dataframes, drop)
+
+    def table_info(self, connection):
+        return get_duckdb_table_info(connection)
+
+    def query(self, connection, query, params=None, **limits):
+        return query_duckdb(connection, query, params, **limits)
+
+    def validate(self, connection, query, row_counts, max_cost=None, scan_rows=None):
+        # columnar scans are cheap without indexes, only the loop joins are checked
+        return validate_duckdb_query(connection, query, max_cost, scan_rows)
+
+    def nbytes(self, connection):
+        return get_duckdb_nbytes(connection)
+
+    def close(self, connection):
+        connection.close()
+
+
+BACKENDS = {backend.name: backend for backend in (SQLiteBackend, DuckDBBackend)}
+
+
+def get_backend(name=None):
+    """
+    Returns the backend with the given name, by default the one configured with DASHBOARDAI_SQL_BACKEND.
+
+    :param name: sqlite or duckdb
+    :return: backend instance
+    """
+    if name is None:
+        name = get_setting("sql_backend", "sqlite")
+    try:
+        return BACKENDS[name.lower()]()
+    except KeyError:
+        raise ValueError(
+            f"Unknown sql backend {name!r}, expected one of {sorted(BACKENDS)}"
+        ) from None
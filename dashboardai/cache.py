@@ -0,0 +1,410 @@
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+from dashboardai.config import get_setting
+
+
+def make_completion_key(model, prompt, stop, max_tokens, provider="openai"):
+    """
+    Returns the cache key of a completion request, a sha256 hex digest of its parameters.
+
+    Args:
+        model (string): Name of the model
+        prompt (string): Prompt sent to the model
+        stop (list): Stop sequences
+        max_tokens (int): Maximum number of tokens to generate
+        provider (string): Name of the provider answering the request, see dashboardai.providers
+
+    Returns:
+        string: Cache key
+    """
+    payload = json.dumps(
+        {
+            "provider": provider,
+            "model": model,
+            "prompt": prompt,
+            "stop": stop,
+            "max_tokens": max_tokens,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """Two-level cache for LLM completions: an in-memory LRU in front of a local SQLite file.
+
+    Completions at temperature 0 are deterministic, so a repeated prompt is answered from the
+    cache instead of the API. Entries expire after ttl_seconds. The memory level keeps at most
+    max_memory_entries, the disk level at most max_disk_entries, least recently used first out.
+    The disk file can be shared by several server processes. Setting path to None keeps the
+    cache in memory only.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        ttl_seconds=None,
+        max_memory_entries=None,
+        max_disk_entries=None,
+        clock=time.time,
+    ):
+        self.path = path
+        self.ttl_seconds = (
+            get_setting("llm_cache_ttl_seconds", 7 * 24 * 3600.0)
+            if ttl_seconds is None
+            else ttl_seconds
+        )
+        self.max_memory_entries = (
+            get_setting("llm_cache_memory_entries", 1024)
+            if max_memory_entries is None
+            else max_memory_entries
+        )
+        self.max_disk_entries = (
+            get_setting("llm_cache_disk_entries", 100_000)
+            if max_disk_entries is None
+            else max_disk_entries
+        )
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS completions "
+                "(key TEXT PRIMARY KEY, response TEXT, created REAL, accessed REAL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS completions_accessed ON completions(accessed)"
+            )
+            self._db.commit()
+
+    def get(self, key):
+        """Returns the cached response for a key, None on a miss or when the entry expired.
+
+        Args:
+            key (string): Cache key, see make_completion_key
+
+        Returns:
+            dict: Response from the LLM or None
+        """
+        now = self._clock()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] <= self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0]
+            self._memory.pop(key, None)
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT response, created FROM completions WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and now - row[1] <= self.ttl_seconds:
+                    self._db.execute(
+                        "UPDATE completions SET accessed = ? WHERE key = ?", (now, key)
+                    )
+                    self._db.commit()
+                    response = json.loads(row[0])
+                    self._remember(key, response, row[1])
+                    self.disk_hits += 1
+                    return response
+                if row is not None:
+                    self._db.execute("DELETE FROM completions WHERE key = ?", (key,))
+                    self._db.commit()
+            self.misses += 1
+            return None
+
+    def set(self, key, response):
+        """Stores a response in both levels of the cache.
+
+        Args:
+            key (string): Cache key, see make_completion_key
+            response (dict): JSON serializable response from the LLM
+        """
+        now = self._clock()
+        response = json.loads(json.dumps(response))
+        with self._lock:
+            self._remember(key, response, now)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(response), now, now),
+                )
+                self._db.execute(
+                    "DELETE FROM completions WHERE key IN (SELECT key FROM completions "
+                    "ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.max_disk_entries,),
+                )
+                self._db.commit()
+
+    def clear(self):
+        """Removes every entry from both levels of the cache."""
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM completions")
+                self._db.commit()
+
+    def stats(self):
+        """Returns the hit and miss counters and the hit rate of the cache."""
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+            }
+
+    def _remember(self, key, response, created):
+        self._memory[key] = (response, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+
+SQL_LITERAL = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+
+
+def normalize_sql(query):
+    """
+    Returns a canonical form of a query for use as cache key. Runs of whitespace are collapsed and
+    trailing semicolons are removed. The case of the query and the spaces around operators are kept:
+    the column labels of a result are spelled like the query, and a - -1 is not a--1. Quoted strings
+    and names are kept as is.
+
+    Args:
+        query (string): SQL query
+
+    Returns:
+        string: Normalized query
+    """
+    parts = SQL_LITERAL.split(query.strip().rstrip(";").strip())
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r"\s+", " ", parts[i])
+    return "".join(parts)
+
+
+class ResultCache:
+    """Cache of query results keyed on the normalized SQL and the content hash of the dataset.
+
+    Results are kept in memory up to max_bytes, measured with DataFrame.memory_usage, and evicted
+    least recently used first. A result larger than max_entry_bytes is written to spill_dir as a
+    zstd compressed Parquet file instead (requires pyarrow), the spilled files are limited to
+    max_spill_bytes. The cached dataframes are shared and must not be modified.
+    """
+
+    def __init__(
+        self, max_bytes=None, max_entry_bytes=None, spill_dir=None, max_spill_bytes=None
+    ):
+        self.max_bytes = (
+            get_setting("result_cache_max_bytes", 500_000_000)
+            if max_bytes is None
+            else max_bytes
+        )
+        self.max_entry_bytes = (
+            self.max_bytes // 4 if max_entry_bytes is None else max_entry_bytes
+        )
+        self.spill_dir = (
+            get_setting("result_cache_dir", ".dashboardai/results")
+            if spill_dir is None
+            else spill_dir
+        )
+        self.max_spill_bytes = (
+            get_setting("result_cache_max_spill_bytes", 5_000_000_000)
+            if max_spill_bytes is None
+            else max_spill_bytes
+        )
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._memory = OrderedDict()
+        self._spilled = OrderedDict()
+        self._nbytes = 0
+        self._spilled_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(version, query):
+        """Returns the cache key of a query on a version of a dataset."""
+        return f"{version}:{normalize_sql(query)}"
+
+    def get(self, version, query):
+        """Returns the cached result of a query, None on a miss.
+
+        Args:
+            version (string): Content hash of the dataset
+            query (string): SQL query
+
+        Returns:
+            pandas.DataFrame: Cached result or None
+        """
+        key = self.make_key(version, query)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key][0]
+            path = self._spilled.get(key)
+            if path is not None:
+                self._spilled.move_to_end(key)
+        if path is not None:
+            try:
+                result = pd.read_parquet(path[0])
+            except OSError:
+                result = None
+            if result is not None:
+                with self._lock:
+                    self.hits += 1
+                return result
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, version, query, result):
+        """Stores the result of a query.
+
+        Args:
+            version (string): Content hash of the dataset
+            query (string): SQL query
+            result (pandas.DataFrame): Result of the query
+        """
+        key = self.make_key(version, query)
+        nbytes = int(result.memory_usage(index=True, deep=True).sum())
+        if nbytes > self.max_entry_bytes:
+            self._spill(key, result)
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._nbytes -= previous[1]
+            self._memory[key] = (result, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes and self._memory:
+                _, (_, evicted) = self._memory.popitem(last=False)
+                self._nbytes -= evicted
+                self.evictions += 1
+
+    def stats(self):
+        """Returns the hit and miss counters and the size of both levels."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._nbytes,
+                "spilled_entries": len(self._spilled),
+                "spilled_bytes": self._spilled_bytes,
+            }
+
+    def _spill(self, key, result):
+        if importlib.util.find_spec("pyarrow") is None:
+            return
+        os.makedirs(self.spill_dir, exist_ok=True)
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest() + ".parquet"
+        path = os.path.join(self.spill_dir, name)
+        result.to_parquet(path, compression="zstd", index=False)
+        size = os.path.getsize(path)
+        with self._lock:
+            previous = self._spilled.pop(key, None)
+            if previous is not None:
+                self._spilled_bytes -= previous[1]
+            self._spilled[key] = (path, size)
+            self._spilled_bytes += size
+            removed = []
+            while self._spilled_bytes > self.max_spill_bytes and len(self._spilled) > 1:
+                _, (old_path, old_size) = self._spilled.popitem(last=False)
+                self._spilled_bytes -= old_size
+                self.evictions += 1
+                removed.append(old_path)
+        for old_path in removed:
+            if old_path != path:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+
+def make_chart_key(question, data):
+    """
+    Returns the cache key of a chart: the question, case and whitespace insensitive, and the
+    column names and dtypes of the data. Charts for the same question on data of the same shape share
+    their code.
+
+    Args:
+        question (string): Question of the user
+        data (pandas.DataFrame): Data the chart is drawn from
+
+    Returns:
+        tuple: Cache key
+    """
+    columns = tuple((str(name), str(dtype)) for name, dtype in data.dtypes.items())
+    return " ".join(question.lower().split()), columns
+
+
+class ChartCodeCache:
+    """LRU cache of compiled chart programs keyed on the question and the columns of the data.
+
+    A chart is re-rendered on new data by running its cached code object again, without calling the
+    LLM or parsing the code. At most max_entries programs are kept.
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = (
+            get_setting("chart_cache_entries", 256)
+            if max_entries is None
+            else max_entries
+        )
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached code object for a key, see make_chart_key, None on a miss."""
+        with self._lock:
+            code_object = self._entries.get(key)
+            if code_object is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return code_object
+
+    def put(self, key, code_object):
+        """Stores a compiled chart program."""
+        with self._lock:
+            self._entries[key] = code_object
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """Returns the hit and miss counters and the number of cached programs."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+            }
@@ -0,0 +1,124 @@
+import pandas as pd
+
+from dashboardai.api import (
+    SchemaIndex,
+    combine_prompts,
+    combine_prompts_graph,
+    create_dataframe_definition_prompt,
+    handle_response,
+    handle_response_graph,
+    send_to_openai,
+)
+from dashboardai.cache import make_chart_key
+from dashboardai.config import get_setting
+from dashboardai.data import get_plan_limits, get_query_limits
+from dashboardai.jobs import check_cancelled
+from dashboardai.metrics import metrics
+from dashboardai.sandbox import compile_code, run_code
+from dashboardai.visualizations import optimize_figure
+
+
+def answer_table_question(cancelled, database, question, version=None, results=None):
+    """
+    This function runs the SQL pipeline for a question: prompt, LLM call and query.
+    It is run as a background job and stops between the stages once cancelled is set.
+    With a result cache, a query that was already run on the same version of the dataset is not run again.
+
+    :param cancelled: threading.Event set when the job is superseded, may be None
+    :param database: dashboardai.backends.Database with the tables of the session
+    :param question: question of the user
+    :param version: content hash of the dataset, the key of the result cache
+    :param results: optional dashboardai.cache.ResultCache
+    :return: dict with the keys query (the generated SQL), result (pandas dataframe), truncated (whether
+        the result was cut off at the row or memory limit), warnings (about the cost of the query, see
+        Database.validate) and prompt_stats (size of the schema prompt before and after pruning, see
+        SchemaIndex.prune)
+    :raises QueryRejected: if the generated query is not a read-only SELECT or too expensive to run
+    """
+    with metrics.span("prompt") as span:
+        # the schema index and the full prompt are built once per version of the dataset
+        index = database.memoize(
+            "schema_index",
+            lambda: SchemaIndex(database.table_info(), database.backend.name),
+        )
+        fixed_sql_prompt, prompt_stats = index.prune(
+            question, get_setting("prompt_max_tokens", 2500)
+        )
+        prompt = combine_prompts(fixed_sql_prompt, question)
+        span["bytes"] = len(prompt)
+        metrics.observe_bytes("prompt_full", len(index.prompt))
+        metrics.observe_bytes("prompt_pruned", len(fixed_sql_prompt))
+    check_cancelled(cancelled)
+    with metrics.span("llm") as span:
+        response = send_to_openai(prompt, stop=[";", "#"])
+        query = handle_response(response)
+        span["bytes"] = len(query)
+    check_cancelled(cancelled)
+    with metrics.span("validate"):
+        # the query is planned without running it, so that bad queries fail fast
+        warnings = database.validate(query, **get_plan_limits())
+        # the columns it filters, joins and groups on are indexed once they are used often
+        indexed = database.record_usage(query)
+    result = None
+    if results is not None:
+        result = results.get(version, query)
+    if result is None:
+        with metrics.span("sql") as span:
+            # a runaway query raises QueryAborted instead of blocking the worker
+            result = database.query(query, cancelled=cancelled, **get_query_limits())
+            span["rows"] = len(result)
+            span["bytes"] = int(result.memory_usage(index=False).sum())
+        if indexed:
+            # compared with the sql stage, the time saved by the automatic indexes
+            metrics.observe("sql_indexed", span["seconds"], rows=span["rows"])
+        # a truncated result depends on the limits, so it is not shared
+        if results is not None and not result.attrs.get("truncated"):
+            results.put(version, query, result)
+    check_cancelled(cancelled)
+    return {
+        "query": query,
+        "result": result,
+        "truncated": bool(result.attrs.get("truncated")),
+        "warnings": warnings,
+        "prompt_stats": prompt_stats,
+    }
+
+
+# variables available to the generated chart code
+GRAPH_NAMES = ("go", "pd", "np", "data", "fig")
+
+
+def answer_graph_question(cancelled, data, question, charts=None):
+    """
+    This function runs the graph pipeline for a question: prompt, LLM call and execution of the plotly code.
+    It is run as a background job and stops between the stages once cancelled is set.
+    The code is validated against a whitelist and compiled, see dashboardai.sandbox.compile_code. With a
+    chart cache, a question asked again on data with the same columns reuses the compiled code without
+    another LLM call.
+
+    :param cancelled: threading.Event set when the job is superseded, may be None
+    :param data: pandas dataframe with the query result, available to the code as data
+    :param question: question of the user
+    :param charts: optional dashboardai.cache.ChartCodeCache
+    :return: plotly figure, downsampled for large results, see optimize_figure
+    """
+    key = make_chart_key(question, data)
+    code_object = charts.get(key) if charts is not None else None
+    if code_object is None:
+        fixed_prompt = create_dataframe_definition_prompt(data)
+        prompt = combine_prompts_graph(fixed_prompt, question)
+        check_cancelled(cancelled)
+        with metrics.span("llm", bytes=len(prompt)):
+            response = send_to_openai(prompt, stop=["fig.show()"])
+        check_cancelled(cancelled)
+        code_object = compile_code(handle_response_graph(response), GRAPH_NAMES)
+        if charts is not None:
+            charts.put(key, code_object)
+    # imported on the first chart, the app starts without plotly.graph_objs
+    import numpy as np
+    import plotly.graph_objs as go
+
+    with metrics.span("render", rows=len(data)):
+        namespace = {"go": go, "pd": pd, "np": np, "data": data, "fig": go.Figure()}
+        run_code(code_object, namespace)
+        return optimize_figure(namespace["fig"])
@@ -0,0 +1,18 @@
+import os
+
+
+def get_setting(name, default):
+    """
+    Read a setting from the environment variable DASHBOARDAI_<NAME>.
+    The value is cast to the type of the default, booleans accept 1/true/yes/on.
+
+    :param name: name of the setting, case insensitive
+    :param default: value returned when the variable is not set
+    :return: value of the setting
+    """
+    value = os.getenv(f"DASHBOARDAI_{name.upper()}")
+    if value is None or default is None:
+        return default if value is None else value
+    if isinstance(default, bool):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return type(default)(value)
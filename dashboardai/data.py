@@ -1,9 +1,45 @@
 import base64
+import functools
+import hashlib
+import importlib.util
 import io
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import threading
+import time
+import tracemalloc
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
-from dash import html
-from sqlalchemy import create_engine, inspect, text
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import StaticPool
+
+from dashboardai.config import get_setting
+from dashboardai.metrics import metrics
+from dashboardai.registry import get_dataframe_nbytes
+
+# gapminder data shown before the first upload, bundled so that the app starts offline
+DEFAULT_DATASET = os.path.join(
+    os.path.dirname(__file__), "datasets", "gapminderDataFiveYear.csv"
+)
+
+PAYLOAD_FORMATS = ("arrow", "columns", "records")
+
+
+@functools.lru_cache(maxsize=1)
+def load_default_dataset():
+    """
+    This function loads the dataset shown before the first upload, once per process.
+    The path can be changed with DASHBOARDAI_DEFAULT_DATASET, by default the bundled gapminder data.
+
+    :return: pandas dataframe, shared and must not be modified
+    """
+    return pd.read_csv(get_setting("default_dataset", DEFAULT_DATASET))
 
 
 def create_sqlite_db(dataframes):
@@ -14,12 +50,71 @@ def create_sqlite_db(dataframes):
     :param dataframes: list of pandas dataframes
     :return: sqlite database
     """
-    # create an in memory sqlite database
-    engine = create_engine("sqlite:///:memory:")
+    # create an in memory sqlite database, the single connection is shared so the engine can be reused across threads
+    engine = create_engine(
+        "sqlite://",
+        poolclass=StaticPool,
+        connect_args={"check_same_thread": False},
+    )
+    load_sqlite_tables(engine, dataframes)
+    return engine
+
+
+def load_sqlite_tables(engine, dataframes, drop=()):
+    """
+    This function adds tables to a sqlite database, a table with the same name is replaced.
+
+    :param engine: sqlite database
+    :param dataframes: list of dicts with keys name (the table name) and data (pandas dataframes or pyarrow tables)
+    :param drop: names of tables to remove
+    """
+    with engine.begin() as conn:
+        for name in drop:
+            conn.execute(text(f"DROP TABLE IF EXISTS {quote_identifier(name)}"))
     # loop through the dataframes and save them to the database
     for df in dataframes:
-        df["data"].to_sql(df["name"], engine, index=False)
-    return engine
+        to_sqlite_dates(to_dataframe(df["data"])).to_sql(
+            df["name"], engine, index=False, if_exists="replace"
+        )
+
+
+def to_sqlite_dates(df):
+    """
+    This function turns the datetime columns of a dataframe into ISO text, the way sqlite compares dates. Without
+    a time of day the values are dates like 2020-01-01, so that generated filters on date literals match them.
+
+    :param df: pandas dataframe, not modified
+    :return: pandas dataframe, df itself if it has no datetime columns
+    """
+    converted = None
+    for i, (_, column) in enumerate(df.items()):
+        if not pd.api.types.is_datetime64_any_dtype(column.dtype):
+            continue
+        values = column.dropna()
+        if (values.dt.normalize() == values).all():
+            text = np.datetime_as_string(column.dt.tz_localize(None).to_numpy(), "D")
+            text = pd.Series(text, index=column.index).where(column.notna())
+        elif (values.dt.microsecond == 0).all():
+            text = column.dt.strftime("%Y-%m-%d %H:%M:%S")
+        else:
+            text = column.dt.strftime("%Y-%m-%d %H:%M:%S.%f")
+        if converted is None:
+            converted = df.copy(deep=False)
+        converted.isetitem(i, text)
+    return df if converted is None else converted
+
+
+def to_dataframe(data):
+    """
+    This function returns a table as a pandas dataframe, pyarrow tables (see dashboardai.registry.DiskStore)
+    are converted and dataframes are returned as they are.
+
+    :param data: pandas dataframe or pyarrow table
+    :return: pandas dataframe
+    """
+    if isinstance(data, pd.DataFrame):
+        return data
+    return data.to_pandas()
 
 
 def get_sqlite_table_info(engine):
@@ -30,93 +125,1281 @@ def get_sqlite_table_info(engine):
     :param engine: sqlite database
     :return: dictionary with table names as keys and column names and datatypes as values
     """
-    # get the table names from the database using inspector
-    inspector = inspect(engine)
-    table_names = inspector.get_table_names()
-
-    # create an empty dictionary to store the table info
+    # read the columns of every table with a single query on the table valued pragma function
     table_info = {}
-
-    # Create a connection to execute queries
     with engine.connect() as conn:
-        # loop through the table names
-        for table in table_names:
-            # get the column names and datatypes of the table
-            table_info[table] = [
-                {"name": tup[1], "dtype": tup[2]}
-                for tup in conn.execute(text(f"PRAGMA table_info({table})")).fetchall()
-            ]
-
+        columns = conn.execute(
+            text(
+                "SELECT m.name, p.name, p.type FROM sqlite_master AS m "
+                "JOIN pragma_table_info(m.name) AS p "
+                "WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%' "
+                "ORDER BY m.name, p.cid"
+            )
+        ).fetchall()
+    for table, column, dtype in columns:
+        table_info.setdefault(table, []).append({"name": column, "dtype": dtype})
     return table_info
 
 
-def query_sqlite_db(engine, query):
+class QueryAborted(Exception):
+    """Raised when a query runs longer than its timeout or is cancelled."""
+
+
+class QueryRejected(QueryAborted):
+    """Raised before a query runs when it is not a single read-only SELECT or its plan is too expensive."""
+
+
+def fetch_limited(fetch, columns, max_rows=None, max_bytes=None):
+    """
+    This function reads a query result in chunks and stops early once the result grows beyond max_rows rows
+    or max_bytes bytes of memory. result.attrs["truncated"] tells whether rows were left out.
+
+    :param fetch: function returning the next chunk as a pandas dataframe or list of rows, empty at the end
+    :param columns: column names for chunks that are lists of rows
+    :param max_rows: maximum number of rows, None for no limit
+    :param max_bytes: maximum memory of the result in bytes, None for no limit. At least one chunk is kept.
+    :return: pandas dataframe
+    """
+    frames, rows, nbytes, truncated = [], 0, 0, False
+    while True:
+        chunk = fetch()
+        if len(chunk) == 0:
+            break
+        if not isinstance(chunk, pd.DataFrame):
+            chunk = pd.DataFrame.from_records(chunk, columns=columns, coerce_float=True)
+        if max_rows is not None and rows + len(chunk) > max_rows:
+            chunk = chunk.iloc[: max_rows - rows]
+            truncated = True
+        if max_bytes is not None:
+            nbytes += int(chunk.memory_usage(index=False, deep=True).sum())
+            if nbytes > max_bytes and frames:
+                truncated = True
+                break
+        frames.append(chunk)
+        rows += len(chunk)
+        if truncated or (max_bytes is not None and nbytes > max_bytes):
+            truncated = True
+            break
+    if not frames:
+        result = pd.DataFrame(columns=columns)
+    elif len(frames) == 1:
+        result = frames[0].reset_index(drop=True)
+    else:
+        result = pd.concat(frames, ignore_index=True)
+    result.attrs["truncated"] = truncated
+    return result
+
+
+def query_sqlite_db(
+    engine,
+    query,
+    params=None,
+    timeout=None,
+    max_rows=None,
+    max_bytes=None,
+    cancelled=None,
+):
     """
     This function takes a sqlite database and a query string and returns the result of the query as a pandas dataframe.
+    With a timeout or cancelled event a progress handler interrupts the query, which raises QueryAborted.
+    With max_rows or max_bytes the result is fetched in chunks and cut off, see fetch_limited.
     :param engine: sqlite database
     :param query: query string
+    :param params: optional list of parameters for the ? placeholders of the query
+    :param timeout: maximum run time in seconds, None for no limit
+    :param max_rows: maximum number of rows of the result, None for no limit
+    :param max_bytes: maximum memory of the result in bytes, None for no limit
+    :param cancelled: optional threading.Event, the query is interrupted once it is set
     :return: pandas dataframe
     """
-    # use the pandas.read_sql_query() method to execute the query and return the result as a dataframe
-    return pd.read_sql_query(query, engine)
+    if timeout is None and max_rows is None and max_bytes is None and cancelled is None:
+        # use the pandas.read_sql_query() method to execute the query and return the result as a dataframe
+        if params is None:
+            return pd.read_sql_query(query, engine)
+        return pd.read_sql_query(query, engine, params=tuple(params))
 
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    def interrupt():
+        # a non zero return value makes sqlite abort the running statement
+        if cancelled is not None and cancelled.is_set():
+            return 1
+        return int(deadline is not None and time.monotonic() > deadline)
+
+    with engine.connect() as conn:
+        con = conn.connection.dbapi_connection
+        con.set_progress_handler(interrupt, 10000)
+        try:
+            cursor = con.cursor()
+            cursor.execute(query, tuple(params or ()))
+            columns = [d[0] for d in cursor.description or []]
+            return fetch_limited(
+                lambda: cursor.fetchmany(10000), columns, max_rows, max_bytes
+            )
+        except sqlite3.OperationalError as e:
+            if "interrupted" not in str(e):
+                raise
+            raise QueryAborted(_abort_reason(cancelled, timeout)) from e
+        finally:
+            con.set_progress_handler(None, 0)
+
+
+def get_query_limits():
+    """
+    Returns the limits for generated queries from the settings DASHBOARDAI_QUERY_TIMEOUT_SECONDS,
+    DASHBOARDAI_QUERY_MAX_ROWS and DASHBOARDAI_QUERY_MAX_BYTES, a value of 0 disables a limit.
+
+    :return: dict with the keys timeout, max_rows and max_bytes
+    """
+    limits = {
+        "timeout": get_setting("query_timeout_seconds", 30.0),
+        "max_rows": get_setting("query_max_rows", 1_000_000),
+        "max_bytes": get_setting("query_max_bytes", 500_000_000),
+    }
+    return {key: value or None for key, value in limits.items()}
+
+
+def get_plan_limits():
+    """
+    Returns the limits of the plan check of generated queries from the settings DASHBOARDAI_QUERY_MAX_COST
+    (rows combined by cross products and nested loop joins, refused above) and DASHBOARDAI_QUERY_SCAN_WARNING_ROWS
+    (full scans of larger tables are reported), a value of 0 disables a limit.
+
+    :return: dict with the keys max_cost and scan_rows
+    """
+    limits = {
+        "max_cost": get_setting("query_max_cost", 1_000_000_000),
+        "scan_rows": get_setting("query_scan_warning_rows", 1_000_000),
+    }
+    return {key: value or None for key, value in limits.items()}
+
+
+# authorizer actions of a read-only SELECT, anything else fails to compile
+SQLITE_READ_ONLY_ACTIONS = {
+    sqlite3.SQLITE_SELECT,
+    sqlite3.SQLITE_READ,
+    sqlite3.SQLITE_FUNCTION,
+    getattr(sqlite3, "SQLITE_RECURSIVE", 33),
+}
+SQL_KEYWORDS = {
+    "where", "join", "inner", "left", "right", "full", "outer", "cross", "natural",
+    "on", "using", "group", "order", "limit", "having", "union", "except",
+    "intersect", "window", "select", "as",
+}  # fmt: skip
+# names following FROM or JOIN, with an optional alias that is not the next keyword
+TABLE_REFERENCE = re.compile(
+    r'(?:\bFROM|\bJOIN|,)\s+("(?:[^"]|"")+"|\w+)'
+    r'(?:\s+(?:AS\s+)?(?!(?:{})\b)("(?:[^"]|"")+"|\w+))?'.format(
+        "|".join(SQL_KEYWORDS)
+    ),
+    re.IGNORECASE,
+)
+
+
+def validate_sqlite_query(engine, query, row_counts, max_cost=None, scan_rows=None):
+    """
+    This function checks a generated query before it runs. The query is compiled, not run, with EXPLAIN QUERY PLAN
+    under an authorizer that only allows reading, so anything but a single read-only SELECT is refused. Tables scanned
+    in a nested loop, e.g. by a cross product or a join on an expression, multiply their rows: above max_cost rows
+    the query is refused. Full scans of tables with more than scan_rows rows are reported as warnings.
+
+    :param engine: sqlite database
+    :param query: query string
+    :param row_counts: dictionary with table names as keys and numbers of rows as values
+    :param max_cost: maximum number of rows combined by nested loops, None for no limit
+    :param scan_rows: tables with more rows are reported when they are fully scanned, None for no warnings
+    :return: list of warning messages
+    :raises QueryRejected: if the query is not a valid read-only SELECT or too expensive
+    """
+
+    def authorize(action, *args):
+        return (
+            sqlite3.SQLITE_OK
+            if action in SQLITE_READ_ONLY_ACTIONS
+            else sqlite3.SQLITE_DENY
+        )
+
+    with engine.connect() as conn:
+        con = conn.connection.dbapi_connection
+        con.set_authorizer(authorize)
+        try:
+            plan = con.execute("EXPLAIN QUERY PLAN " + query).fetchall()
+        except sqlite3.DatabaseError as e:
+            if "not authorized" in str(e):
+                raise QueryRejected("Only read-only SELECT queries are allowed") from e
+            raise QueryRejected(f"Invalid query: {e}") from e
+        except sqlite3.ProgrammingError as e:
+            raise QueryRejected(f"Invalid query: {e}") from e
+        finally:
+            con.set_authorizer(None)
+
+    # the plan names tables by their alias
+    aliases = {name.lower(): name for name in row_counts}
+    aliases.update(_get_table_aliases(query, row_counts))
+
+    # the loops of a select are nested in plan order, a correlated subquery runs once per row of its select
+    warnings, loops, repeats = [], {}, {}
+    for node, parent, _, detail in plan:
+        outer = repeats.get(parent, 1)
+        for rows in loops.get(parent, []):
+            outer *= rows or 1
+        if detail.startswith("CORRELATED"):
+            repeats[node] = outer
+            continue
+        match = re.match(r"(SCAN|SEARCH) (.+?)(?: USING (.*))?$", detail)
+        if match is None:
+            continue
+        table = aliases.get(match.group(2).lower())
+        rows = row_counts.get(table) if table is not None else None
+        full_scan = match.group(1) == "SCAN" and match.group(3) is None
+        loops.setdefault(parent, []).append(rows)
+        if not full_scan or rows is None:
+            continue
+        cost = rows * outer
+        if max_cost is not None and outer > 1 and cost > max_cost:
+            raise QueryRejected(
+                f"The query would combine about {cost:.2g} rows of {table} with the other tables, "
+                "please ask a narrower question"
+            )
+        if scan_rows is not None and cost > scan_rows:
+            if outer > 1:
+                warnings.append(
+                    f"{table} ({rows} rows) is scanned once per row of the tables before it"
+                )
+            else:
+                warnings.append(f"Full scan of {table} ({rows} rows)")
+    return warnings
+
+
+def _get_table_aliases(query, tables):
+    # lower case names and aliases of the tables referenced by a query, with the name of their table
+    tables = {name.lower(): name for name in tables}
+    aliases = {}
+    for table, alias in TABLE_REFERENCE.findall(query):
+        table = _unquote(table).lower()
+        if table not in tables:
+            continue
+        aliases[table] = tables[table]
+        if alias:
+            aliases[_unquote(alias).lower()] = tables[table]
+    return aliases
+
+
+def _unquote(name):
+    return name.strip('"').replace('""', '"')
+
+
+# clauses whose columns an index can speed up, up to the next clause
+INDEX_CLAUSE = re.compile(
+    r"\b(?:WHERE|ON|USING|GROUP\s+BY)\b(.*?)"
+    r"(?=\b(?:SELECT|FROM|WHERE|JOIN|ON|USING|GROUP\s+BY|HAVING|ORDER\s+BY|LIMIT|UNION|EXCEPT|INTERSECT|WINDOW)\b|$)",
+    re.IGNORECASE | re.DOTALL,
+)
+# a column name, optionally qualified with its table or alias
+COLUMN_REFERENCE = re.compile(
+    r'("(?:[^"]|"")+"|[A-Za-z_]\w*)(?:\s*\.\s*("(?:[^"]|"")+"|[A-Za-z_]\w*))?'
+)
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+
+def get_index_columns(query, table_info):
+    """
+    This function returns the columns a query filters, joins or groups on, the columns an index can speed up.
+    The clauses WHERE, ON, USING and GROUP BY are searched for the columns of the tables the query reads, a column
+    name without a table belongs to every table of the query that has such a column.
+
+    :param query: query string
+    :param table_info: dictionary with table names as keys and lists of columns as values, see get_sqlite_table_info
+    :return: sorted list of (table, column) tuples
+    """
+    query = STRING_LITERAL.sub("''", query)
+    aliases = _get_table_aliases(query, table_info)
+    columns = {
+        table: {column["name"].lower(): column["name"] for column in table_info[table]}
+        for table in set(aliases.values())
+    }
+    found = set()
+    for clause in INDEX_CLAUSE.findall(query):
+        for first, second in COLUMN_REFERENCE.findall(clause):
+            if second:
+                table = aliases.get(_unquote(first).lower())
+                tables, name = ([table] if table is not None else []), second
+            else:
+                tables, name = columns, first
+            name = _unquote(name).lower()
+            for table in tables:
+                if name in columns[table]:
+                    found.add((table, columns[table][name]))
+    return sorted(found)
+
+
+def _get_index_name(table, column):
+    return quote_identifier(f"dashboardai_{table}.{column}")
+
+
+def _get_used_bytes(conn):
+    # pages of the database in use, the free pages of dropped tables are reused before it grows
+    pages = conn.execute(text("PRAGMA page_count")).scalar()
+    pages -= conn.execute(text("PRAGMA freelist_count")).scalar()
+    return pages * conn.execute(text("PRAGMA page_size")).scalar()
+
+
+def create_sqlite_index(engine, table, column):
+    """
+    This function creates an index on a column of a sqlite database, if the column has none yet.
+
+    :param engine: sqlite database
+    :param table: table name
+    :param column: column name
+    :return: memory taken by the index in bytes
+    """
+    with engine.begin() as conn:
+        before = _get_used_bytes(conn)
+        conn.execute(
+            text(
+                f"CREATE INDEX IF NOT EXISTS {_get_index_name(table, column)} "
+                f"ON {quote_identifier(table)} ({quote_identifier(column)})"
+            )
+        )
+        return max(_get_used_bytes(conn) - before, 0)
+
+
+def get_sqlite_nbytes(engine):
+    """
+    This function returns the memory taken by the tables and indexes of an in-memory sqlite database.
+
+    :param engine: sqlite database
+    :return: number of bytes
+    """
+    with engine.connect() as conn:
+        return _get_used_bytes(conn)
+
+
+def drop_sqlite_index(engine, table, column):
+    """
+    This function removes the index created by create_sqlite_index.
+
+    :param engine: sqlite database
+    :param table: table name
+    :param column: column name
+    """
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP INDEX IF EXISTS {_get_index_name(table, column)}"))
+
+
+def get_index_limits():
+    """
+    Returns the limits of the automatic indexes from the settings DASHBOARDAI_INDEX_MIN_USES (generated queries
+    on a column before it is indexed, 0 disables the indexes), DASHBOARDAI_INDEX_MIN_ROWS (smaller tables are not
+    indexed) and DASHBOARDAI_INDEX_MAX_BYTES (memory of the indexes of a database).
+
+    :return: dict with the keys min_uses, min_rows and max_bytes
+    """
+    return {
+        "min_uses": get_setting("index_min_uses", 3),
+        "min_rows": get_setting("index_min_rows", 10_000),
+        "max_bytes": get_setting("index_max_bytes", 200_000_000),
+    }
+
+
+# operators combining every row of a side with every row of the other
+DUCKDB_LOOP_JOINS = {"CROSS_PRODUCT", "NESTED_LOOP_JOIN", "BLOCKWISE_NL_JOIN"}
+# scans of the views of the dataframes and pyarrow tables, every other table function is refused
+DUCKDB_TABLE_SCANS = {"PANDAS_SCAN", "ARROW_SCAN", "ARROW_SCAN_DUMB"}
+
+
+def validate_duckdb_query(con, query, max_cost=None, scan_rows=None):
+    """
+    This function checks a generated query before it runs: it must be a single SELECT, which DuckDB plans with
+    EXPLAIN without running it, and read only the tables of the database, not table functions like read_csv or
+    range. Cross products and nested loop joins multiply the estimated rows of their
+    inputs, above max_cost rows the query is refused and above scan_rows rows it is reported.
+
+    :param con: DuckDB connection
+    :param query: query string
+    :param max_cost: maximum number of rows combined by a cross product or nested loop join, None for no limit
+    :param scan_rows: loop joins combining more rows are reported, None for no warnings
+    :return: list of warning messages
+    :raises QueryRejected: if the query is not a valid SELECT of the tables or too expensive
+    """
+    import duckdb
 
-def parse_contents(contents, filename):
-    print(f"Parsing file: {filename}")  # Debug print
-    content_type, content_string = contents.split(",")
-    decoded = base64.b64decode(content_string)
+    try:
+        statements = con.extract_statements(query)
+        if len(statements) != 1 or statements[0].type != duckdb.StatementType.SELECT:
+            raise QueryRejected("Only read-only SELECT queries are allowed")
+        plan = con.execute("EXPLAIN (FORMAT JSON) " + query).fetchall()[0][1]
+    except duckdb.Error as e:
+        # the first line has the message, the next ones point at the query
+        raise QueryRejected(f"Invalid query: {str(e).splitlines()[0]}") from e
+
+    warnings = []
+
+    def visit(node):
+        rows = [visit(child) for child in node.get("children", [])]
+        function = node.get("extra_info", {}).get("Function")
+        if function is not None and function not in DUCKDB_TABLE_SCANS:
+            raise QueryRejected(
+                f"Only the tables of the dataset can be queried, not {function.lower()}"
+            )
+        estimate = node.get("extra_info", {}).get("Estimated Cardinality")
+        if node["name"] in DUCKDB_LOOP_JOINS and rows:
+            cost = 1
+            for child_rows in rows:
+                cost *= child_rows or 1
+            if max_cost is not None and cost > max_cost:
+                raise QueryRejected(
+                    f"The query would combine about {cost:.2g} rows, please ask a narrower question"
+                )
+            if scan_rows is not None and cost > scan_rows:
+                warnings.append(f"{node['name']} of about {cost:.2g} rows")
+        try:
+            return int(estimate)
+        except (TypeError, ValueError):
+            return max(rows, default=None, key=lambda r: r or 0)
+
+    for node in json.loads(plan):
+        visit(node)
+    return warnings
+
+
+def _abort_reason(cancelled, timeout):
+    if cancelled is not None and cancelled.is_set():
+        return "Query cancelled"
+    return f"Query aborted after {timeout:g} seconds"
+
+
+FILTER_OPERATORS = {
+    "=": "=",
+    "eq": "=",
+    "!=": "!=",
+    "ne": "!=",
+    "<": "<",
+    "lt": "<",
+    "<=": "<=",
+    "le": "<=",
+    ">": ">",
+    "gt": ">",
+    ">=": ">=",
+    "ge": ">=",
+    "contains": "LIKE",
+    "datestartswith": "LIKE",
+}
+FILTER_PART = re.compile(
+    r"^\{(?P<column>[^}]+)\}\s*(?P<case>[is]?)(?P<operator>>=|<=|!=|=|<|>|eq|ne|lt|le|gt|ge|contains|datestartswith)\s*(?P<value>.*)$"
+)
+BLANK_PART = re.compile(r"^\{(?P<column>[^}]+)\}\s*is\s+(blank|nil)$")
+# && and || anywhere, and and or as words
+LOGICAL_OPERATOR = re.compile(r"&&|\|\||(?:and|or)(?=[\s(]|$)", re.IGNORECASE)
+
+
+def quote_identifier(name):
+    """
+    This function quotes a table or column name for use in a SQL statement.
+
+    :param name: table or column name
+    :return: quoted name
+    """
+    return '"{}"'.format(str(name).replace('"', '""'))
+
+
+def parse_filter_query(filter_query, columns):
+    """
+    This function translates the filter_query of a DataTable with filter_action="custom" into a SQL condition.
+    Parts joined with && or and are combined with AND, parts joined with || or or with OR, and parentheses
+    group parts. The values are passed as parameters and not put into the SQL. The operators =, !=, <, <=, >, >=
+    (and eq, ne, lt, le, gt, ge), contains, datestartswith and is blank are supported, optionally prefixed with
+    i for case insensitive matching.
+
+    :param filter_query: filter_query of the DataTable, e.g. '{country} contains "Alb" && {pop} > 5'
+    :param columns: names of the columns that can be filtered
+    :return: tuple of the condition string (empty if there is no filter) and the list of parameters
+    :raises ValueError: if a part cannot be parsed or refers to an unknown column
+    """
+    tokens = _split_filter(filter_query or "")
+    if not tokens:
+        return "", []
+    params = []
+    position = 0
+
+    def parse(operator, parse_operand):
+        nonlocal position
+        operands = [parse_operand()]
+        while position < len(tokens) and tokens[position] == operator:
+            position += 1
+            operands.append(parse_operand())
+        return operands
+
+    def parse_or():
+        operands = parse("OR", parse_and)
+        return operands[0] if len(operands) == 1 else f"({' OR '.join(operands)})"
+
+    def parse_and():
+        return " AND ".join(parse("AND", parse_operand))
+
+    def parse_operand():
+        nonlocal position
+        if position == len(tokens):
+            raise ValueError(f"Incomplete filter: {filter_query}")
+        token = tokens[position]
+        position += 1
+        if token == "(":
+            condition = parse_or()
+            if position == len(tokens) or tokens[position] != ")":
+                raise ValueError(f"Unbalanced parentheses in filter: {filter_query}")
+            position += 1
+            # an OR group is already parenthesized and AND binds tighter than OR
+            return condition
+        if token in ("AND", "OR", ")"):
+            raise ValueError(f"Unsupported filter: {filter_query}")
+        return _parse_filter_part(token, columns, params)
+
+    condition = parse_or()
+    if position != len(tokens):
+        raise ValueError(f"Unsupported filter: {filter_query}")
+    return condition, params
+
+
+def _split_filter(filter_query):
+    # the parts, AND, OR and parentheses of a filter query, quoted values and {column} names are kept whole
+    tokens, part, i, depth, nested = [], "", 0, 0, 0
+
+    def end_part():
+        nonlocal part
+        if part.strip():
+            tokens.append(part.strip())
+        part = ""
+
+    while i < len(filter_query):
+        char = filter_query[i]
+        if char in "\"'`{":
+            close = "}" if char == "{" else char
+            j = i + 1
+            while j < len(filter_query) and filter_query[j] != close:
+                j += 2 if filter_query[j] == "\\" and close != "}" else 1
+            part += filter_query[i : j + 1]
+            i = j + 1
+            continue
+        logical = LOGICAL_OPERATOR.match(filter_query, i)
+        if logical is not None and (
+            logical.group()[0] in "&|" or not part or part[-1].isspace()
+        ):
+            end_part()
+            tokens.append("OR" if logical.group().lower() in ("||", "or") else "AND")
+            i = logical.end()
+        elif char == "(" and not part.strip():
+            tokens.append("(")
+            depth += 1
+            i += 1
+        elif char == ")" and not nested:
+            if not depth:
+                raise ValueError(f"Unbalanced parentheses in filter: {filter_query}")
+            end_part()
+            tokens.append(")")
+            depth -= 1
+            i += 1
+        else:
+            # parentheses inside a value, e.g. {name} = f(x), stay part of it
+            nested += (char == "(") - (char == ")")
+            part += char
+            i += 1
+    if nested:
+        raise ValueError(f"Unbalanced parentheses in filter: {filter_query}")
+    end_part()
+    return tokens
+
+
+def _parse_filter_part(part, columns, params):
+    # one comparison of a filter query, its value is appended to params
+    blank = BLANK_PART.match(part)
+    match = blank or FILTER_PART.match(part)
+    if match is None:
+        raise ValueError(f"Unsupported filter: {part}")
+    column = match.group("column")
+    if column not in columns:
+        raise ValueError(f"Unknown column in filter: {column}")
+    if blank:
+        return f"{quote_identifier(column)} IS NULL"
+    value = match.group("value").strip()
+    if len(value) > 1 and value[0] == value[-1] and value[0] in "\"'`":
+        value = value[1:-1]
+    else:
+        try:
+            value = float(value) if "." in value else int(value)
+        except ValueError:
+            pass
+    operator = match.group("operator")
+    target = quote_identifier(column)
+    if operator == "contains":
+        value = f"%{value}%"
+    elif operator == "datestartswith":
+        value = f"{value}%"
+    if operator in ("contains", "datestartswith"):
+        target = f"CAST({target} AS TEXT)"
+    if match.group("case") == "i" and isinstance(value, str):
+        target, value = f"LOWER({target})", value.lower()
+    params.append(value)
+    return f"{target} {FILTER_OPERATORS[operator]} ?"
+
+
+def build_page_query(
+    query, columns, page_current=0, page_size=10, sort_by=None, filter_query=None
+):
+    """
+    This function wraps a query so that it returns a single page of its result, for a DataTable with
+    page_action, sort_action and filter_action set to "custom".
+
+    :param query: query string whose result is paged
+    :param columns: names of the columns of the result, used to validate sort_by and filter_query
+    :param page_current: index of the page, starting at 0
+    :param page_size: number of rows per page
+    :param sort_by: sort_by of the DataTable, list of dicts with keys column_id and direction
+    :param filter_query: filter_query of the DataTable
+    :return: tuple of the query string and the list of parameters
+    """
+    condition, params = parse_filter_query(filter_query, columns)
+    paged = f"SELECT * FROM ({query.strip().rstrip(';')}) AS page_source"
+    if condition:
+        paged += f" WHERE {condition}"
+    order = []
+    for sort in sort_by or []:
+        if sort["column_id"] not in columns:
+            raise ValueError(f"Unknown column in sort: {sort['column_id']}")
+        direction = "DESC" if sort["direction"] == "desc" else "ASC"
+        order.append(f"{quote_identifier(sort['column_id'])} {direction}")
+    if order:
+        paged += " ORDER BY " + ", ".join(order)
+    paged += " LIMIT ? OFFSET ?"
+    return paged, params + [int(page_size), int(page_current) * int(page_size)]
+
+
+def build_count_query(query, columns, filter_query=None):
+    """
+    This function wraps a query so that it returns the number of rows of its result after filtering.
+
+    :param query: query string
+    :param columns: names of the columns of the result, used to validate filter_query
+    :param filter_query: filter_query of the DataTable
+    :return: tuple of the query string and the list of parameters
+    """
+    condition, params = parse_filter_query(filter_query, columns)
+    counted = f"SELECT COUNT(*) AS row_count FROM ({query.strip().rstrip(';')}) AS count_source"
+    if condition:
+        counted += f" WHERE {condition}"
+    return counted, params
+
+
+def get_content_hash(contents, filenames):
+    """
+    This function returns a sha256 hex digest identifying a set of uploaded files.
+    Uploading the same files with the same names again gives the same hash.
+
+    :param contents: list of base64 encoded file contents as sent by dcc.Upload
+    :param filenames: list of file names
+    :return: hex digest string
+    """
+    return get_dataset_hash(
+        [
+            (filename, get_file_hash(content))
+            for content, filename in zip(contents, filenames)
+        ]
+    )
+
+
+def get_file_hash(content):
+    """
+    This function returns the sha256 hex digest of the contents of one uploaded file.
+    Files with the same contents have the same hash, whatever their name.
+
+    :param content: base64 encoded file contents as sent by dcc.Upload
+    :return: hex digest string
+    """
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def get_dataset_hash(files):
+    """
+    This function returns a sha256 hex digest identifying a dataset made of files, see get_content_hash.
+
+    :param files: list of (file name, file hash) tuples, see get_file_hash
+    :return: hex digest string
+    """
+    digest = hashlib.sha256()
+    for filename, file_hash in files:
+        digest.update(filename.encode("utf-8") + b"\0")
+        digest.update(bytes.fromhex(file_hash))
+    return digest.hexdigest()
+
+
+def describe_tables(tables):
+    """
+    This function returns the metadata of a set of tables, small enough to be kept in the browser.
+    The table names are dictionary keys and the column names and number of rows are the values.
+
+    :param tables: dictionary with table names as keys and pandas dataframes or pyarrow tables as values
+    :return: dictionary with table names as keys and dicts with keys columns and rows as values
+    """
+    return {
+        name: {
+            # pyarrow tables have column_names, their columns are the arrays
+            "columns": [str(c) for c in getattr(df, "column_names", df.columns)],
+            "rows": len(df),
+        }
+        for name, df in tables.items()
+    }
+
+
+def encode_dataframe(df, payload_format=None):
+    """
+    This function encodes a dataframe for a dcc.Store, decode_dataframe turns it back into a dataframe.
+    arrow is a base64 string of a zstd compressed Arrow IPC stream, it keeps the dtypes and is the smallest.
+    columns holds the values of every column in a list with the dtypes, so that column names are not
+    repeated on every row. records is the list of row dicts of DataFrame.to_dict("records").
+    Dataframes that Arrow cannot encode, e.g. with duplicate column names, fall back to columns.
+
+    :param df: pandas dataframe
+    :param payload_format: arrow, columns or records, defaults to DASHBOARDAI_PAYLOAD_FORMAT, itself defaulting
+    to arrow when pyarrow is installed and columns otherwise
+    :return: dict with the keys format and data, a list of dicts for records
+    """
+    if payload_format is None:
+        payload_format = get_setting(
+            "payload_format",
+            "columns" if importlib.util.find_spec("pyarrow") is None else "arrow",
+        )
+    if payload_format not in PAYLOAD_FORMATS:
+        raise ValueError(
+            f"Unknown payload format {payload_format!r}, expected one of {PAYLOAD_FORMATS}"
+        )
+    if payload_format == "records":
+        return df.to_dict("records")
+    if payload_format == "arrow":
+        pa = _import_pyarrow()
+    if payload_format == "arrow" and pa is not None:
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, ValueError):
+            pass
+        else:
+            sink = pa.BufferOutputStream()
+            options = pa.ipc.IpcWriteOptions(compression="zstd")
+            with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+                writer.write_table(table)
+            data = base64.b64encode(sink.getvalue().to_pybytes()).decode("ascii")
+            return {"format": "arrow", "data": data}
+    return {
+        "format": "columns",
+        "columns": [str(c) for c in df.columns],
+        "dtypes": [str(dtype) for dtype in df.dtypes],
+        "data": [df.iloc[:, i].tolist() for i in range(df.shape[1])],
+    }
+
+
+def _import_pyarrow():
+    # pyarrow is optional and imported on first use, without it the Store payloads are encoded as columns
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc
+    except ImportError:
+        return None
+    return pa
+
+
+def decode_dataframe(payload):
+    """
+    This function decodes a dcc.Store payload of encode_dataframe into a dataframe.
+    The payload comes from the browser, Arrow data is validated before it is used.
+
+    :param payload: dict of encode_dataframe or list of row dicts
+    :return: pandas dataframe
+    :raises ValueError: if the payload is not valid
+    """
+    if isinstance(payload, list):
+        return pd.DataFrame(payload)
+    if payload.get("format") == "arrow":
+        pa = _import_pyarrow()
+        if pa is None:
+            raise ValueError("Arrow payloads require the pyarrow package")
+        try:
+            table = pa.ipc.open_stream(base64.b64decode(payload["data"])).read_all()
+            table.validate(full=True)
+        except (pa.ArrowException, TypeError, ValueError) as e:
+            raise ValueError(f"Invalid arrow payload: {e}") from e
+        return table.to_pandas()
+    if payload.get("format") == "columns":
+        df = pd.DataFrame(dict(enumerate(payload["data"])))
+        for i, dtype in enumerate(payload["dtypes"]):
+            if dtype != "object":
+                try:
+                    df[i] = df[i].astype(dtype)
+                except (TypeError, ValueError):
+                    pass
+        df.columns = payload["columns"]
+        return df
+    raise ValueError(f"Unknown payload format {payload.get('format')!r}")
+
+
+def decode_contents(contents, chunk_size=4 * 1024 * 1024):
+    """
+    This function decodes the base64 payload of a dcc.Upload contents string into a bytes buffer.
+    The payload is decoded in chunks straight into the buffer, so besides the contents string only one
+    copy of the file is held in memory.
+
+    :param contents: contents string as sent by dcc.Upload, "data:<type>;base64,<payload>"
+    :param chunk_size: number of base64 characters decoded at a time, a multiple of 4
+    :return: io.BytesIO positioned at the start of the file
+    """
+    start = contents.index(",") + 1
+    buffer = io.BytesIO()
+    for offset in range(start, len(contents), chunk_size):
+        buffer.write(base64.b64decode(contents[offset : offset + chunk_size]))
+    buffer.seek(0)
+    return buffer
+
+
+def get_csv_engine():
+    """
+    Returns the pandas csv engine configured with DASHBOARDAI_CSV_ENGINE.
+    auto picks the multithreaded pyarrow engine when pyarrow is installed and the c engine otherwise.
+
+    :return: pyarrow or c
+    """
+    engine = get_setting("csv_engine", "auto")
+    if engine != "auto":
+        return engine
+    return "c" if importlib.util.find_spec("pyarrow") is None else "pyarrow"
+
+
+# the start of an ISO date or datetime, e.g. 2020-01-31 or 2020-01-31T10:00
+ISO_DATE = re.compile(r"\d{4}-\d{2}-\d{2}(?:[T ]|$)")
+
+
+def compact_dtypes(df, category_ratio=None):
+    """
+    This function shrinks the memory of a parsed table. Integers are downcast to the smallest type holding
+    their values, floats to float32 when no value changes, text columns of ISO dates are parsed as datetimes
+    and text columns with few distinct values become categoricals. The SQL backends keep the types, except that
+    the integer columns of DuckDB are widened again (see load_duckdb_tables) and sqlite stores the datetimes as
+    ISO text like the uploaded files had them (see to_sqlite_dates).
+
+    :param df: pandas dataframe, not modified
+    :param category_ratio: text columns with at most this ratio of distinct values to rows become categoricals,
+    defaults to DASHBOARDAI_CATEGORY_MAX_RATIO
+    :return: pandas dataframe, df itself if no column changed
+    """
+    if category_ratio is None:
+        category_ratio = get_setting("category_max_ratio", 0.5)
+    compacted = None
+    for i, (_, column) in enumerate(df.items()):
+        kind = column.dtype.kind
+        if kind in "iu":
+            converted = pd.to_numeric(column, downcast="integer")
+        elif kind == "f":
+            converted = column.astype("float32")
+            if not converted.astype(column.dtype).equals(column):
+                continue
+        elif kind == "O" and pd.api.types.infer_dtype(column, skipna=True) == "string":
+            converted = _parse_dates(column)
+            if converted is None and column.nunique() <= category_ratio * len(column):
+                converted = column.astype("category")
+        else:
+            continue
+        if converted is None or converted.dtype == column.dtype:
+            continue
+        if compacted is None:
+            compacted = df.copy(deep=False)
+        compacted.isetitem(i, converted)
+    return df if compacted is None else compacted
+
+
+def _parse_dates(column):
+    # a sample is tried first, so that text columns fail fast, ISO8601 would also take years like "2020"
+    # and codes like "20200101", so the sample has to be full dates with separators
+    values = column.dropna()
+    if values.empty or not all(ISO_DATE.match(value) for value in values.iloc[:100]):
+        return None
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            pd.to_datetime(values.iloc[:100], format="ISO8601")
+            return pd.to_datetime(column, format="ISO8601")
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+
+def read_table(buffer, filename, sheet_name=0, trace_memory=None, compact=None):
+    """
+    This function parses a decoded csv or excel file into a pandas dataframe and measures the parsing.
+    The stats are a dict with the keys filename, sheet, bytes (decoded size), rows, engine, parse_seconds
+    and peak_bytes. peak_bytes is the peak of the memory allocated while parsing as seen by tracemalloc,
+    it is only measured when trace_memory is enabled (DASHBOARDAI_TRACE_PARSE_MEMORY) because tracing
+    slows allocations down. Memory allocated by pyarrow itself is not seen by tracemalloc.
+
+    The dtypes of the dataframe are compacted with compact_dtypes unless compact is disabled
+    (DASHBOARDAI_COMPACT_DTYPES), the memory of the dataframe before and after is reported in the stats
+    as memory_before_bytes and memory_bytes, with compact_seconds.
+
+    :param buffer: binary file object with the file contents
+    :param filename: name of the uploaded file, its extension selects the parser
+    :param sheet_name: name or position of the sheet to read from an excel file
+    :param trace_memory: measure the peak memory, defaults to the DASHBOARDAI_TRACE_PARSE_MEMORY setting
+    :param compact: compact the dtypes, defaults to the DASHBOARDAI_COMPACT_DTYPES setting
+    :return: tuple of the dataframe and the stats dict
+    :raises ValueError: if the file type is not supported
+    """
+    if trace_memory is None:
+        trace_memory = get_setting("trace_parse_memory", False)
+    if compact is None:
+        compact = get_setting("compact_dtypes", True)
+    start_tracing = trace_memory and not tracemalloc.is_tracing()
+    if start_tracing:
+        tracemalloc.start()
+    elif trace_memory:
+        tracemalloc.reset_peak()
+    stats = {
+        "filename": filename,
+        "sheet": None,
+        "bytes": buffer.getbuffer().nbytes,
+        "rows": None,
+        "engine": None,
+        "peak_bytes": None,
+    }
+
+    started = time.perf_counter()
     try:
         if "csv" in filename:
             # Assume that the user uploaded a CSV file
-            df = pd.read_csv(io.StringIO(decoded.decode("utf-8")))
-            print(f"Successfully parsed CSV with columns: {df.columns}")  # Debug print
-            return df
+            stats["engine"] = get_csv_engine()
+            df = pd.read_csv(buffer, engine=stats["engine"])
         elif "xls" in filename:
             # Assume that the user uploaded an excel file
-            df = pd.read_excel(io.BytesIO(decoded))
-            return df
+            stats["engine"] = "excel"
+            stats["sheet"] = sheet_name
+            df = pd.read_excel(buffer, sheet_name=sheet_name)
         else:
-            print(f"Unsupported file type: {filename}")  # Debug print
-            return None
+            raise ValueError(f"Unsupported file type: {filename}")
+    finally:
+        stats["parse_seconds"] = time.perf_counter() - started
+        if trace_memory:
+            stats["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        if start_tracing:
+            tracemalloc.stop()
+
+    stats["rows"] = len(df)
+    stats["memory_before_bytes"] = get_dataframe_nbytes(df)
+    started = time.perf_counter()
+    if compact:
+        df = compact_dtypes(df)
+    stats["compact_seconds"] = time.perf_counter() - started
+    stats["memory_bytes"] = (
+        get_dataframe_nbytes(df) if compact else stats["memory_before_bytes"]
+    )
+    return df, stats
+
+
+def parse_contents_with_stats(contents, filename, trace_memory=None):
+    """
+    This function parses an uploaded csv file or the first sheet of an excel file into a pandas dataframe.
+    The stats of read_table are extended with decode_seconds.
+
+    :param contents: contents string as sent by dcc.Upload
+    :param filename: name of the uploaded file
+    :param trace_memory: measure the peak memory, defaults to the DASHBOARDAI_TRACE_PARSE_MEMORY setting
+    :return: tuple of the dataframe and the stats dict
+    :raises ValueError: if the file type is not supported
+    """
+    started = time.perf_counter()
+    buffer = decode_contents(contents)
+    decode_seconds = time.perf_counter() - started
+    df, stats = read_table(buffer, filename, trace_memory=trace_memory)
+    stats["decode_seconds"] = decode_seconds
+    return df, stats
+
+
+def parse_contents(contents, filename):
+    """
+    This function parses an uploaded csv file or the first sheet of an excel file into a pandas dataframe.
+
+    :param contents: contents string as sent by dcc.Upload
+    :param filename: name of the uploaded file
+    :return: pandas dataframe
+    :raises ValueError: if the file type is not supported
+    """
+    return parse_contents_with_stats(contents, filename)[0]
+
+
+def get_table_name(filename, sheet_name=None):
+    """
+    This function returns the table name of an uploaded file, the file name without its extension.
+    Sheets of an excel file with several sheets are named <file name>_<sheet name>.
+
+    :param filename: name of the uploaded file
+    :param sheet_name: name of the sheet, None for csv files and single sheet workbooks
+    :return: table name
+    """
+    name = filename.rsplit(".", 1)[0]
+    if sheet_name is not None:
+        name += "_" + re.sub(r"\W+", "_", str(sheet_name)).strip("_")
+    return name
+
+
+def _parse_task(task):
+    # runs in an ingest worker, errors are returned so that one bad sheet does not fail the upload
+    data, filename, sheet_name, trace_memory = task
+    try:
+        df, stats = read_table(io.BytesIO(data), filename, sheet_name, trace_memory)
+        return df, stats, None
     except Exception as e:
-        print(f"Error parsing file: {str(e)}")  # Debug print
-        return html.Div(["There was an error processing this file."])
+        return None, None, f"{type(e).__name__}: {e}"
+
+
+_ingest_pools = {}
+_ingest_pools_lock = threading.Lock()
+
+
+def _get_ingest_pool(max_workers):
+    # worker processes are started once and reused by every upload
+    with _ingest_pools_lock:
+        if max_workers not in _ingest_pools:
+            _ingest_pools[max_workers] = ProcessPoolExecutor(
+                max_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _ingest_pools[max_workers]
+
+
+def parse_uploads(contents, filenames, max_workers=None, trace_memory=None, cache=None):
+    """
+    This function parses a list of uploaded files, every csv file and every sheet of an excel file becomes a table.
+    The files and sheets are parsed in parallel by a pool of max_workers processes. The results are in upload
+    order and a file that cannot be parsed is reported with its error instead of failing the whole upload.
+
+    Every result is a dict with the keys filename, file_hash (see get_file_hash), tables (dictionary with table
+    names as keys and pandas dataframes as values), stats (list with the stats of read_table per table) and
+    errors (list of messages).
+
+    With a cache (see dashboardai.registry.FileCache), a file that was parsed before, by any session and under
+    any name, is not decoded and parsed again: its dataframes are shared and its stats have cached set to True.
+
+    :param contents: list of contents strings as sent by dcc.Upload
+    :param filenames: list of file names
+    :param max_workers: number of worker processes, defaults to DASHBOARDAI_INGEST_WORKERS, 0 or 1 parses in process
+    :param trace_memory: measure the peak memory, defaults to the DASHBOARDAI_TRACE_PARSE_MEMORY setting
+    :param cache: optional FileCache of parsed files keyed by file hash
+    :return: list of result dicts, one per file
+    """
+    if max_workers is None:
+        max_workers = get_setting("ingest_workers", os.cpu_count() or 1)
+    if trace_memory is None:
+        trace_memory = get_setting("trace_parse_memory", False)
+
+    results, tasks, owners = [], [], []
+    for content, filename in zip(contents, filenames):
+        file_hash = get_file_hash(content)
+        result = {
+            "filename": filename,
+            "file_hash": file_hash,
+            "tables": {},
+            "stats": [],
+            "errors": [],
+            "sheets": [],
+        }
+        results.append(result)
+        sheets = cache.get(file_hash) if cache is not None else None
+        if sheets is not None:
+            for sheet, df, stats in sheets:
+                name = get_table_name(filename, sheet if len(sheets) > 1 else None)
+                result["tables"][name] = df
+                stats = dict(stats, filename=filename, table=name, cached=True)
+                result["stats"].append(stats)
+            del result["sheets"]
+            continue
+        try:
+            started = time.perf_counter()
+            data = decode_contents(content).getvalue()
+            decode_seconds = time.perf_counter() - started
+            metrics.observe("decode", decode_seconds, bytes=len(data))
+            sheets = [0]
+            if "xls" in filename and "csv" not in filename:
+                sheets = pd.ExcelFile(io.BytesIO(data)).sheet_names
+        except Exception as e:
+            result["errors"].append(f"{type(e).__name__}: {e}")
+            continue
+        for sheet in sheets:
+            name = get_table_name(filename, sheet if len(sheets) > 1 else None)
+            tasks.append((data, filename, sheet, trace_memory))
+            owners.append((result, name, sheet, decode_seconds))
+
+    if max_workers > 1 and len(tasks) > 1:
+        parsed = _get_ingest_pool(max_workers).map(_parse_task, tasks)
+    else:
+        parsed = map(_parse_task, tasks)
+
+    for (result, name, sheet, decode_seconds), (df, stats, error) in zip(
+        owners, parsed
+    ):
+        if error is not None:
+            label = (
+                result["filename"] if sheet == 0 else f"{result['filename']}[{sheet}]"
+            )
+            result["errors"].append(f"{label}: {error}")
+            continue
+        stats["table"] = name
+        stats["decode_seconds"] = decode_seconds
+        stats["cached"] = False
+        metrics.observe(
+            "parse", stats["parse_seconds"], bytes=stats["bytes"], rows=stats["rows"]
+        )
+        metrics.observe(
+            "compact", stats["compact_seconds"], bytes=stats["memory_bytes"]
+        )
+        result["tables"][name] = df
+        result["stats"].append(stats)
+        result["sheets"].append((sheet, df, stats))
+
+    for result in results:
+        sheets = result.pop("sheets", None)
+        # only completely parsed files are reused
+        if cache is not None and sheets and not result["errors"]:
+            cache.put(result["file_hash"], sheets)
+    return results
 
 
 def create_duckdb(dataframes):
     """
-    This function takes a list of pandas dataframes and turns them into an in-memory DuckDB database.
-    It uses the pandas.to_sql() method to create a table for each dataframe in the list. The table name
-    is the same as the dataframe name. The index of the dataframe is not saved in the database.
-     :param dataframes: list of pandas dataframes
-    :return: DuckDB database
+    This function takes a list dicts with keys name (the table name) and data (pandas dataframes or pyarrow tables)
+    and turns them into an in-memory DuckDB database.
+    The dataframes are registered as views, DuckDB scans them in place without copying the data.
+
+    :param dataframes: list of dicts with keys name and data
+    :return: DuckDB connection
     """
-    # create an in memory DuckDB database
-    con = duckdb.connect(":memory:")
-    # loop through the dataframes and save them to the database
-    for dataframe in dataframes:
-        dataframe.to_sql(dataframe.name, con, index=False)
+    # duckdb is an optional backend, imported when the first database is created
+    try:
+        import duckdb
+    except ImportError as e:
+        raise ImportError("The duckdb backend requires the duckdb package") from e
+    # create an in memory DuckDB database, the queries cannot read or write files or change the settings
+    con = duckdb.connect(
+        ":memory:",
+        config={"enable_external_access": False, "lock_configuration": True},
+    )
+    load_duckdb_tables(con, dataframes)
     return con
 
 
+def load_duckdb_tables(con, dataframes, drop=()):
+    """
+    This function registers more dataframes with a DuckDB database, a view with the same name is replaced.
+
+    :param con: DuckDB connection
+    :param dataframes: list of dicts with keys name and data (pandas dataframes or pyarrow tables)
+    :param drop: names of views to remove
+    """
+    for name in drop:
+        con.execute(f"DROP VIEW IF EXISTS {quote_identifier(name)}")
+    # loop through the dataframes and register them with the database
+    for df in dataframes:
+        data = df["data"]
+        relation = (
+            con.from_df(data)
+            if isinstance(data, pd.DataFrame)
+            else con.from_arrow(data)
+        )
+        # integers downcast by compact_dtypes are widened again, DuckDB raises on overflows of narrow types
+        columns = [
+            (
+                f"CAST({quote_identifier(column)} AS BIGINT) AS {quote_identifier(column)}"
+                if dtype in ("TINYINT", "SMALLINT", "INTEGER")
+                else quote_identifier(column)
+            )
+            for column, dtype in zip(relation.columns, map(str, relation.dtypes))
+        ]
+        relation.project(", ".join(columns)).create_view(df["name"], replace=True)
+
+
+def get_duckdb_nbytes(con):
+    """
+    This function returns the memory allocated by a DuckDB database. The views scan the dataframes in place,
+    so the dataframes themselves are not part of it.
+
+    :param con: DuckDB connection
+    :return: number of bytes
+    """
+    return int(
+        con.execute(
+            "SELECT COALESCE(SUM(memory_usage_bytes), 0) FROM duckdb_memory()"
+        ).fetchone()[0]
+    )
+
+
 def get_duckdb_table_info(con):
     """
     This function returns the tables, their column names and datatypes of the DuckDB in-memory database.
     The table names are dictionary keys and the column names and datatypes are the values as tuples.
-     :param con: DuckDB database
+
+    :param con: DuckDB connection
     :return: dictionary with table names as keys and column names and datatypes as values
     """
-    # get the table names from the database
-    table_names = con.execute(
-        "SELECT name FROM sqlite_master WHERE type='table';"
-    ).fetchall()
-    # create an empty dictionary to store the table info
     table_info = {}
-    # loop through the table names
-    for table in table_names:
-        # get the column names and datatypes of the table
-        table_info[table[0]] = [
-            {"name": column[0], "dtype": column[1]}
-            for column in con.execute(f"PRAGMA table_info('{table[0]}')").fetchall()
-        ]
+    # categoricals are ENUM columns listing every value, they are described as text
+    columns = con.execute(
+        "SELECT table_name, column_name, "
+        "CASE WHEN data_type LIKE 'ENUM(%' THEN 'VARCHAR' ELSE data_type END "
+        "FROM information_schema.columns ORDER BY table_name, ordinal_position"
+    ).fetchall()
+    for table, column, dtype in columns:
+        table_info.setdefault(table, []).append({"name": column, "dtype": dtype})
     return table_info
+
+
+def query_duckdb(
+    con,
+    query,
+    params=None,
+    timeout=None,
+    max_rows=None,
+    max_bytes=None,
+    cancelled=None,
+):
+    """
+    This function takes a DuckDB connection and a query string and returns the result of the query as a pandas dataframe.
+    With a timeout or cancelled event a watcher thread interrupts the query, which raises QueryAborted.
+    With max_rows or max_bytes the result is streamed in chunks and cut off, see fetch_limited.
+
+    :param con: DuckDB connection
+    :param query: query string
+    :param params: optional list of parameters for the ? placeholders of the query
+    :param timeout: maximum run time in seconds, None for no limit
+    :param max_rows: maximum number of rows of the result, None for no limit
+    :param max_bytes: maximum memory of the result in bytes, None for no limit
+    :param cancelled: optional threading.Event, the query is interrupted once it is set
+    :return: pandas dataframe
+    """
+    if timeout is None and max_rows is None and max_bytes is None and cancelled is None:
+        return con.execute(query, params).df()
+
+    import duckdb
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    done = threading.Event()
+
+    def watch():
+        while not done.wait(0.05):
+            expired = deadline is not None and time.monotonic() > deadline
+            if expired or (cancelled is not None and cancelled.is_set()):
+                con.interrupt()
+                return
+
+    watcher = threading.Thread(target=watch, daemon=True)
+    watcher.start()
+    try:
+        con.execute(query, params)
+        columns = [d[0] for d in con.description or []]
+        return fetch_limited(
+            lambda: con.fetch_df_chunk(5), columns, max_rows, max_bytes
+        )
+    except duckdb.InterruptException as e:
+        raise QueryAborted(_abort_reason(cancelled, timeout)) from e
+    finally:
+        done.set()
+        watcher.join()
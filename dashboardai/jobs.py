@@ -0,0 +1,143 @@
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+from dashboardai.config import get_setting
+from dashboardai.metrics import metrics
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when it was superseded by a newer job of the same session."""
+
+
+def check_cancelled(cancelled):
+    """Raises JobCancelled if the event is set, jobs call this between their stages.
+
+    Args:
+        cancelled (threading.Event): Cancellation flag passed to the job, may be None
+    """
+    if cancelled is not None and cancelled.is_set():
+        raise JobCancelled()
+
+
+class JobManager:
+    """Runs the LLM and SQL pipelines as background jobs so that no request thread waits on them.
+
+    At most max_workers jobs run at the same time, further jobs wait in the queue. Every session
+    has at most one job per kind (table or graph): submitting a new one cancels the previous one.
+    Queued jobs are dropped, running jobs see the cancelled flag they receive as first argument.
+    Finished jobs are kept until their status was read or for ttl_seconds.
+    """
+
+    def __init__(self, max_workers=None, ttl_seconds=600.0):
+        if max_workers is None:
+            max_workers = get_setting("job_workers", 8)
+        self.max_workers = max_workers
+        self.ttl_seconds = ttl_seconds
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="job")
+        self._jobs = {}
+        self._active = {}
+        self._lock = threading.Lock()
+
+    def submit(self, session_id, kind, fn, *args):
+        """Starts fn(cancelled, *args) in the background and cancels the previous job of the session.
+
+        Args:
+            session_id (string): Id of the session the job belongs to
+            kind (string): Kind of job, one running job is kept per session and kind
+            fn (callable): Function to run, receives a threading.Event as first argument
+
+        Returns:
+            string: Id of the job
+        """
+        job_id = uuid.uuid4().hex
+        cancelled = threading.Event()
+        with self._lock:
+            self._expire()
+            previous = self._active.get((session_id, kind))
+            if previous is not None:
+                self._cancel(previous)
+            self._jobs[job_id] = {
+                "cancelled": cancelled,
+                "submitted": time.monotonic(),
+                "future": None,
+            }
+            self._active[(session_id, kind)] = job_id
+            self._jobs[job_id]["future"] = self._executor.submit(
+                _timed, kind, fn, cancelled, *args
+            )
+        return job_id
+
+    def status(self, job_id):
+        """Returns the status of a job and removes the job once it is finished.
+
+        The status is a dict with the key status (pending, running, done, failed, cancelled or
+        unknown) and, for finished jobs, result or error.
+
+        Args:
+            job_id (string): Id of the job
+
+        Returns:
+            dict: Status of the job
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return {"status": "unknown"}
+            future = job["future"]
+            if not future.done():
+                return {"status": "running" if future.running() else "pending"}
+            del self._jobs[job_id]
+            for key, active in list(self._active.items()):
+                if active == job_id:
+                    del self._active[key]
+        try:
+            return {"status": "done", "result": future.result()}
+        except (CancelledError, JobCancelled):
+            return {"status": "cancelled"}
+        except Exception as e:
+            return {"status": "failed", "error": e}
+
+    def cancel(self, job_id):
+        """Cancels a job, unknown ids are ignored."""
+        with self._lock:
+            if job_id in self._jobs:
+                self._cancel(job_id)
+
+    def stats(self):
+        """Returns the number of jobs by status and the worker limit."""
+        with self._lock:
+            futures = [job["future"] for job in self._jobs.values()]
+        running = sum(future.running() for future in futures)
+        pending = sum(not future.done() for future in futures) - running
+        return {"running": running, "pending": pending, "max_workers": self.max_workers}
+
+    def shutdown(self):
+        """Cancels the queued jobs and waits for the running ones."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _cancel(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return
+        job["cancelled"].set()
+        if job["future"] is not None:
+            job["future"].cancel()
+
+    def _expire(self):
+        now = time.monotonic()
+        expired = set()
+        for job_id, job in list(self._jobs.items()):
+            if job["future"].done() and now - job["submitted"] > self.ttl_seconds:
+                del self._jobs[job_id]
+                expired.add(job_id)
+        for key, active in list(self._active.items()):
+            if active in expired:
+                del self._active[key]
+
+
+def _timed(kind, fn, *args):
+    # the job is the outermost span of its stages, see Metrics.span
+    with metrics.span(f"{kind}_job"):
+        return fn(*args)
@@ -0,0 +1,193 @@
+import bisect
+import contextlib
+import logging
+import threading
+import time
+
+from dashboardai.config import get_setting
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets, the last bucket is +Inf
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9)
+
+
+class Histogram:
+    """Cumulative histogram in the Prometheus model: bucket counts, sum and count of the observations."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {format_value(self.sum)}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class Metrics:
+    """
+    Timing spans of the pipeline stages, aggregated per stage into a duration histogram, a payload size
+    histogram and a row counter, and rendered in the Prometheus text format.
+
+    Spans opened while another span is open in the same thread belong to the same request. When the
+    outermost span takes longer than slow_seconds, the request is logged with the durations of its
+    stages. Collectors add the stats of the caches and the job manager as gauges.
+    """
+
+    def __init__(self, slow_seconds=None):
+        self.slow_seconds = (
+            get_setting("slow_request_seconds", 0.0)
+            if slow_seconds is None
+            else slow_seconds
+        )
+        self._seconds = {}
+        self._bytes = {}
+        self._rows = {}
+        self._collectors = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def observe(self, stage, seconds, bytes=None, rows=None):
+        """
+        Records a stage that was timed elsewhere, e.g. in a worker process.
+
+        :param stage: name of the stage
+        :param seconds: duration of the stage
+        :param bytes: optional size of the payload of the stage
+        :param rows: optional number of rows processed by the stage
+        """
+        with self._lock:
+            self._seconds.setdefault(stage, Histogram(SECONDS_BUCKETS)).observe(seconds)
+            if bytes is not None:
+                self._bytes.setdefault(stage, Histogram(BYTES_BUCKETS)).observe(bytes)
+            if rows is not None:
+                self._rows[stage] = self._rows.get(stage, 0) + rows
+        trace = getattr(self._local, "trace", None)
+        if trace is not None:
+            trace.append((stage, seconds, bytes, rows))
+
+    def observe_bytes(self, stage, bytes):
+        """
+        Records the size of a payload without a duration, e.g. of a prompt before it is pruned.
+
+        :param stage: name of the payload
+        :param bytes: size of the payload
+        """
+        with self._lock:
+            self._bytes.setdefault(stage, Histogram(BYTES_BUCKETS)).observe(bytes)
+
+    @contextlib.contextmanager
+    def span(self, stage, **attributes):
+        """
+        Times the block as a stage. The block can set the keys bytes and rows of the yielded dict to
+        record the payload size and the row count of the stage, its key seconds is set after the block.
+
+        :param stage: name of the stage
+        :param attributes: initial bytes and rows
+        :return: context manager yielding the dict of attributes
+        """
+        outermost = getattr(self._local, "trace", None) is None
+        if outermost:
+            self._local.trace = []
+        start = time.perf_counter()
+        try:
+            yield attributes
+        finally:
+            seconds = attributes["seconds"] = time.perf_counter() - start
+            self.observe(
+                stage, seconds, attributes.get("bytes"), attributes.get("rows")
+            )
+            if outermost:
+                trace = self._local.trace
+                self._local.trace = None
+                if self.slow_seconds and seconds >= self.slow_seconds:
+                    logger.warning("slow request %s", format_trace(trace))
+
+    def trace(self):
+        """
+        Returns the stages recorded so far by the request of this thread, inside an open span.
+
+        :return: list of (stage, seconds, bytes, rows) tuples, empty outside of a span
+        """
+        return list(getattr(self._local, "trace", None) or ())
+
+    def add_collector(self, name, collect):
+        """
+        Exposes the numeric values of a stats dict as gauges named dashboardai_<name>_<key>.
+
+        :param name: prefix of the gauges, e.g. result_cache
+        :param collect: function without arguments returning a dict, e.g. ResultCache.stats
+        """
+        with self._lock:
+            self._collectors[name] = collect
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            seconds = dict(self._seconds)
+            payloads = dict(self._bytes)
+            rows = dict(self._rows)
+            collectors = dict(self._collectors)
+            lines = [
+                "# HELP dashboardai_stage_seconds Duration of the pipeline stages",
+                "# TYPE dashboardai_stage_seconds histogram",
+            ]
+            for stage, histogram in sorted(seconds.items()):
+                lines += histogram.render(
+                    "dashboardai_stage_seconds", f'stage="{stage}"'
+                )
+            lines += [
+                "# HELP dashboardai_stage_bytes Payload size of the pipeline stages",
+                "# TYPE dashboardai_stage_bytes histogram",
+            ]
+            for stage, histogram in sorted(payloads.items()):
+                lines += histogram.render("dashboardai_stage_bytes", f'stage="{stage}"')
+            lines += [
+                "# HELP dashboardai_stage_rows_total Rows processed by the pipeline stages",
+                "# TYPE dashboardai_stage_rows_total counter",
+            ]
+            for stage, count in sorted(rows.items()):
+                lines.append(f'dashboardai_stage_rows_total{{stage="{stage}"}} {count}')
+        for name, collect in sorted(collectors.items()):
+            for key, value in collect().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauge = f"dashboardai_{name}_{key}"
+                    lines += [f"# TYPE {gauge} gauge", f"{gauge} {format_value(value)}"]
+        return "\n".join(lines) + "\n"
+
+
+def format_value(value):
+    """Formats a sample value with full precision, integers without a fraction."""
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+def format_trace(trace):
+    """Formats the stages of a request as one log line, the outermost span comes last."""
+    parts = []
+    for stage, seconds, nbytes, rows in trace:
+        part = f"{stage}={seconds:.3f}s"
+        if nbytes is not None:
+            part += f" bytes={nbytes}"
+        if rows is not None:
+            part += f" rows={rows}"
+        parts.append(part)
+    return ", ".join(parts)
+
+
+# shared by the pipelines and the /metrics route of the app
+metrics = Metrics()
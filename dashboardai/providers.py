@@ -0,0 +1,95 @@
+import os
+import re
+import time
+
+from dashboardai.config import get_setting
+
+
+class OpenAIProvider:
+    """Completions from the OpenAI API, see send_to_openai."""
+
+    name = "openai"
+
+    def complete(self, model, prompt, stop, max_tokens):
+        """
+        Returns the completion of a prompt.
+
+        :param model: name of the model
+        :param prompt: prompt
+        :param stop: stop sequences
+        :param max_tokens: maximum number of tokens to generate
+        :return: response dict with the completion in ["choices"][0]["text"]
+        """
+        # imported on the first call, the app starts without it
+        import openai
+
+        if openai.api_key is None:
+            openai.api_key = os.getenv("OPENAI_API_KEY")
+        return openai.Completion.create(
+            engine=model,
+            prompt=prompt,
+            temperature=0,
+            max_tokens=max_tokens,
+            top_p=1.0,
+            frequency_penalty=0.0,
+            presence_penalty=0.0,
+            stop=stop,
+        )
+
+
+class FakeProvider:
+    """
+    Local deterministic stand-in for the LLM, for load tests and offline development.
+
+    SQL prompts are answered with the sql template formatted with the first table of the prompt,
+    graph prompts with the code template formatted with the first two columns of the data.
+    Every completion waits latency seconds, like a call to the API would.
+    """
+
+    name = "fake"
+
+    def __init__(self, latency=None, sql=None, code=None):
+        self.latency = (
+            get_setting("llm_fake_latency_seconds", 0.0) if latency is None else latency
+        )
+        self.sql = ' * FROM "{table}" LIMIT 1000' if sql is None else sql
+        self.code = (
+            "fig.add_trace(go.Scatter(x=data[{x!r}], y=data[{y!r}], mode='markers'))\n"
+            if code is None
+            else code
+        )
+
+    def complete(self, model, prompt, stop, max_tokens):
+        if self.latency:
+            time.sleep(self.latency)
+        if prompt.endswith("SELECT"):
+            # SQL prompt, see combine_prompts
+            table = re.search(r"^# (.+?)\(.*\) $", prompt, re.MULTILINE)
+            text = self.sql.format(table=table.group(1) if table else "data")
+        else:
+            line = re.search(r"^# (.*) $", prompt, re.MULTILINE)
+            columns = line.group(1).split(",") if line is not None else []
+            columns = (columns + columns + ["index", "index"])[:2]
+            text = self.code.format(x=columns[0], y=columns[1])
+        return {"choices": [{"text": text, "index": 0}], "model": model}
+
+
+PROVIDERS = {provider.name: provider for provider in (OpenAIProvider, FakeProvider)}
+
+
+def get_provider(name=None):
+    """
+    Returns the completion provider with the given name, by default the one configured with
+    DASHBOARDAI_LLM_PROVIDER.
+
+    :param name: openai or fake
+    :return: provider instance
+    """
+    if name is None:
+        name = get_setting("llm_provider", "openai")
+    try:
+        return PROVIDERS[name.lower()]()
+    except KeyError:
+        raise ValueError(
+            f"Unknown llm provider {name!r}, expected one of {sorted(PROVIDERS)}"
+        ) from None
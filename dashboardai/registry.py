@@ -0,0 +1,559 @@
+import importlib.util
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import pandas as pd
+
+from dashboardai.config import get_setting
+
+# session ids and table keys are used as file names, they come from the browser
+_SAFE_NAME = re.compile(r"[A-Za-z0-9_-]{1,128}")
+
+
+def get_dataframe_nbytes(df):
+    """
+    Returns the memory used by a dataframe in bytes, including the contents of object columns.
+
+    :param df: pandas dataframe
+    :return: number of bytes
+    """
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+class DatasetRegistry:
+    """
+    Server-side store for the uploaded tables of every session, keyed by session id.
+    Only the session id and the table metadata travel to the browser, the dataframes stay here.
+    The registry holds at most max_bytes of data, the least recently used sessions are evicted first.
+    The most recent dataset is always kept, even if it alone exceeds the budget.
+    """
+
+    def __init__(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = get_setting("registry_max_bytes", 2_000_000_000)
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._datasets = OrderedDict()
+        self._lock = threading.RLock()
+
+    def put(self, session_id, tables, keys=None):
+        """
+        Stores the tables of a session, replacing what the session had before.
+
+        :param session_id: id of the session
+        :param tables: dictionary with table names as keys and pandas dataframes as values
+        :param keys: content keys of the tables, only used by DiskStore
+        """
+        nbytes = sum(get_dataframe_nbytes(df) for df in tables.values())
+        with self._lock:
+            self._datasets.pop(session_id, None)
+            self._datasets[session_id] = {"tables": dict(tables), "nbytes": nbytes}
+            self._evict()
+
+    def get(self, session_id):
+        """
+        Returns the tables of a session and marks the session as recently used.
+
+        :param session_id: id of the session
+        :return: dictionary with table names as keys and pandas dataframes as values, None if unknown or evicted
+        """
+        with self._lock:
+            dataset = self._datasets.get(session_id)
+            if dataset is None:
+                return None
+            self._datasets.move_to_end(session_id)
+            return dataset["tables"]
+
+    def discard(self, session_id):
+        """Removes a session from the registry, unknown ids are ignored."""
+        with self._lock:
+            self._datasets.pop(session_id, None)
+
+    @property
+    def nbytes(self):
+        """Total number of bytes held by the registry."""
+        with self._lock:
+            return sum(dataset["nbytes"] for dataset in self._datasets.values())
+
+    def stats(self):
+        """Returns the number of sessions, their size and the evictions."""
+        with self._lock:
+            return {
+                "sessions": len(self._datasets),
+                "bytes": sum(dataset["nbytes"] for dataset in self._datasets.values()),
+                "evictions": self.evictions,
+            }
+
+    def __contains__(self, session_id):
+        with self._lock:
+            return session_id in self._datasets
+
+    def __len__(self):
+        with self._lock:
+            return len(self._datasets)
+
+    def _evict(self):
+        total = sum(dataset["nbytes"] for dataset in self._datasets.values())
+        while total > self.max_bytes and len(self._datasets) > 1:
+            _, dataset = self._datasets.popitem(last=False)
+            total -= dataset["nbytes"]
+            self.evictions += 1
+
+
+class DiskStore:
+    """
+    Server-side store for the uploaded tables of every session, in a directory shared by the worker processes
+    of the app and kept across restarts. Every table is written once as an uncompressed Arrow IPC file and
+    memory-mapped when it is read, so the workers share its pages through the page cache instead of each
+    holding a copy. Tables with a content key are written once for every session that uploads the same file.
+
+    The files take at most max_bytes on disk, the least recently used sessions are evicted first and the most
+    recent one is always kept. The tables are returned as read-only pyarrow tables, see to_dataframe.
+    """
+
+    def __init__(self, path=None, max_bytes=None, grace_seconds=60.0):
+        # pyarrow is only required by the disk store
+        if importlib.util.find_spec("pyarrow") is None:
+            raise ImportError("The disk dataset store requires the pyarrow package")
+        if path is None:
+            path = get_setting(
+                "store_path", os.path.join(tempfile.gettempdir(), "dashboardai-store")
+            )
+        if max_bytes is None:
+            max_bytes = get_setting("store_max_bytes", 10_000_000_000)
+        self.path = path
+        self.max_bytes = max_bytes
+        # unreferenced files younger than this may belong to a put of another worker
+        self.grace_seconds = grace_seconds
+        self.evictions = 0
+        self._lock = threading.RLock()
+        os.makedirs(os.path.join(path, "tables"), exist_ok=True)
+        os.makedirs(os.path.join(path, "sessions"), exist_ok=True)
+
+    def put(self, session_id, tables, keys=None):
+        """
+        Stores the tables of a session, replacing what the session had before.
+        A table with a key that is already on disk is not written again.
+
+        :param session_id: id of the session
+        :param tables: dictionary with table names as keys and pandas dataframes or pyarrow tables as values
+        :param keys: optional dictionary with content keys of the tables, e.g. hashes of their files
+        """
+        if not _SAFE_NAME.fullmatch(session_id):
+            raise ValueError(f"Invalid session id {session_id!r}")
+        keys = keys or {}
+        files = {}
+        with self._lock:
+            for name, data in tables.items():
+                key = keys.get(name)
+                if key is None or not _SAFE_NAME.fullmatch(key):
+                    key = uuid.uuid4().hex
+                files[name] = key + ".arrow"
+                path = self._table_path(files[name])
+                try:
+                    # mark the shared file as used, so that it is not collected
+                    os.utime(path)
+                except FileNotFoundError:
+                    _write_atomic(path, lambda f: _write_arrow(f, data))
+            _write_atomic(
+                self._session_path(session_id),
+                lambda f: f.write(json.dumps({"tables": files}).encode("utf-8")),
+            )
+            self._evict()
+
+    def get(self, session_id):
+        """
+        Returns the tables of a session and marks the session as recently used.
+
+        :param session_id: id of the session
+        :return: dictionary with table names as keys and pyarrow tables as values, None if unknown or evicted
+        """
+        files = self._read_session(session_id)
+        if files is None:
+            return None
+        try:
+            os.utime(self._session_path(session_id))
+            return {
+                name: _read_arrow(self._table_path(file))
+                for name, file in files.items()
+            }
+        except FileNotFoundError:
+            # evicted by another worker in the meantime
+            return None
+
+    def discard(self, session_id):
+        """Removes a session from the store, unknown ids are ignored."""
+        if _SAFE_NAME.fullmatch(session_id):
+            with self._lock:
+                _remove(self._session_path(session_id))
+
+    @property
+    def nbytes(self):
+        """Total number of bytes of the table files."""
+        return sum(size for _, size, _ in self._list_files("tables"))
+
+    def stats(self):
+        """Returns the number of sessions, the size of the files and the evictions."""
+        return {
+            "sessions": len(self),
+            "bytes": self.nbytes,
+            "evictions": self.evictions,
+        }
+
+    def __contains__(self, session_id):
+        return self._read_session(session_id) is not None
+
+    def __len__(self):
+        return len(self._list_files("sessions"))
+
+    def _table_path(self, file):
+        return os.path.join(self.path, "tables", file)
+
+    def _session_path(self, session_id):
+        return os.path.join(self.path, "sessions", session_id + ".json")
+
+    def _read_session(self, session_id):
+        if not _SAFE_NAME.fullmatch(session_id):
+            return None
+        try:
+            with open(self._session_path(session_id), encoding="utf-8") as f:
+                return json.load(f)["tables"]
+        except FileNotFoundError:
+            return None
+
+    def _list_files(self, directory):
+        # (name, size, modification time) of the files of a directory, skipping files written right now
+        entries = []
+        with os.scandir(os.path.join(self.path, directory)) as it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((entry.name, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self):
+        sessions = sorted(self._list_files("sessions"), key=lambda entry: entry[2])
+        tables = {
+            name: (size, mtime) for name, size, mtime in self._list_files("tables")
+        }
+        references = {}
+        for name, _, _ in sessions:
+            files = self._read_session(name[: -len(".json")]) or {}
+            references[name] = set(files.values())
+        used = set().union(*references.values())
+        total = sum(tables[file][0] for file in used if file in tables)
+        while total > self.max_bytes and len(sessions) > 1:
+            name, _, _ = sessions.pop(0)
+            _remove(os.path.join(self.path, "sessions", name))
+            self.evictions += 1
+            used = set().union(*(references[name] for name, _, _ in sessions))
+            total = sum(tables[file][0] for file in used if file in tables)
+        # files of evicted sessions, unless another session still uses them
+        now = time.time()
+        for file, (_, mtime) in tables.items():
+            if file not in used and now - mtime > self.grace_seconds:
+                _remove(self._table_path(file))
+
+
+def _write_arrow(f, data):
+    import pyarrow as pa
+    import pyarrow.ipc
+
+    if isinstance(data, pd.DataFrame):
+        try:
+            data = pa.Table.from_pandas(data, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # object columns mixing types, e.g. numbers and text in a sheet
+            objects = data.select_dtypes("object").columns
+            data = pa.Table.from_pandas(
+                data.astype({column: "string" for column in objects}),
+                preserve_index=False,
+            )
+    with pa.ipc.new_file(f, data.schema) as writer:
+        writer.write_table(data)
+
+
+def _read_arrow(path):
+    import pyarrow as pa
+    import pyarrow.ipc
+
+    # the buffers of the table point into the mapped file, nothing is copied
+    with pa.memory_map(path, "r") as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def _write_atomic(path, write):
+    # readers in other processes see the old file or the complete new one
+    directory, name = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(prefix="." + name, dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        _remove(tmp)
+        raise
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+DATASET_STORES = {"memory": DatasetRegistry, "disk": DiskStore}
+
+
+def get_dataset_store(name=None):
+    """
+    Returns the store of the uploaded tables, by default the one configured with DASHBOARDAI_DATASET_STORE.
+
+    :param name: memory (per process) or disk (shared by the worker processes)
+    :return: store instance
+    """
+    if name is None:
+        name = get_setting("dataset_store", "memory")
+    try:
+        return DATASET_STORES[name.lower()]()
+    except KeyError:
+        raise ValueError(
+            f"Unknown dataset store {name!r}, expected one of {sorted(DATASET_STORES)}"
+        ) from None
+
+
+class FileCache:
+    """
+    Parsed uploads keyed by the hash of the file contents, shared by every session.
+    A file uploaded again, by the same or another session, reuses its dataframes instead of being parsed again.
+    The cache holds at most max_bytes of dataframes, the least recently used files are evicted first.
+    The dataframes are shared with the sessions and must not be modified.
+    """
+
+    def __init__(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = get_setting("file_cache_max_bytes", 1_000_000_000)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._files = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, file_hash):
+        """
+        Returns the parsed sheets of a file, None if it is not cached.
+
+        :param file_hash: hash of the file contents, see dashboardai.data.get_file_hash
+        :return: list of (sheet, dataframe, stats) tuples
+        """
+        with self._lock:
+            entry = self._files.get(file_hash)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._files.move_to_end(file_hash)
+            self.hits += 1
+            return entry["sheets"]
+
+    def put(self, file_hash, sheets):
+        """
+        Stores the parsed sheets of a file.
+
+        :param file_hash: hash of the file contents
+        :param sheets: list of (sheet, dataframe, stats) tuples
+        """
+        nbytes = sum(get_dataframe_nbytes(df) for _, df, _ in sheets)
+        with self._lock:
+            previous = self._files.pop(file_hash, None)
+            if previous is not None:
+                self._nbytes -= previous["nbytes"]
+            self._files[file_hash] = {"sheets": list(sheets), "nbytes": nbytes}
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes and self._files:
+                _, evicted = self._files.popitem(last=False)
+                self._nbytes -= evicted["nbytes"]
+                self.evictions += 1
+
+    def stats(self):
+        """Returns the hit and miss counters and the size of the cache."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._files),
+                "bytes": self._nbytes,
+            }
+
+
+class EngineCache:
+    """
+    Keeps one database engine per dataset so that it is built once per upload and reused across queries.
+    An entry is rebuilt when the content hash of the uploaded files changes and dropped after
+    idle_seconds without use. The engines take at most max_bytes, measured with their nbytes() method
+    when they are built or updated, the least recently used engines are dropped first.
+    Hits and misses are counted for monitoring.
+    """
+
+    def __init__(self, idle_seconds=None, clock=time.monotonic, max_bytes=None):
+        if idle_seconds is None:
+            idle_seconds = get_setting("engine_idle_seconds", 1800.0)
+        if max_bytes is None:
+            max_bytes = get_setting("engine_cache_max_bytes", 2_000_000_000)
+        self.idle_seconds = idle_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._clock = clock
+        self._engines = {}
+        self._lock = threading.RLock()
+
+    def get(self, key, content_hash, factory):
+        """
+        Returns the cached engine of a dataset, building it with factory() on a miss.
+
+        :param key: id of the dataset, usually the session id
+        :param content_hash: hash of the uploaded files the engine must be built from
+        :param factory: function without arguments that builds the engine
+        :return: engine
+        """
+        with self._lock:
+            self.evict_idle()
+            entry = self._engines.get(key)
+            if entry is not None and entry["content_hash"] == content_hash:
+                self.hits += 1
+                entry["last_used"] = self._clock()
+                return entry["engine"]
+            self.misses += 1
+        engine = factory()
+        nbytes = _nbytes(engine)
+        with self._lock:
+            stale = self._engines.get(key)
+            if stale is not None and stale["content_hash"] == content_hash:
+                # another thread built the same engine in the meantime, keep that one
+                stale["last_used"] = self._clock()
+                engine, stale = stale["engine"], {"engine": engine}
+                evicted = []
+            else:
+                self._engines[key] = {
+                    "engine": engine,
+                    "content_hash": content_hash,
+                    "last_used": self._clock(),
+                    "nbytes": nbytes,
+                }
+                evicted = self._evict(key)
+        for entry in [stale, *evicted]:
+            if entry is not None:
+                _dispose(entry["engine"])
+        return engine
+
+    def update(self, key, content_hash, update):
+        """
+        Changes the cached engine of a dataset in place, e.g. to add tables, instead of building it again.
+
+        :param key: id of the dataset
+        :param content_hash: hash of the dataset after the change
+        :param update: function called with the engine
+        :return: True if an engine was cached and updated, False if the next get builds a new one
+        """
+        with self._lock:
+            entry = self._engines.get(key)
+            if entry is None:
+                return False
+            update(entry["engine"])
+            entry["content_hash"] = content_hash
+            entry["last_used"] = self._clock()
+        # measured without the lock, the database waits for its running query
+        nbytes = _nbytes(entry["engine"])
+        with self._lock:
+            entry["nbytes"] = nbytes
+            evicted = self._evict(key)
+        for entry in evicted:
+            _dispose(entry["engine"])
+        return True
+
+    def invalidate(self, key):
+        """Drops the engine of a dataset, unknown keys are ignored."""
+        with self._lock:
+            entry = self._engines.pop(key, None)
+        if entry is not None:
+            _dispose(entry["engine"])
+
+    def evict_idle(self):
+        """Drops every engine that has not been used for idle_seconds."""
+        now = self._clock()
+        with self._lock:
+            idle = [
+                key
+                for key, entry in self._engines.items()
+                if now - entry["last_used"] > self.idle_seconds
+            ]
+            entries = [self._engines.pop(key) for key in idle]
+            self.evictions += len(entries)
+        for entry in entries:
+            _dispose(entry["engine"])
+
+    def nbytes(self):
+        """Returns the memory taken by the cached engines in bytes."""
+        with self._lock:
+            return sum(entry["nbytes"] for entry in self._engines.values())
+
+    def stats(self):
+        """Returns the hit and miss counters, the number of cached engines and their memory."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._engines),
+                "bytes": self.nbytes(),
+            }
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._engines
+
+    def __len__(self):
+        with self._lock:
+            return len(self._engines)
+
+    def _evict(self, keep):
+        # called with the lock held, the engines are disposed by the caller outside of it
+        evicted = []
+        total = self.nbytes()
+        while total > self.max_bytes and len(self._engines) > 1:
+            key = min(
+                (key for key in self._engines if key != keep),
+                key=lambda key: self._engines[key]["last_used"],
+            )
+            entry = self._engines.pop(key)
+            total -= entry["nbytes"]
+            evicted.append(entry)
+        self.evictions += len(evicted)
+        return evicted
+
+
+def _nbytes(engine):
+    # databases report their memory, other engines are not counted
+    nbytes = getattr(engine, "nbytes", None)
+    return nbytes() if nbytes is not None else 0
+
+
+def _dispose(engine):
+    # sqlalchemy engines are disposed, plain dbapi connections are closed
+    close = getattr(engine, "dispose", None) or getattr(engine, "close", None)
+    if close is not None:
+        close()
@@ -0,0 +1,191 @@
+import ast
+import builtins
+
+# syntax allowed in generated chart code: expressions, assignments, conditions and for loops over data
+ALLOWED_NODES = (
+    ast.Module,
+    ast.Expr,
+    ast.Assign,
+    ast.AugAssign,
+    ast.If,
+    ast.For,
+    ast.Pass,
+    ast.Call,
+    ast.keyword,
+    ast.Attribute,
+    ast.Subscript,
+    ast.Slice,
+    ast.Name,
+    ast.Load,
+    ast.Store,
+    ast.Constant,
+    ast.List,
+    ast.Tuple,
+    ast.Dict,
+    ast.Set,
+    ast.Starred,
+    ast.ListComp,
+    ast.DictComp,
+    ast.SetComp,
+    ast.GeneratorExp,
+    ast.comprehension,
+    ast.IfExp,
+    ast.BoolOp,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Compare,
+    ast.JoinedStr,
+    ast.FormattedValue,
+    ast.operator,
+    ast.unaryop,
+    ast.boolop,
+    ast.cmpop,
+    ast.expr_context,
+)
+
+# builtins callable from chart code, everything else is hidden from it
+ALLOWED_BUILTINS = (
+    "abs",
+    "bool",
+    "dict",
+    "enumerate",
+    "float",
+    "int",
+    "len",
+    "list",
+    "max",
+    "min",
+    "range",
+    "reversed",
+    "round",
+    "set",
+    "sorted",
+    "str",
+    "sum",
+    "tuple",
+    "zip",
+)
+
+SAFE_BUILTINS = {name: getattr(builtins, name) for name in ALLOWED_BUILTINS}
+
+# fmt: off
+# attributes of the modules in the namespace: the trace and figure constructors of plotly.graph_objs and
+# computations of numpy and pandas, submodules are left out so that no chain reaches os or io
+MODULE_ATTRIBUTES = {
+    "go": {
+        "Figure", "Layout", "Scatter", "Scattergl", "Bar", "Pie", "Histogram", "Histogram2d",
+        "Histogram2dContour", "Box", "Violin", "Heatmap", "Contour", "Scatter3d", "Surface",
+        "Scatterpolar", "Barpolar", "Scattergeo", "Choropleth", "Funnel", "Waterfall", "Indicator",
+        "Table", "Sunburst", "Treemap", "Candlestick", "Ohlc",
+    },
+    "np": {
+        "abs", "arange", "argsort", "array", "ceil", "clip", "cos", "cumsum", "exp", "floor",
+        "histogram", "inf", "isnan", "linspace", "log", "log10", "log2", "max", "mean", "median",
+        "min", "nan", "percentile", "pi", "poly1d", "polyfit", "quantile", "round", "sin", "sort",
+        "sqrt", "std", "sum", "unique", "var", "where",
+    },
+    "pd": {
+        "DataFrame", "Series", "Timestamp", "concat", "cut", "date_range", "isna", "melt", "notna",
+        "qcut", "to_datetime", "to_numeric", "to_timedelta",
+    },
+}
+
+# attributes of the other values: figures, dataframes, series, their accessors, lists, dicts and strings.
+# agg, aggregate, pivot_table and crosstab are left out, they call any method named by a string argument
+OBJECT_ATTRIBUTES = {
+    # figures
+    "add_trace", "add_traces", "update_layout", "update_traces", "update_xaxes", "update_yaxes",
+    "add_annotation", "add_shape", "add_hline", "add_vline", "layout", "title", "xaxis", "yaxis",
+    "text", "update",
+    # dataframes and series
+    "columns", "index", "values", "shape", "dtype", "dtypes", "name", "size", "empty", "T", "loc",
+    "iloc", "at", "iat", "str", "dt", "cat", "head", "tail", "sort_values", "sort_index", "groupby",
+    "sum", "mean", "median", "min", "max", "count", "nunique", "unique", "value_counts", "std",
+    "var", "cumsum", "cumcount", "diff", "pct_change", "rolling", "shift", "round", "abs", "astype",
+    "fillna", "dropna", "drop", "drop_duplicates", "rename", "reset_index", "set_index", "pivot",
+    "melt", "merge", "nlargest", "nsmallest", "idxmax", "idxmin", "isin", "isna", "notna",
+    "between", "unstack", "stack", "quantile", "describe", "corr", "clip", "where", "mask", "copy",
+    "tolist", "to_list", "to_numpy", "to_dict", "to_frame", "to_period", "to_timestamp", "reindex",
+    "explode", "assign", "first", "last", "iterrows", "itertuples", "reshape", "flatten",
+    # date and string accessors
+    "year", "month", "day", "hour", "minute", "date", "dayofweek", "weekday", "quarter", "floor",
+    "normalize", "strftime", "lower", "upper", "capitalize", "strip", "replace", "contains",
+    "startswith", "endswith", "split", "len", "slice", "join",
+    # lists and dicts
+    "append", "extend", "insert", "items", "keys", "get", "pop", "sort",
+}
+# fmt: on
+
+
+class UnsafeCodeError(ValueError):
+    """Raised when generated code uses syntax, names or calls outside the whitelist."""
+
+
+def validate_code(tree, names):
+    """
+    This function checks a parsed chart program against the whitelist: only the nodes in ALLOWED_NODES,
+    direct calls only of safe builtins or names in the namespace, and only the attributes in MODULE_ATTRIBUTES
+    of the modules go, np and pd and the attributes in OBJECT_ATTRIBUTES of other values. Names must be defined
+    by the namespace, the program itself or SAFE_BUILTINS.
+
+    :param tree: ast.Module of the program
+    :param names: names available in the namespace the program runs in, e.g. go, pd, np, data, fig
+    :raises UnsafeCodeError: for the first violation found
+    """
+    known = set(names) | set(SAFE_BUILTINS)
+    # the modules are only used through their attributes, they cannot be renamed or passed on
+    prefixes = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            known.add(node.id)
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+            prefixes.add(id(node.value))
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise UnsafeCodeError(f"{type(node).__name__} is not allowed")
+        if isinstance(node, ast.Name) and node.id not in known:
+            raise UnsafeCodeError(f"name {node.id} is not allowed")
+        if (
+            isinstance(node, ast.Name)
+            and node.id in MODULE_ATTRIBUTES
+            and id(node) not in prefixes
+        ):
+            raise UnsafeCodeError(f"module {node.id} is only allowed with an attribute")
+        if isinstance(node, ast.Attribute):
+            module = node.value.id if isinstance(node.value, ast.Name) else None
+            allowed = MODULE_ATTRIBUTES.get(module, OBJECT_ATTRIBUTES)
+            if node.attr not in allowed:
+                raise UnsafeCodeError(f"attribute {node.attr} is not allowed")
+        if isinstance(node, ast.Call) and not isinstance(
+            node.func, (ast.Name, ast.Attribute)
+        ):
+            raise UnsafeCodeError("only calls of names and methods are allowed")
+
+
+def compile_code(code, names):
+    """
+    This function parses, validates and compiles a chart program, see validate_code.
+    The compiled code object can be run again with exec on new data without parsing it again.
+
+    :param code: source code of the program
+    :param names: names available in the namespace the program runs in
+    :return: code object
+    :raises UnsafeCodeError: when the program is not allowed
+    :raises SyntaxError: when the program is not valid Python
+    """
+    tree = ast.parse(code, "<chart>", "exec")
+    validate_code(tree, names)
+    return compile(tree, "<chart>", "exec")
+
+
+def run_code(code_object, namespace):
+    """
+    This function runs a compiled chart program in the namespace, with only SAFE_BUILTINS available.
+
+    :param code_object: code object returned by compile_code
+    :param namespace: dict with the variables of the program, modified in place
+    :return: namespace
+    """
+    namespace["__builtins__"] = SAFE_BUILTINS
+    exec(code_object, namespace)
+    return namespace
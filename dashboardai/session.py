@@ -0,0 +1,149 @@
+import io
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from dashboardai.backends import get_backend
+from dashboardai.cache import ResultCache
+from dashboardai.callbacks import answer_table_question
+from dashboardai.config import get_setting
+from dashboardai.data import get_table_name, read_table
+from dashboardai.metrics import metrics
+
+
+def read_files(paths):
+    """
+    Reads csv and excel files from disk like uploads: every csv file and every sheet of an excel file becomes
+    a table named after the file, see get_table_name. The dtypes are compacted like on upload, see read_table.
+
+    :param paths: list of file paths
+    :return: dictionary with table names as keys and pandas dataframes as values
+    :raises ValueError: if the file type is not supported
+    """
+    tables = {}
+    for path in paths:
+        filename = os.path.basename(path)
+        with open(path, "rb") as f:
+            buffer = io.BytesIO(f.read())
+        sheets = [0]
+        if "xls" in filename and "csv" not in filename:
+            sheets = pd.ExcelFile(buffer).sheet_names
+        for sheet in sheets:
+            name = get_table_name(filename, sheet if len(sheets) > 1 else None)
+            tables[name], _ = read_table(buffer, filename, sheet)
+            buffer.seek(0)
+    return tables
+
+
+class Session:
+    """
+    Natural language questions on a set of tables without the Dash app, e.g. to precompute answers in a batch
+    job. The tables are given as a dataframe (the table data), a dictionary of dataframes by table name, or
+    csv and excel files (see read_files). They are loaded into the SQL backend once, on the first question,
+    and the database with its schema prompt is reused by every question of the session.
+
+    ask_many answers max_workers questions at a time (DASHBOARDAI_JOB_WORKERS), the LLM calls overlap while
+    the queries on the database run one at a time. Results are cached per session unless a shared
+    dashboardai.cache.ResultCache is given.
+
+        with Session(files=["sales.csv"]) as session:
+            for answer in session.ask_many(["total sales by region", "top 10 customers"]):
+                print(answer["query"], answer["result"])
+    """
+
+    def __init__(
+        self, tables=None, files=(), backend=None, max_workers=None, results=None
+    ):
+        if isinstance(tables, pd.DataFrame):
+            tables = {"data": tables}
+        self.tables = dict(tables or {})
+        self.tables.update(read_files(files))
+        if not self.tables:
+            raise ValueError("A session needs at least one table")
+        self.backend = get_backend(backend)
+        self.max_workers = (
+            get_setting("job_workers", 8) if max_workers is None else max_workers
+        )
+        self.results = ResultCache() if results is None else results
+        # the result cache is keyed on the dataset, the tables of a session do not change
+        self.version = uuid.uuid4().hex
+        self._database = None
+        self._lock = threading.Lock()
+
+    @property
+    def database(self):
+        """The dashboardai.backends.Database with the tables, loaded on first use."""
+        with self._lock:
+            if self._database is None:
+                self._database = self.backend.create(
+                    [{"name": name, "data": df} for name, df in self.tables.items()]
+                )
+            return self._database
+
+    def ask(self, question):
+        """
+        Answers a question with a SQL query on the tables.
+
+        :param question: question in natural language
+        :return: dict with the keys question, query (the generated SQL), result (pandas dataframe), truncated, warnings,
+        seconds (total duration) and timings (seconds per stage, e.g. prompt, llm and sql)
+        :raises QueryAborted: when the query exceeds the limits, see get_query_limits and get_plan_limits
+        """
+        database = self.database
+        started = time.perf_counter()
+        with metrics.span("ask"):
+            before = len(metrics.trace())
+            answer = answer_table_question(
+                None, database, question, self.version, self.results
+            )
+            stages = metrics.trace()[before:]
+        timings = {}
+        for stage, seconds, _, _ in stages:
+            timings[stage] = timings.get(stage, 0.0) + seconds
+        return {
+            "question": question,
+            "query": answer["query"],
+            "result": answer["result"],
+            "truncated": answer["truncated"],
+            "warnings": answer["warnings"],
+            "seconds": time.perf_counter() - started,
+            "timings": timings,
+        }
+
+    def ask_many(self, questions):
+        """
+        Answers questions concurrently, at most max_workers at a time. A question asked several times is
+        answered once. A failed question does not stop the others: its answer has the key error with the
+        message and no result.
+
+        :param questions: list of questions in natural language
+        :return: list of answers in the order of the questions, see ask
+        """
+        unique = list(dict.fromkeys(questions))
+        workers = max(1, min(self.max_workers, len(unique)))
+        with ThreadPoolExecutor(workers, thread_name_prefix="ask") as executor:
+            answers = dict(zip(unique, executor.map(self._try_ask, unique)))
+        return [answers[question] for question in questions]
+
+    def close(self):
+        """Releases the database of the session."""
+        with self._lock:
+            if self._database is not None:
+                self._database.dispose()
+                self._database = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _try_ask(self, question):
+        try:
+            return self.ask(question)
+        except Exception as e:
+            return {"question": question, "error": f"{type(e).__name__}: {e}"}
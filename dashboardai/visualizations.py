@@ -1,19 +1,55 @@
+import math
+import warnings
+
+import numpy as np
 import pandas as pd
 from dash import dash_table
 
+from dashboardai.config import get_setting
+
+# per point attributes of a scatter trace, subset together with x and y when downsampling
+POINT_ATTRIBUTES = ("x", "y", "text", "hovertext", "customdata", "ids")
+MARKER_ATTRIBUTES = ("color", "size", "symbol", "opacity")
+
 
-def generate_table(dataframe, max_rows=10):
+def generate_table(dataframe, max_rows=10, mode="native", row_count=None):
     """
     This function creates an interactive DataTable from a given dataframe, with a maximum of 10 rows.
     It takes the columns in the dataframe and sets them as the columns of the DataTable. It also takes
     the values in the dataframe and converts them into a dictionary format before setting them as the
     data of the DataTable. The maximum number of rows to display can be changed through the max_rows argument.
 
-    :param dataframe: dataframe to convert to DataTable
+    In the "custom" mode only the first page of the dataframe is sent to the browser. Paging, sorting and
+    filtering are left to a server-side callback that queries the rows of the requested page, see
+    dashboardai.data.build_page_query.
+
+    :param dataframe: dataframe to convert to DataTable, in custom mode at least its first page
     :param max_rows: maximum number of rows to display
+    :param mode: native to page, sort and filter in the browser, custom to do it on the server
+    :param row_count: total number of rows in custom mode, used for the page count
     :return: DataTable object
     """
+    if mode == "custom":
+        page_count = None
+        if row_count is not None:
+            page_count = max(1, math.ceil(row_count / max_rows))
+        return dash_table.DataTable(
+            id="data-table",
+            columns=[{"name": i, "id": i} for i in dataframe.columns],
+            data=dataframe.head(max_rows).to_dict("records"),
+            page_size=max_rows,
+            page_current=0,
+            page_count=page_count,
+            page_action="custom",
+            style_table={"overflowX": "scroll"},
+            filter_action="custom",
+            filter_query="",
+            sort_action="custom",
+            sort_mode="multi",
+            sort_by=[],
+        )
     return dash_table.DataTable(
+        id="data-table",
         columns=[{"name": i, "id": i} for i in dataframe.columns],
         data=dataframe.to_dict("records"),
         page_size=max_rows,
@@ -21,3 +57,175 @@ def generate_table(dataframe, max_rows=10):
         filter_action="native",
         sort_action="native",
     )
+
+
+def lttb(x, y, n_out):
+    """
+    This function downsamples a line with the Largest-Triangle-Three-Buckets algorithm. The points are
+    split into n_out - 2 buckets and from every bucket the point forming the largest triangle with the
+    previously selected point and the average of the next bucket is kept, which preserves peaks and dips.
+    The first and the last point are always kept.
+
+    :param x: numeric x values, sorted
+    :param y: numeric y values
+    :param n_out: number of points to keep
+    :return: numpy array with the sorted indices of the kept points
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    indices = np.empty(n_out, dtype=int)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        # points with missing values never win over a valid point
+        area = np.where(np.isnan(area), -1.0, area)
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
+def bin_points(x, y, n_out):
+    """
+    This function downsamples a scatter plot by binning the points into a grid of at most n_out cells
+    and keeping the first point of every occupied cell. Outliers and the extent of the data are preserved,
+    dense areas are thinned out.
+
+    :param x: numeric x values
+    :param y: numeric y values
+    :param n_out: maximum number of points to keep
+    :return: numpy array with the sorted indices of the kept points
+    """
+    n = len(y)
+    if n_out >= n:
+        return np.arange(n)
+    size = max(1, int(math.sqrt(n_out)))
+    cells = _grid_cells(x, size) * (size + 1) + _grid_cells(y, size)
+    return np.sort(np.unique(cells, return_index=True)[1])
+
+
+def _grid_cells(values, size):
+    values = np.asarray(values, dtype=float)
+    low, high = np.nanmin(values), np.nanmax(values)
+    scaled = (values - low) / ((high - low) or 1.0) * (size - 1)
+    # missing values share one extra cell
+    return np.where(np.isnan(scaled), size, np.round(scaled)).astype(int)
+
+
+def _as_numeric(values, n):
+    """Returns the values of an axis as floats: numbers, timestamps or category codes."""
+    if values is None:
+        return np.arange(n, dtype=float)
+    values = np.asarray(values)
+    if values.dtype.kind in "biuf":
+        return values.astype(float)
+    if values.dtype.kind == "M":
+        return values.astype("datetime64[ns]").astype("int64").astype(float)
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            dates = pd.to_datetime(values)
+        return np.asarray(dates.asi8, dtype=float)
+    except (ValueError, TypeError, OverflowError):
+        return pd.factorize(values)[0].astype(float)
+
+
+def _point_count(trace):
+    values = trace.y if trace.y is not None else trace.x
+    return 0 if values is None else len(values)
+
+
+def _downsample_trace(trace, n_out):
+    n = _point_count(trace)
+    x = _as_numeric(trace.x, n)
+    y = _as_numeric(trace.y, n)
+    mode = trace.mode or ("lines" if n >= 20 else "lines+markers")
+    if "lines" in mode:
+        keep = lttb(x, y, n_out)
+    else:
+        keep = bin_points(x, y, n_out)
+
+    def subset(values):
+        if values is None or isinstance(values, str) or np.ndim(values) != 1:
+            return values
+        if len(values) != n:
+            return values
+        return np.asarray(values)[keep]
+
+    for name in POINT_ATTRIBUTES:
+        trace[name] = subset(trace[name])
+    for name in MARKER_ATTRIBUTES:
+        trace.marker[name] = subset(trace.marker[name])
+    return len(keep)
+
+
+def _to_webgl(trace):
+    # stacked areas and splines are not supported by scattergl
+    if trace.stackgroup or trace.line.shape == "spline":
+        return trace
+    properties = trace.to_plotly_json()
+    properties.pop("type", None)
+    import plotly.graph_objs as go
+
+    return go.Scattergl(properties, skip_invalid=True)
+
+
+def optimize_figure(fig, max_points=None, webgl_points=None):
+    """
+    This function makes large figures fast to send and render. Scatter traces with more than max_points
+    points are downsampled, lines with the LTTB algorithm (see lttb) and markers by binning (see
+    bin_points). When the figure still has more than webgl_points scatter points, the traces are drawn
+    with WebGL (go.Scattergl) instead of SVG. Downsampling is noted in an annotation on the figure.
+
+    :param fig: plotly figure, modified in place
+    :param max_points: maximum number of points per trace, by default DASHBOARDAI_GRAPH_MAX_POINTS
+    :param webgl_points: number of points above which WebGL is used, by default DASHBOARDAI_GRAPH_WEBGL_POINTS
+    :return: plotly figure, a new figure when traces were converted to WebGL
+    """
+    # imported on the first chart, the app starts without plotly.graph_objs
+    import plotly.graph_objs as go
+
+    if max_points is None:
+        max_points = get_setting("graph_max_points", 10000)
+    if webgl_points is None:
+        webgl_points = get_setting("graph_webgl_points", 5000)
+    scatter_types = (go.Scatter, go.Scattergl)
+    before, after = 0, 0
+    for trace in fig.data:
+        if not isinstance(trace, scatter_types):
+            continue
+        n = _point_count(trace)
+        before += n
+        if max_points and n > max_points:
+            n = _downsample_trace(trace, max_points)
+        after += n
+    if after < before:
+        fig.add_annotation(
+            text=f"Downsampled: showing {after:,} of {before:,} points",
+            xref="paper",
+            yref="paper",
+            x=1,
+            y=1,
+            xanchor="right",
+            yanchor="bottom",
+            showarrow=False,
+            font={"size": 10, "color": "gray"},
+        )
+    if webgl_points and after > webgl_points:
+        traces = [
+            _to_webgl(trace) if isinstance(trace, go.Scatter) else trace
+            for trace in fig.data
+        ]
+        fig = go.Figure(data=traces, layout=fig.layout, frames=fig.frames)
+    return fig
@@ -1,12 +1,23 @@
 """ tests in pytest for the api module """
 
 
+import openai
+import pandas as pd
+import pytest
+
+from dashboardai import api, providers
 from dashboardai.api import (
+    SchemaIndex,
     check_string_in_list,
+    create_dataframe_definition_prompt,
     create_table_definition_prompt,
+    estimate_tokens,
     handle_response_graph,
     remove_semicolons_in_brackets,
+    score_name,
+    send_to_openai,
     single_semicolon,
+    tokenize,
 )
 
 
@@ -63,7 +74,7 @@ def test_handle_response_graph():
     )
 
 
-def remove_semicolons_in_brackets():
+def test_remove_semicolons_in_brackets():
     """test the remove_semicolons_in_brackets function"""
     # create a string
     input_str = "(;, ,, ;);(;;;;)"
@@ -73,6 +84,23 @@ def remove_semicolons_in_brackets():
     assert output_str == "(, ,, );()"
 
 
+def test_remove_semicolons_in_nested_brackets():
+    """test that semicolons in nested brackets are removed, but not those in strings"""
+    assert remove_semicolons_in_brackets("f(a(b;c);d)") == "f(a(bc)d)"
+    assert remove_semicolons_in_brackets("f('a (b; c)';x)") == "f('a (b; c)'x)"
+    with pytest.raises(ValueError):
+        remove_semicolons_in_brackets("f((x)")
+
+
+def test_handle_response_graph_keeps_loops():
+    text = "for c in data['c'].unique():\n    fig.add_trace(go.Bar(\n        x=[c]))\nfig.show()\n"
+    code = handle_response_graph({"choices": [{"text": text}]})
+    assert (
+        code
+        == "for c in data['c'].unique():\n    fig.add_trace(go.Bar(\n        x=[c]))"
+    )
+
+
 def test_single_semicolon():
     """test the single_semicolon function"""
     # create a string
@@ -87,3 +115,87 @@ def test_single_semicolon():
     input_str = "c;;b; ; a"
     output_str = single_semicolon(input_str)
     assert output_str == "c;b;a"
+
+
+def test_send_to_openai_cache(monkeypatch):
+    """test that repeated prompts are answered from the completion cache"""
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        return {"choices": [{"text": " * FROM table1"}]}
+
+    monkeypatch.setattr(openai.Completion, "create", create)
+    monkeypatch.setattr(api, "_completion_cache", api.CompletionCache(path=None))
+    first = send_to_openai("prompt", stop=[";"])
+    assert send_to_openai("prompt", stop=[";"]) == first
+    assert len(calls) == 1
+    send_to_openai("prompt", stop=["#"])
+    send_to_openai("prompt", stop=[";"], use_cache=False)
+    assert len(calls) == 3
+    assert api.get_completion_cache().stats()["memory_hits"] == 1
+
+
+def test_send_to_openai_cache_per_provider(monkeypatch):
+    """test that answers of the fake provider are not returned for the openai provider"""
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        return {"choices": [{"text": " * FROM real"}]}
+
+    monkeypatch.setattr(openai.Completion, "create", create)
+    monkeypatch.setattr(api, "_completion_cache", api.CompletionCache(path=None))
+    monkeypatch.setattr(api, "_provider", providers.FakeProvider())
+    fake = send_to_openai("# data(a) \nSELECT", stop=[";"])
+    monkeypatch.setattr(api, "_provider", providers.OpenAIProvider())
+    real = send_to_openai("# data(a) \nSELECT", stop=[";"])
+    assert real["choices"][0]["text"] == " * FROM real" != fake["choices"][0]["text"]
+    assert len(calls) == 1
+
+
+def test_create_dataframe_definition_prompt():
+    """test that results with the same columns share the prompt"""
+    first = create_dataframe_definition_prompt(pd.DataFrame({"a": [1], "b": [2]}))
+    assert first == (
+        "### the variable data that is a pandas dataframe, with properties: \n# a,b \n"
+    )
+    second = create_dataframe_definition_prompt(pd.DataFrame({"a": [3], "b": [4]}))
+    assert second is first
+
+
+def test_tokenize():
+    assert tokenize("lifeExp") == ["life", "exp"]
+    assert tokenize("co2_change") == ["co", "2", "change"]
+    assert tokenize("What is the GDP?") == ["what", "is", "the", "gdp"]
+
+
+def test_score_name():
+    question = "average life expectancy per country"
+    words = set(tokenize(question))
+    assert score_name("country", question, words) == 3.0
+    assert score_name("lifeExp", question, words) == 1.7
+    assert score_name("countyr", question, words) > 0
+    assert score_name("income", question, words) == 0
+
+
+def test_schema_index_prune():
+    """test that only the relevant tables and columns are kept within the token budget"""
+    schema = {
+        "countries": [{"name": f"indicator_{i}", "dtype": "REAL"} for i in range(50)]
+        + [{"name": "lifeExp", "dtype": "REAL"}, {"name": "country", "dtype": "TEXT"}],
+        "orders": [{"name": f"field_{i}", "dtype": "TEXT"} for i in range(50)],
+    }
+    index = SchemaIndex(schema)
+    prompt, stats = index.prune("life expectancy by country", max_tokens=10**6)
+    assert prompt == create_table_definition_prompt(schema)
+    assert stats["tokens_before"] == stats["tokens_after"]
+
+    prompt, stats = index.prune("life expectancy by country", max_tokens=40)
+    assert prompt.startswith("### sqlite database, with its properties: \n")
+    assert "# countries(" in prompt
+    assert "lifeExp,country" in prompt
+    assert estimate_tokens(prompt) <= 40
+    assert stats["columns_before"] == 102
+    assert stats["columns_after"] < stats["columns_before"]
+    assert stats["tokens_after"] < stats["tokens_before"]
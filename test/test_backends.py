@@ -0,0 +1,252 @@
+""" tests in pytest for the backends module """
+
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from dashboardai import backends
+from dashboardai.backends import DuckDBBackend, SQLiteBackend, get_backend
+from dashboardai.data import QueryAborted, QueryRejected, compact_dtypes
+
+
+@pytest.fixture(params=["sqlite", "duckdb"])
+def backend(request):
+    if request.param == "duckdb":
+        pytest.importorskip("duckdb")
+    return get_backend(request.param)
+
+
+@pytest.fixture
+def test_data():
+    testdata1 = pd.DataFrame({"id": [1, 2, 3], "name": ["Alice", "Bob", "Charlie"]})
+    testdata2 = pd.DataFrame({"id": [4, 5], "name": ["David", "Eve"]})
+    return [
+        {"name": "table1", "data": testdata1},
+        {"name": "table2", "data": testdata2},
+    ]
+
+
+def test_get_backend():
+    assert isinstance(get_backend("sqlite"), SQLiteBackend)
+    assert isinstance(get_backend("DuckDB"), DuckDBBackend)
+    with pytest.raises(ValueError):
+        get_backend("oracle")
+
+
+def test_get_backend_from_setting(monkeypatch):
+    monkeypatch.setenv("DASHBOARDAI_SQL_BACKEND", "duckdb")
+    assert isinstance(get_backend(), DuckDBBackend)
+
+
+def test_table_info(backend, test_data):
+    database = backend.create(test_data)
+    table_info = database.table_info()
+    assert sorted(table_info) == ["table1", "table2"]
+    assert [c["name"] for c in table_info["table1"]] == ["id", "name"]
+
+
+def test_query(backend, test_data):
+    database = backend.create(test_data)
+    result = database.query(
+        "SELECT name, COUNT(*) AS n FROM table1 WHERE id > 1 GROUP BY name ORDER BY name"
+    )
+    assert result["name"].tolist() == ["Bob", "Charlie"]
+    assert result["n"].tolist() == [1, 1]
+    database.dispose()
+
+
+def test_schema_read_once(backend, test_data, monkeypatch):
+    database = backend.create(test_data)
+    calls = []
+    table_info = backend.table_info
+    monkeypatch.setattr(
+        backend, "table_info", lambda con: calls.append(con) or table_info(con)
+    )
+    assert database.table_info() is database.table_info()
+    assert len(calls) == 1
+    assert database.memoize("prompt", lambda: "a") == "a"
+    assert database.memoize("prompt", lambda: "b") == "a"
+
+
+def test_load_replaces_and_drops_tables(backend, test_data):
+    database = backend.create(test_data)
+    assert sorted(database.table_info()) == ["table1", "table2"]
+    table3 = pd.DataFrame({"x": [1.5]})
+    table1 = pd.DataFrame({"id": [9]})
+    database.load(
+        [{"name": "table3", "data": table3}, {"name": "table1", "data": table1}],
+        drop=["table2"],
+    )
+    # the memoized schema is read again
+    assert sorted(database.table_info()) == ["table1", "table3"]
+    assert database.query("SELECT id FROM table1")["id"].tolist() == [9]
+
+
+def test_nbytes(backend):
+    """test that sqlite counts the copied tables and duckdb not the dataframes it scans in place"""
+    small = backend.create([{"name": "t", "data": pd.DataFrame({"a": [1]})}])
+    df = pd.DataFrame({"a": range(100_000)})
+    large = backend.create([{"name": "t", "data": df}])
+    if backend.name == "sqlite":
+        assert large.nbytes() > small.nbytes() + 100_000
+    else:
+        assert large.nbytes() < df.memory_usage().sum()
+
+
+def test_create_from_arrow_tables(backend, test_data):
+    """test that pyarrow tables, as read from the disk store, are loaded like dataframes"""
+    pyarrow = pytest.importorskip("pyarrow")
+    tables = [
+        {"name": t["name"], "data": pyarrow.Table.from_pandas(t["data"])}
+        for t in test_data
+    ]
+    database = backend.create(tables)
+    expected = backend.create(test_data)
+    query = 'SELECT COUNT(*) AS n FROM "table1"'
+    assert database.query(query).equals(expected.query(query))
+
+
+def test_compacted_types(backend):
+    """test that compacted dtypes are kept by the backends without overflowing narrow integers"""
+    df = compact_dtypes(
+        pd.DataFrame({"n": [100, 120], "region": ["north", "north"], "x": [0.5, 1.5]})
+    )
+    database = backend.create([{"name": "t", "data": df}])
+    dtypes = {c["name"]: c["dtype"] for c in database.table_info()["t"]}
+    assert dtypes["region"] in ("TEXT", "VARCHAR")
+    assert dtypes["x"] in ("REAL", "FLOAT")
+    result = database.query("SELECT n * n AS n2 FROM t WHERE region = 'north'")
+    assert result["n2"].tolist() == [10000, 14400]
+
+
+def test_query_max_rows(backend, test_data):
+    database = backend.create(test_data)
+    result = database.query("SELECT * FROM table1 ORDER BY id", max_rows=2)
+    assert result["id"].tolist() == [1, 2]
+    assert result.attrs["truncated"]
+    result = database.query("SELECT * FROM table1 ORDER BY id", max_rows=3)
+    assert len(result) == 3
+    assert not result.attrs["truncated"]
+
+
+def test_query_empty_result_with_limits(backend, test_data):
+    database = backend.create(test_data)
+    result = database.query("SELECT id, name FROM table1 WHERE id > 9", max_rows=10)
+    assert list(result.columns) == ["id", "name"]
+    assert len(result) == 0
+
+
+# counts the rows of a cross join with 10^9 rows, which runs far longer than the timeout
+RUNAWAY_QUERY = """
+WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 1000)
+SELECT COUNT(*) FROM n a, n b, n c
+"""
+
+
+def test_query_timeout(backend, test_data):
+    database = backend.create(test_data)
+    start = time.monotonic()
+    with pytest.raises(QueryAborted):
+        database.query(RUNAWAY_QUERY, timeout=0.2)
+    assert time.monotonic() - start < 5
+    # the database is still usable after the abort
+    assert len(database.query("SELECT * FROM table1")) == 3
+
+
+def test_query_cancelled(backend, test_data):
+    database = backend.create(test_data)
+    cancelled = threading.Event()
+    threading.Timer(0.2, cancelled.set).start()
+    with pytest.raises(QueryAborted, match="cancelled"):
+        database.query(RUNAWAY_QUERY, cancelled=cancelled)
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "DELETE FROM table1",
+        "SELECT 1; DROP TABLE table1",
+        "SELECT * FROM missing",
+        "SELEC * FROM table1",
+        "SELECT * FROM read_csv_auto('/etc/passwd')",
+        "SELECT * FROM read_text('/etc/passwd')",
+        "SELECT * FROM range(10)",
+    ],
+)
+def test_validate_rejects(backend, test_data, query):
+    """test that writes and invalid queries are refused before they run"""
+    database = backend.create(test_data)
+    with pytest.raises(QueryRejected):
+        database.validate(query)
+    assert len(database.query("SELECT * FROM table1")) == 3
+
+
+def test_duckdb_without_file_access(test_data):
+    """test that the DuckDB connection cannot read files, even without validation"""
+    duckdb = pytest.importorskip("duckdb")
+    database = get_backend("duckdb").create(test_data)
+    with pytest.raises(duckdb.PermissionException):
+        database.query("SELECT * FROM read_csv_auto('/etc/passwd')")
+    with pytest.raises(duckdb.Error):
+        database.query("SET enable_external_access = true")
+    assert len(database.query("SELECT * FROM table1")) == 3
+    database.dispose()
+
+
+def test_validate_cross_product(backend, test_data):
+    """test that the rows combined by a cross product are refused above max_cost"""
+    database = backend.create(test_data)
+    query = "SELECT * FROM table1, table2"
+    assert database.validate(query, max_cost=6) == database.validate(query)
+    with pytest.raises(QueryRejected):
+        database.validate(query, max_cost=5)
+    assert database.validate("SELECT * FROM table1 WHERE id > 1", max_cost=1) == []
+
+
+def wait_for_indexes():
+    # the single worker of the pool runs the builds in order
+    backends._index_pool.submit(lambda: None).result()
+
+
+def test_automatic_index(test_data):
+    """test that a column is indexed in the background once generated queries used it often"""
+    database = SQLiteBackend().create(test_data)
+    database.min_uses, database.min_rows = 2, 0
+    query = "SELECT * FROM table1 WHERE name = 'Bob'"
+    assert database.record_usage(query) is False
+    wait_for_indexes()
+    assert database.indexes() == {}
+    assert database.record_usage(query) is False
+    wait_for_indexes()
+    assert list(database.indexes()) == [("table1", "name")]
+    assert database.record_usage(query) is True
+    plan = database.query("EXPLAIN QUERY PLAN " + query)
+    assert "USING INDEX" in plan["detail"].iloc[0]
+    assert database.query(query)["id"].tolist() == [2]
+    # replaced tables lose their indexes and their usage counts
+    database.load(test_data[:1])
+    assert database.indexes() == {}
+    assert database.record_usage(query) is False
+    database.dispose()
+
+
+def test_automatic_index_limits(backend, test_data):
+    """test that small tables, DuckDB views and indexes over max_bytes are not indexed"""
+    database = backend.create(test_data)
+    database.min_uses, database.max_bytes = 1, 1
+    query = "SELECT * FROM table1 WHERE name = 'Bob'"
+    database.record_usage(query)
+    wait_for_indexes()
+    assert database.indexes() == {}
+    database.min_rows = 0
+    for _ in range(2):
+        assert database.record_usage(query) is False
+        wait_for_indexes()
+    assert database.indexes() == {}
+    if backend.indexes:
+        assert database._indexes == {("table1", "name"): 0}
+        plan = database.query("EXPLAIN QUERY PLAN " + query)
+        assert "USING INDEX" not in plan["detail"].iloc[0]
+    database.dispose()
@@ -0,0 +1,68 @@
+""" tests in pytest for the benchmark suite, on tiny datasets """
+
+import json
+
+import pytest
+
+from benchmarks.load import TABLE, make_payload, percentile
+from benchmarks.pipeline import compare, main, make_dataset, run_benchmarks
+
+
+def test_make_dataset():
+    df = make_dataset(100, 6)
+    assert df.shape == (100, 6)
+    assert list(df.columns[:4]) == ["int_0", "float_1", "category_2", "date_3"]
+
+
+def test_run_benchmarks():
+    report = run_benchmarks([50], [5, 500], repeats=1, max_cells=1000)
+    benchmarks = {result["benchmark"] for result in report["results"]}
+    assert {
+        "parse_csv",
+        "parse_xlsx",
+        "compact_dtypes",
+        "create_sqlite_db",
+        "answer_table_question",
+        "encode_results[arrow]",
+        "decode_results[records]",
+    } <= benchmarks
+    assert "query_sqlite_db[group_by]" in benchmarks
+    # 50 x 500 is above max_cells
+    assert {result["columns"] for result in report["results"]} == {5}
+    json.dumps(report)
+
+
+def test_compare():
+    baseline = {
+        "results": [{"benchmark": "a", "rows": 1, "columns": 1, "seconds": 1.0}]
+    }
+    current = {"results": [{"benchmark": "a", "rows": 1, "columns": 1, "seconds": 1.5}]}
+    assert compare(baseline, current) == [("a", 1, 1, 1.5)]
+    assert compare(baseline, current, threshold=2) == []
+
+
+def test_main_writes_json(tmp_path):
+    output = tmp_path / "bench.json"
+    args = ["--rows", "20", "--columns", "5", "--repeats", "1", "--formats", "csv"]
+    assert main(args + ["--output", str(output)]) == 0
+    assert json.loads(output.read_text())["results"]
+    assert main(args + ["--compare", str(output), "--threshold", "1000"]) == 0
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile(list(range(101)), 95) == 95
+    assert percentile([1, 2], 99) == pytest.approx(1.99)
+
+
+def test_make_payload():
+    payload = make_payload(TABLE, ["question", 3], [{"session_id": "s"}, "job"], 1)
+    assert payload["output"].startswith("..table.children...table-results.data")
+    assert payload["changedPropIds"] == ["table-poll.n_intervals"]
+    assert payload["inputs"][1] == {
+        "id": "table-poll",
+        "property": "n_intervals",
+        "value": 3,
+    }
+    assert payload["state"][1]["value"] == "job"
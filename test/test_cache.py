@@ -0,0 +1,122 @@
+""" tests in pytest for the cache module """
+
+import pandas as pd
+import pytest
+
+from dashboardai.cache import (
+    CompletionCache,
+    ResultCache,
+    make_completion_key,
+    normalize_sql,
+)
+
+RESPONSE = {"choices": [{"text": " * FROM table1"}]}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_make_completion_key():
+    key = make_completion_key("model", "prompt", [";"], 100)
+    assert key == make_completion_key("model", "prompt", [";"], 100)
+    assert key != make_completion_key("model", "prompt", [";"], 200)
+    assert key != make_completion_key("model", "prompt", ["#"], 100)
+    assert key != make_completion_key("other", "prompt", [";"], 100)
+    assert key == make_completion_key("model", "prompt", [";"], 100, "openai")
+    assert key != make_completion_key("model", "prompt", [";"], 100, "fake")
+
+
+def test_memory_cache():
+    cache = CompletionCache(path=None, ttl_seconds=60, max_memory_entries=2)
+    assert cache.get("a") is None
+    cache.set("a", RESPONSE)
+    assert cache.get("a") == RESPONSE
+    cache.set("b", RESPONSE)
+    cache.set("c", RESPONSE)
+    assert cache.get("a") is None
+    assert cache.stats() == {
+        "memory_hits": 1,
+        "disk_hits": 0,
+        "misses": 2,
+        "hit_rate": 1 / 3,
+        "memory_entries": 2,
+    }
+
+
+def test_disk_cache_shared_between_instances(tmp_path):
+    path = str(tmp_path / "cache" / "completions.sqlite")
+    CompletionCache(path=path, ttl_seconds=60).set("a", RESPONSE)
+    cache = CompletionCache(path=path, ttl_seconds=60)
+    assert cache.get("a") == RESPONSE
+    assert cache.get("a") == RESPONSE
+    assert cache.disk_hits == 1
+    assert cache.memory_hits == 1
+
+
+def test_disk_cache_size_limit(tmp_path):
+    clock = FakeClock()
+    path = str(tmp_path / "completions.sqlite")
+    cache = CompletionCache(
+        path=path, ttl_seconds=60, max_memory_entries=0, max_disk_entries=2, clock=clock
+    )
+    for key in "abc":
+        clock.now += 1
+        cache.set(key, RESPONSE)
+    assert cache.get("a") is None
+    assert cache.get("c") == RESPONSE
+
+
+def test_cache_ttl(tmp_path):
+    clock = FakeClock()
+    cache = CompletionCache(
+        path=str(tmp_path / "completions.sqlite"), ttl_seconds=10, clock=clock
+    )
+    cache.set("a", RESPONSE)
+    clock.now += 11
+    assert cache.get("a") is None
+    assert cache.misses == 1
+
+
+def test_normalize_sql():
+    assert normalize_sql("SELECT  a ,b\n FROM t WHERE x = 'A  B';") == (
+        "SELECT a ,b FROM t WHERE x = 'A  B'"
+    )
+    assert normalize_sql('Select "Col" from T') == 'Select "Col" from T'
+    # a minus sign before a negative number is not a comment
+    assert normalize_sql("SELECT a - -1 FROM t") != normalize_sql("SELECT a--1 FROM t")
+    # the results have the column labels of their query
+    assert normalize_sql("SELECT Country FROM t") != normalize_sql(
+        "SELECT country FROM t"
+    )
+
+
+def test_result_cache_memory_eviction():
+    df = pd.DataFrame({"a": range(100)})
+    size = int(df.memory_usage(index=True, deep=True).sum())
+    cache = ResultCache(max_bytes=size * 2, max_entry_bytes=size, spill_dir="unused")
+    cache.put("v1", "SELECT * FROM t", df)
+    assert cache.get("v1", "SELECT *\n FROM t;") is df
+    assert cache.get("v2", "SELECT * FROM t") is None
+    cache.put("v1", "SELECT 2", df)
+    cache.put("v1", "SELECT 3", df)
+    assert cache.get("v1", "SELECT * FROM t") is None
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["evictions"] == 1
+    assert stats["memory_bytes"] == size * 2
+
+
+def test_result_cache_spills_large_results(tmp_path):
+    pytest.importorskip("pyarrow")
+    df = pd.DataFrame({"a": range(1000), "b": ["x"] * 1000})
+    cache = ResultCache(max_bytes=10**9, max_entry_bytes=100, spill_dir=str(tmp_path))
+    cache.put("v1", "SELECT * FROM t", df)
+    assert cache.stats()["memory_entries"] == 0
+    assert cache.stats()["spilled_entries"] == 1
+    assert cache.get("v1", "SELECT * FROM t").equals(df)
@@ -0,0 +1,135 @@
+""" tests in pytest for the callbacks module """
+
+import subprocess
+import sys
+
+import pandas as pd
+import plotly.graph_objs as go
+import pytest
+
+from dashboardai import backends, callbacks
+from dashboardai.backends import get_backend
+from dashboardai.cache import ChartCodeCache, ResultCache
+from dashboardai.callbacks import answer_graph_question, answer_table_question
+from dashboardai.data import QueryRejected
+from dashboardai.metrics import metrics
+from dashboardai.sandbox import UnsafeCodeError
+
+
+def fake_send_to_openai(text):
+    def send_to_openai(prompt, stop, max_tokens=1000, use_cache=True):
+        return {"choices": [{"text": text}]}
+
+    return send_to_openai
+
+
+def test_answer_table_question(monkeypatch):
+    monkeypatch.setattr(
+        callbacks, "send_to_openai", fake_send_to_openai(" COUNT(*) AS n FROM table1")
+    )
+    data = pd.DataFrame({"id": [1, 2, 3]})
+    database = get_backend("sqlite").create([{"name": "table1", "data": data}])
+    answer = answer_table_question(None, database, "how many rows?")
+    assert answer["query"] == "Select COUNT(*) AS n FROM table1"
+    assert answer["result"]["n"].tolist() == [3]
+    text = metrics.render()
+    assert 'dashboardai_stage_bytes_count{stage="prompt_full"}' in text
+    assert 'dashboardai_stage_bytes_count{stage="prompt_pruned"}' in text
+
+
+def test_answer_table_question_result_cache(monkeypatch):
+    monkeypatch.setattr(
+        callbacks, "send_to_openai", fake_send_to_openai(" COUNT(*) AS n FROM table1")
+    )
+    data = pd.DataFrame({"id": [1, 2, 3]})
+    database = get_backend("sqlite").create([{"name": "table1", "data": data}])
+    results = ResultCache(max_bytes=10**6)
+    first = answer_table_question(None, database, "rows?", "v1", results)
+    monkeypatch.setattr(database, "query", None)
+    second = answer_table_question(None, database, "rows?", "v1", results)
+    assert second["result"] is first["result"]
+    assert results.stats()["hits"] == 1
+
+
+def test_answer_table_question_rejected(monkeypatch):
+    monkeypatch.setattr(
+        callbacks, "send_to_openai", fake_send_to_openai(" 1; DELETE FROM table1")
+    )
+    data = pd.DataFrame({"id": [1, 2, 3]})
+    database = get_backend("sqlite").create([{"name": "table1", "data": data}])
+    with pytest.raises(QueryRejected):
+        answer_table_question(None, database, "delete everything")
+    assert len(database.query("SELECT * FROM table1")) == 3
+
+
+def test_answer_table_question_indexed(monkeypatch):
+    monkeypatch.setattr(
+        callbacks, "send_to_openai", fake_send_to_openai(" * FROM table1 WHERE id = 2")
+    )
+    monkeypatch.setenv("DASHBOARDAI_INDEX_MIN_USES", "1")
+    monkeypatch.setenv("DASHBOARDAI_INDEX_MIN_ROWS", "0")
+    data = pd.DataFrame({"id": [1, 2, 3]})
+    database = get_backend("sqlite").create([{"name": "table1", "data": data}])
+    with metrics.span("ask"):
+        answer_table_question(None, database, "row 2")
+        assert "sql_indexed" not in [stage for stage, *_ in metrics.trace()]
+    backends._index_pool.submit(lambda: None).result()
+    assert list(database.indexes()) == [("table1", "id")]
+    with metrics.span("ask"):
+        answer = answer_table_question(None, database, "row 2")
+        assert "sql_indexed" in [stage for stage, *_ in metrics.trace()]
+    assert answer["result"]["id"].tolist() == [2]
+
+
+def test_answer_table_question_truncated(monkeypatch):
+    monkeypatch.setattr(
+        callbacks, "send_to_openai", fake_send_to_openai(" * FROM table1")
+    )
+    monkeypatch.setenv("DASHBOARDAI_QUERY_MAX_ROWS", "2")
+    data = pd.DataFrame({"id": [1, 2, 3]})
+    database = get_backend("sqlite").create([{"name": "table1", "data": data}])
+    results = ResultCache(max_bytes=10**6)
+    answer = answer_table_question(None, database, "all rows", "v1", results)
+    assert answer["truncated"]
+    assert len(answer["result"]) == 2
+    # truncated results are not cached
+    assert results.get("v1", answer["query"]) is None
+
+
+def test_answer_graph_question(monkeypatch):
+    code = "fig.add_trace(go.Bar(x=data['a'], y=data['b']))\nfig.show()"
+    monkeypatch.setattr(callbacks, "send_to_openai", fake_send_to_openai(code))
+    data = pd.DataFrame({"a": ["x", "y"], "b": [1, 2]})
+    fig = answer_graph_question(None, data, "bar chart of b by a")
+    assert isinstance(fig, go.Figure)
+    assert list(fig.data[0].y) == [1, 2]
+
+
+def test_answer_graph_question_chart_cache(monkeypatch):
+    code = "fig.add_trace(go.Bar(x=data['a'], y=data['b']))\nfig.show()"
+    monkeypatch.setattr(callbacks, "send_to_openai", fake_send_to_openai(code))
+    charts = ChartCodeCache()
+    data = pd.DataFrame({"a": ["x", "y"], "b": [1, 2]})
+    answer_graph_question(None, data, "bar chart of b by a", charts)
+    # new data with the same columns reuses the compiled code without calling the LLM
+    monkeypatch.setattr(callbacks, "send_to_openai", None)
+    data = pd.DataFrame({"a": ["z"], "b": [5]})
+    fig = answer_graph_question(None, data, "Bar chart of b  by a", charts)
+    assert list(fig.data[0].y) == [5]
+    assert charts.stats() == {"hits": 1, "misses": 1, "entries": 1}
+
+
+def test_answer_graph_question_rejects_unsafe_code(monkeypatch):
+    code = "import os\nos.remove('app.py')"
+    monkeypatch.setattr(callbacks, "send_to_openai", fake_send_to_openai(code))
+    with pytest.raises(UnsafeCodeError):
+        answer_graph_question(None, pd.DataFrame({"a": [1]}), "delete the app")
+
+
+def test_graph_imports_are_deferred():
+    """test that plotly.graph_objs is only imported by the first chart"""
+    code = (
+        "import sys, dashboardai.callbacks, dashboardai.visualizations; "
+        "assert 'plotly.graph_objs' not in sys.modules"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
@@ -1,18 +1,47 @@
 """ tests in pytest for the data module """
 
+import base64
+import io
+import json
 import os
+import subprocess
 import sys
+import threading
 
 import pandas as pd
 import pytest
 from sqlalchemy import create_engine, inspect, text
 
 from dashboardai.data import (
+    QueryRejected,
+    build_count_query,
+    build_page_query,
+    compact_dtypes,
+    create_duckdb,
     create_sqlite_db,
+    decode_contents,
+    decode_dataframe,
+    describe_tables,
+    encode_dataframe,
+    fetch_limited,
+    get_content_hash,
+    get_dataset_hash,
+    get_duckdb_table_info,
+    get_file_hash,
+    get_index_columns,
+    get_query_limits,
     get_sqlite_table_info,
+    get_table_name,
+    load_default_dataset,
     parse_contents,
+    parse_contents_with_stats,
+    parse_filter_query,
+    parse_uploads,
+    query_duckdb,
     query_sqlite_db,
+    validate_sqlite_query,
 )
+from dashboardai.registry import FileCache
 
 
 @pytest.fixture
@@ -70,6 +99,108 @@ def test_query_sqlite_db(test_data):
     assert result.equals(test_data[0]["data"])
 
 
+def test_sqlite_db_shared_across_threads(test_data):
+    engine = create_sqlite_db(test_data)
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(query_sqlite_db(engine, "SELECT * FROM table2"))
+    )
+    thread.start()
+    thread.join()
+    assert results[0].equals(test_data[1]["data"])
+
+
+def test_duckdb_import_is_deferred():
+    """test that duckdb is only imported by the first duckdb database"""
+    code = (
+        "import sys, dashboardai.backends, dashboardai.data, dashboardai.registry; "
+        "assert 'duckdb' not in sys.modules"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_duckdb(test_data):
+    pytest.importorskip("duckdb")
+    con = create_duckdb(test_data)
+    assert get_duckdb_table_info(con) == {
+        "table1": [
+            {"name": "id", "dtype": "BIGINT"},
+            {"name": "name", "dtype": "VARCHAR"},
+        ],
+        "table2": [
+            {"name": "id", "dtype": "BIGINT"},
+            {"name": "name", "dtype": "VARCHAR"},
+        ],
+    }
+    result = query_duckdb(con, "SELECT * FROM table1")
+    assert result.equals(test_data[0]["data"])
+
+
+def test_get_content_hash():
+    contents = ["data:text/csv;base64,YQ==", "data:text/csv;base64,Yg=="]
+    filenames = ["a.csv", "b.csv"]
+    assert get_content_hash(contents, filenames) == get_content_hash(
+        list(contents), list(filenames)
+    )
+    assert get_content_hash(contents, filenames) != get_content_hash(
+        contents[::-1], filenames
+    )
+    assert get_content_hash(contents, filenames) != get_content_hash(
+        contents, ["a.csv", "c.csv"]
+    )
+
+
+@pytest.mark.parametrize("payload_format", ["arrow", "columns", "records"])
+def test_encode_dataframe(payload_format):
+    """test that results survive the round trip through the browser Store with their dtypes"""
+    if payload_format == "arrow":
+        pytest.importorskip("pyarrow")
+    df = pd.DataFrame(
+        {
+            "id": [1, 2, 3],
+            "value": [0.5, None, 2.0],
+            "name": ["a", "b", None],
+            "day": pd.to_datetime(["2020-01-01", "2020-01-02", "2020-01-03"]),
+        }
+    )
+    payload = encode_dataframe(df, payload_format)
+    # the payload is sent as JSON
+    decoded = decode_dataframe(json.loads(json.dumps(payload, default=str)))
+    if payload_format == "records":
+        assert decoded["id"].tolist() == [1, 2, 3]
+    else:
+        assert payload["format"] == payload_format
+        pd.testing.assert_frame_equal(decoded, df)
+
+
+def test_encode_dataframe_duplicate_columns():
+    """test that results Arrow cannot encode fall back to columns"""
+    df = pd.DataFrame([[1, 2]], columns=["id", "id"])
+    payload = encode_dataframe(df, "arrow")
+    assert payload["format"] == "columns"
+    assert decode_dataframe(payload).values.tolist() == [[1, 2]]
+
+
+def test_decode_dataframe_invalid():
+    with pytest.raises(ValueError):
+        decode_dataframe({"format": "arrow", "data": "bm90IGFycm93"})
+    with pytest.raises(ValueError):
+        decode_dataframe({"format": "pickle"})
+    with pytest.raises(ValueError):
+        encode_dataframe(pd.DataFrame(), "pickle")
+
+
+def test_describe_tables(test_data):
+    tables = {df["name"]: df["data"] for df in test_data}
+    assert describe_tables(tables) == {
+        "table1": {"columns": ["id", "name"], "rows": 3},
+        "table2": {"columns": ["id", "name"], "rows": 2},
+    }
+    pyarrow = pytest.importorskip("pyarrow")
+    arrow_tables = {name: pyarrow.Table.from_pandas(df) for name, df in tables.items()}
+    assert describe_tables(arrow_tables) == describe_tables(tables)
+
+
 """ test the parse_contents function, filename is a string and contents is a list of bytes, for csv files
 first write a csv file to disk, then read it back in as a list of bytes, then delete the file from disk"""
 
@@ -82,7 +213,25 @@ def test_parse_contents_csv():
     # call the parse_contents function
     result = parse_contents(test_list[0], "test.csv")
     # check if the result is the same as the dataframe
-    assert result.equals(pd.read_csv("test/gapminder.csv"))
+    assert result.equals(compact_dtypes(pd.read_csv("test/gapminder.csv")))
+
+
+@pytest.mark.parametrize("csv_engine", ["c", "pyarrow"])
+def test_sqlite_date_filter(monkeypatch, csv_engine):
+    """test that generated filters on date literals match the parsed dates"""
+    if csv_engine == "pyarrow":
+        pytest.importorskip("pyarrow")
+    monkeypatch.setenv("DASHBOARDAI_CSV_ENGINE", csv_engine)
+    text = "day,time,value\n2020-01-01,2020-01-01 10:30:00,1\n2020-01-01,,2\n2020-01-02,2020-01-02 11:00:00,3\n"
+    contents = "data:text/csv;base64," + base64.b64encode(text.encode()).decode()
+    df = parse_contents(contents, "dates.csv")
+    engine = create_sqlite_db([{"name": "dates", "data": df}])
+    result = query_sqlite_db(engine, "SELECT value FROM dates WHERE day = '2020-01-01'")
+    assert result["value"].tolist() == [1, 2]
+    result = query_sqlite_db(
+        engine, "SELECT value FROM dates WHERE time = '2020-01-02 11:00:00'"
+    )
+    assert result["value"].tolist() == [3]
 
 
 def test_parse_contents_xlsx():
@@ -93,4 +242,295 @@ def test_parse_contents_xlsx():
     # call the parse_contents function
     result = parse_contents(test_list[0], "test.xlsx")
     # check if the result is the same as the dataframe
-    assert result.equals(pd.read_excel("test/gapminder.xlsx"))
+    assert result.equals(compact_dtypes(pd.read_excel("test/gapminder.xlsx")))
+
+
+def test_decode_contents():
+    """test that the payload is decoded in chunks into a bytes buffer"""
+    payload = bytes(range(256)) * 10
+    contents = "data:text/csv;base64," + base64.b64encode(payload).decode("ascii")
+    assert decode_contents(contents).read() == payload
+    assert decode_contents(contents, chunk_size=8).read() == payload
+
+
+@pytest.mark.parametrize("engine", ["c", "pyarrow"])
+def test_parse_contents_with_stats(monkeypatch, engine):
+    """test the parse stats and both csv engines"""
+    if engine == "pyarrow":
+        pytest.importorskip("pyarrow")
+    monkeypatch.setenv("DASHBOARDAI_CSV_ENGINE", engine)
+    with open("test/cars.csv", "rb") as f:
+        raw = f.read()
+    contents = "data:text/csv;base64," + base64.b64encode(raw).decode("ascii")
+    result, stats = parse_contents_with_stats(contents, "cars.csv", trace_memory=True)
+    assert result.equals(compact_dtypes(pd.read_csv("test/cars.csv")))
+    assert stats["engine"] == engine
+    assert stats["bytes"] == len(raw)
+    assert stats["rows"] == len(result)
+    assert stats["peak_bytes"] > 0
+    assert stats["parse_seconds"] >= 0
+    assert 0 < stats["memory_bytes"] < stats["memory_before_bytes"]
+
+
+def test_compact_dtypes():
+    """test that numbers are downcast, dates parsed and repeated strings made categorical"""
+    df = pd.DataFrame(
+        {
+            "small": [1, 2, 3, 4],
+            "large": [1, 2, 3, 2**40],
+            "exact": [0.5, 1.25, None, 2.0],
+            "precise": [0.1, 0.2, 0.3, 0.4],
+            "date": ["2020-01-01", "2020-02-01", None, "2021-03-04"],
+            "region": ["north", "south", "north", "north"],
+            "name": ["a", "b", "c", "d"],
+            "mixed": ["a", 1, "a", 1],
+        }
+    )
+    result = compact_dtypes(df)
+    assert result["small"].dtype == "int8"
+    assert result["large"].dtype == "int64"
+    assert result["exact"].dtype == "float32"
+    assert result["precise"].dtype == "float64"
+    assert result["date"].dtype == "datetime64[ns]"
+    assert result["date"].isna().sum() == 1
+    assert result["region"].dtype == "category"
+    assert result["name"].dtype == object
+    assert result["mixed"].dtype == object
+    assert df["small"].dtype == "int64"
+    pd.testing.assert_frame_equal(
+        result.astype({"region": object, "exact": "float64", "small": "int64"}),
+        df.assign(date=pd.to_datetime(df["date"])),
+    )
+    unchanged = pd.DataFrame({"name": ["a", "b"]})
+    assert compact_dtypes(unchanged) is unchanged
+
+
+def test_compact_dtypes_keeps_years_and_codes():
+    """test that only full dates with separators are parsed as datetimes"""
+    df = pd.DataFrame(
+        {
+            "year": ["2020", "2021", "2022"],
+            "code": ["20200101", "20200102", "20200103"],
+            "time": ["2020-01-01 10:00", "2020-01-02T11:30:00", None],
+        }
+    )
+    result = compact_dtypes(df, category_ratio=0)
+    assert result["year"].dtype == object
+    assert result["code"].dtype == object
+    assert result["time"].dtype == "datetime64[ns]"
+
+
+def encode_upload(raw, content_type="text/csv"):
+    return f"data:{content_type};base64," + base64.b64encode(raw).decode("ascii")
+
+
+def test_get_table_name():
+    assert get_table_name("cars.csv") == "cars"
+    assert get_table_name("data.v2.xlsx", "Sheet 1") == "data.v2_Sheet_1"
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_parse_uploads(max_workers):
+    """test that files and sheets are parsed in upload order with per file errors"""
+    sheets = {
+        "first": pd.DataFrame({"a": [1, 2]}),
+        "second sheet": pd.DataFrame({"b": ["x", "y", "z"]}),
+    }
+    workbook = io.BytesIO()
+    with pd.ExcelWriter(workbook) as writer:
+        for name, df in sheets.items():
+            df.to_excel(writer, sheet_name=name, index=False)
+    with open("test/cars.csv", "rb") as f:
+        cars = f.read()
+    contents = [
+        encode_upload(cars),
+        encode_upload(b"not a workbook"),
+        encode_upload(workbook.getvalue()),
+        encode_upload(b"a,b"),
+    ]
+    filenames = ["cars.csv", "broken.xlsx", "book.xlsx", "notes.txt"]
+
+    results = parse_uploads(contents, filenames, max_workers=max_workers)
+
+    assert [r["filename"] for r in results] == filenames
+    assert list(results[0]["tables"]) == ["cars"]
+    assert results[0]["tables"]["cars"].equals(
+        compact_dtypes(pd.read_csv("test/cars.csv"))
+    )
+    assert results[0]["errors"] == []
+    assert results[1]["tables"] == {}
+    assert len(results[1]["errors"]) == 1
+    assert list(results[2]["tables"]) == ["book_first", "book_second_sheet"]
+    assert results[2]["tables"]["book_second_sheet"].equals(
+        compact_dtypes(sheets["second sheet"])
+    )
+    assert [s["rows"] for s in results[2]["stats"]] == [2, 3]
+    assert results[3]["tables"] == {}
+    assert "Unsupported file type" in results[3]["errors"][0]
+
+
+def test_parse_uploads_cache():
+    """test that a file uploaded again under another name is not parsed again"""
+    cache = FileCache()
+    content = encode_upload(b"a,b\n1,2\n")
+    first = parse_uploads([content], ["one.csv"], max_workers=0, cache=cache)
+    second = parse_uploads([content], ["two.csv"], max_workers=0, cache=cache)
+    assert first[0]["file_hash"] == second[0]["file_hash"]
+    assert second[0]["tables"]["two"] is first[0]["tables"]["one"]
+    assert not first[0]["stats"][0]["cached"]
+    assert second[0]["stats"][0]["cached"]
+    assert second[0]["stats"][0]["table"] == "two"
+    assert cache.stats()["hits"] == 1
+    # files that could not be parsed are not cached
+    parse_uploads([encode_upload(b"x")], ["notes.txt"], max_workers=0, cache=cache)
+    assert cache.stats()["entries"] == 1
+
+
+def test_get_content_hash_matches_dataset_hash():
+    contents = [encode_upload(b"a"), encode_upload(b"b")]
+    files = [
+        ("a.csv", get_file_hash(contents[0])),
+        ("b.csv", get_file_hash(contents[1])),
+    ]
+    assert get_content_hash(contents, ["a.csv", "b.csv"]) == get_dataset_hash(files)
+
+
+def test_parse_filter_query():
+    columns = ["id", "name"]
+    assert parse_filter_query("", columns) == ("", [])
+    condition, params = parse_filter_query(
+        '{name} icontains "Al" && {id} >= 2 && {name} is blank', columns
+    )
+    assert condition == (
+        'LOWER(CAST("name" AS TEXT)) LIKE ? AND "id" >= ? AND "name" IS NULL'
+    )
+    assert params == ["%al%", 2]
+    with pytest.raises(ValueError):
+        parse_filter_query("{secret} = 1", columns)
+    with pytest.raises(ValueError):
+        parse_filter_query("{id} ~ 1", columns)
+
+
+@pytest.mark.parametrize(
+    "filter_query, expected",
+    [
+        ("{id} >= 2 and {id} < 5", ('"id" >= ? AND "id" < ?', [2, 5])),
+        ('{name} = "Al" || {id} > 3', ('("name" = ? OR "id" > ?)', ["Al", 3])),
+        ('{name} = "a or b" OR {id} = 1', ('("name" = ? OR "id" = ?)', ["a or b", 1])),
+        (
+            '({id} = 1 or {id} = 2) && {name} != "Bob"',
+            ('("id" = ? OR "id" = ?) AND "name" != ?', [1, 2, "Bob"]),
+        ),
+    ],
+)
+def test_parse_filter_query_logical(filter_query, expected):
+    assert parse_filter_query(filter_query, ["id", "name"]) == expected
+
+
+@pytest.mark.parametrize(
+    "filter_query", ["{id} > 1 and", "or {id} > 1", "({id} > 1", "{id} > 1)", "()"]
+)
+def test_parse_filter_query_rejects_malformed(filter_query):
+    with pytest.raises(ValueError):
+        parse_filter_query(filter_query, ["id", "name"])
+
+
+def test_build_page_query(test_data):
+    engine = create_sqlite_db(test_data)
+    columns = ["id", "name"]
+    query, params = build_page_query(
+        "SELECT * FROM table1;",
+        columns,
+        page_current=1,
+        page_size=1,
+        sort_by=[{"column_id": "id", "direction": "desc"}],
+        filter_query="{id} > 1",
+    )
+    result = query_sqlite_db(engine, query, params)
+    assert result["name"].tolist() == ["Bob"]
+    query, params = build_count_query("SELECT * FROM table1", columns, "{id} > 1")
+    assert query_sqlite_db(engine, query, params).iloc[0, 0] == 2
+    with pytest.raises(ValueError):
+        build_page_query(
+            "SELECT * FROM table1",
+            columns,
+            sort_by=[{"column_id": "x", "direction": "asc"}],
+        )
+
+
+def test_fetch_limited():
+    chunks = iter([[(1, "a"), (2, "b")], [(3, "c"), (4, "d")], []])
+    result = fetch_limited(lambda: next(chunks), ["id", "name"], max_rows=3)
+    assert result["id"].tolist() == [1, 2, 3]
+    assert result.attrs["truncated"]
+
+    chunks = iter([pd.DataFrame({"x": range(1000)})] * 3 + [pd.DataFrame()])
+    result = fetch_limited(lambda: next(chunks), ["x"], max_bytes=10)
+    # the first chunk is always kept
+    assert len(result) == 1000
+    assert result.attrs["truncated"]
+
+
+def test_get_query_limits(monkeypatch):
+    monkeypatch.setenv("DASHBOARDAI_QUERY_TIMEOUT_SECONDS", "0")
+    monkeypatch.setenv("DASHBOARDAI_QUERY_MAX_ROWS", "10")
+    limits = get_query_limits()
+    assert limits["timeout"] is None
+    assert limits["max_rows"] == 10
+
+
+def test_load_default_dataset(monkeypatch):
+    df = load_default_dataset()
+    assert list(df.columns) == [
+        "country",
+        "year",
+        "pop",
+        "continent",
+        "lifeExp",
+        "gdpPercap",
+    ]
+    assert len(df) == 1704
+    # loaded once per process
+    assert load_default_dataset() is df
+
+
+def test_validate_sqlite_query(test_data):
+    """test the plan check of correlated subqueries, aliases and large scans"""
+    engine = create_sqlite_db(test_data)
+    row_counts = {"table1": 3000, "table2": 2000}
+    correlated = "SELECT id, (SELECT COUNT(*) FROM table2 AS t WHERE t.id < table1.id) FROM table1"
+    with pytest.raises(QueryRejected):
+        validate_sqlite_query(engine, correlated, row_counts, max_cost=10**6)
+    self_join = 'SELECT * FROM table1 a, "table1" AS b'
+    warnings = validate_sqlite_query(engine, self_join, row_counts, scan_rows=10**6)
+    assert warnings == [
+        "table1 (3000 rows) is scanned once per row of the tables before it"
+    ]
+    warnings = validate_sqlite_query(
+        engine, "SELECT * FROM table1", row_counts, scan_rows=1000
+    )
+    assert warnings == ["Full scan of table1 (3000 rows)"]
+    # joins on equal columns use an automatic index
+    join = "SELECT * FROM table1 JOIN table2 ON table1.id = table2.id"
+    assert validate_sqlite_query(engine, join, row_counts, max_cost=10**6) is not None
+
+
+def test_get_index_columns(test_data):
+    """test that the columns of filters, joins and groups are found through aliases"""
+    table_info = get_sqlite_table_info(create_sqlite_db(test_data))
+    query = (
+        'SELECT a.name, COUNT(*) FROM table1 AS a JOIN "table2" b ON a.id = b.id '
+        "WHERE name <> 'id' GROUP BY a.name ORDER BY 2"
+    )
+    assert get_index_columns(query, table_info) == [
+        ("table1", "id"),
+        ("table1", "name"),
+        ("table2", "id"),
+        ("table2", "name"),
+    ]
+    query = "SELECT * FROM table1 LEFT JOIN table2 USING (id) LIMIT 5"
+    assert get_index_columns(query, table_info) == [
+        ("table1", "id"),
+        ("table2", "id"),
+    ]
+    assert get_index_columns("SELECT name FROM table1 ORDER BY id", table_info) == []
@@ -0,0 +1,89 @@
+""" tests in pytest for the jobs module """
+
+import threading
+import time
+
+import pytest
+
+from dashboardai.jobs import JobCancelled, JobManager, check_cancelled
+
+
+def wait_for(manager, job_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = manager.status(job_id)
+        if status["status"] not in ("pending", "running"):
+            return status
+        time.sleep(0.01)
+    raise AssertionError("job did not finish")
+
+
+def test_check_cancelled():
+    event = threading.Event()
+    check_cancelled(None)
+    check_cancelled(event)
+    event.set()
+    with pytest.raises(JobCancelled):
+        check_cancelled(event)
+
+
+def test_job_result_and_failure():
+    manager = JobManager(max_workers=2)
+    job_id = manager.submit("a", "table", lambda cancelled, x: x * 2, 21)
+    assert wait_for(manager, job_id) == {"status": "done", "result": 42}
+    # finished jobs are removed once their status was read
+    assert manager.status(job_id) == {"status": "unknown"}
+
+    def fail(cancelled):
+        raise ValueError("bad query")
+
+    status = wait_for(manager, manager.submit("a", "table", fail))
+    assert status["status"] == "failed"
+    assert isinstance(status["error"], ValueError)
+    manager.shutdown()
+
+
+def test_new_job_cancels_previous_job_of_session():
+    manager = JobManager(max_workers=1)
+    started, release = threading.Event(), threading.Event()
+
+    def slow(cancelled):
+        started.set()
+        release.wait(5)
+        check_cancelled(cancelled)
+        return "stale"
+
+    running = manager.submit("a", "table", slow)
+    started.wait(5)
+    # queued behind the running job, cancelled before it starts
+    queued = manager.submit("b", "table", lambda cancelled: "queued")
+    manager.submit("b", "table", lambda cancelled: "fresh")
+    latest = manager.submit("a", "table", lambda cancelled: "fresh")
+    release.set()
+    assert wait_for(manager, running) == {"status": "cancelled"}
+    assert wait_for(manager, queued) == {"status": "cancelled"}
+    assert wait_for(manager, latest) == {"status": "done", "result": "fresh"}
+    manager.shutdown()
+
+
+def test_other_kind_is_not_cancelled():
+    manager = JobManager(max_workers=2)
+    table = manager.submit("a", "table", lambda cancelled: "table")
+    graph = manager.submit("a", "graph", lambda cancelled: "graph")
+    assert wait_for(manager, table)["result"] == "table"
+    assert wait_for(manager, graph)["result"] == "graph"
+    manager.shutdown()
+
+
+def test_submit_after_expired_job():
+    manager = JobManager(max_workers=1, ttl_seconds=0)
+    first = manager.submit("a", "table", lambda cancelled: "first")
+    while manager.stats()["running"] or manager.stats()["pending"]:
+        time.sleep(0.01)
+    time.sleep(0.01)
+    # the first job expires unread, the session submits again
+    second = manager.submit("a", "table", lambda cancelled: "second")
+    assert manager.status(first) == {"status": "unknown"}
+    assert wait_for(manager, second) == {"status": "done", "result": "second"}
+    assert manager._active == {}
+    manager.shutdown()
@@ -0,0 +1,90 @@
+""" tests in pytest for the metrics module """
+
+import logging
+
+from dashboardai.metrics import Histogram, Metrics
+
+
+def test_histogram():
+    histogram = Histogram((1, 10))
+    for value in (0.5, 1, 5, 50):
+        histogram.observe(value)
+    lines = histogram.render("m", 'stage="a"')
+    assert lines == [
+        'm_bucket{stage="a",le="1"} 2',
+        'm_bucket{stage="a",le="10"} 3',
+        'm_bucket{stage="a",le="+Inf"} 4',
+        'm_sum{stage="a"} 56.5',
+        'm_count{stage="a"} 4',
+    ]
+
+
+def test_span_records_stage():
+    metrics = Metrics(slow_seconds=0)
+    with metrics.span("sql") as span:
+        span["rows"] = 3
+        span["bytes"] = 2000
+    assert span["seconds"] >= 0
+    metrics.observe("parse", 0.2, bytes=100, rows=7)
+    metrics.observe_bytes("prompt_full", 5000)
+    text = metrics.render()
+    assert 'dashboardai_stage_bytes_sum{stage="prompt_full"} 5000' in text
+    assert 'stage_seconds_count{stage="prompt_full"}' not in text
+    assert 'dashboardai_stage_seconds_count{stage="sql"} 1' in text
+    assert 'dashboardai_stage_bytes_bucket{stage="sql",le="10000"} 1' in text
+    assert 'dashboardai_stage_rows_total{stage="sql"} 3' in text
+    assert 'dashboardai_stage_rows_total{stage="parse"} 7' in text
+
+
+def test_collectors():
+    metrics = Metrics(slow_seconds=0)
+    metrics.add_collector(
+        "cache",
+        lambda: {
+            "hits": 2,
+            "bytes": 1234567,
+            "ratio": 0.1234567,
+            "name": "x",
+            "flag": True,
+        },
+    )
+    metrics.observe("load", 0.5, bytes=1234567)
+    text = metrics.render()
+    assert "dashboardai_cache_hits 2\n" in text
+    # sizes keep every digit
+    assert "dashboardai_cache_bytes 1234567\n" in text
+    assert "dashboardai_cache_ratio 0.1234567\n" in text
+    assert 'dashboardai_stage_bytes_sum{stage="load"} 1234567.0\n' in text
+    assert "dashboardai_cache_name" not in text
+    assert "dashboardai_cache_flag" not in text
+
+
+def test_slow_request_log(caplog):
+    metrics = Metrics(slow_seconds=1e-9)
+    with caplog.at_level(logging.WARNING, logger="dashboardai.metrics"):
+        with metrics.span("table_job"):
+            with metrics.span("llm", bytes=10):
+                pass
+    assert len(caplog.records) == 1
+    message = caplog.records[0].getMessage()
+    assert message.startswith("slow request llm=")
+    assert "bytes=10" in message and "table_job=" in message
+
+
+def test_no_slow_request_log_when_disabled(caplog):
+    metrics = Metrics(slow_seconds=0)
+    with caplog.at_level(logging.WARNING, logger="dashboardai.metrics"):
+        with metrics.span("table_job"):
+            pass
+    assert not caplog.records
+
+
+def test_trace():
+    metrics = Metrics()
+    assert metrics.trace() == []
+    with metrics.span("ask"):
+        with metrics.span("llm", rows=2):
+            pass
+        assert [stage for stage, _, _, _ in metrics.trace()] == ["llm"]
+        assert metrics.trace()[0][3] == 2
+    assert metrics.trace() == []
@@ -0,0 +1,52 @@
+""" tests in pytest for the providers module """
+
+import time
+
+import pandas as pd
+import pytest
+
+from dashboardai import api
+from dashboardai.api import (
+    combine_prompts,
+    combine_prompts_graph,
+    create_dataframe_definition_prompt,
+    create_table_definition_prompt,
+    send_to_openai,
+)
+from dashboardai.providers import FakeProvider, OpenAIProvider, get_provider
+
+
+def test_get_provider(monkeypatch):
+    assert isinstance(get_provider("openai"), OpenAIProvider)
+    assert isinstance(get_provider("Fake"), FakeProvider)
+    monkeypatch.setenv("DASHBOARDAI_LLM_PROVIDER", "fake")
+    assert isinstance(get_provider(), FakeProvider)
+    with pytest.raises(ValueError):
+        get_provider("llama")
+
+
+def test_fake_provider_sql():
+    schema = {"cars": [{"name": "age"}], "people": [{"name": "name"}]}
+    prompt = combine_prompts(create_table_definition_prompt(schema), "how many?")
+    response = FakeProvider(latency=0).complete("model", prompt, [";"], 100)
+    assert api.handle_response(response) == 'Select * FROM "cars" LIMIT 1000'
+
+
+def test_fake_provider_graph():
+    data = pd.DataFrame({"a": [1], "b": [2]})
+    prompt = combine_prompts_graph(create_dataframe_definition_prompt(data), "plot")
+    response = FakeProvider(latency=0).complete("model", prompt, None, 100)
+    assert "x=data['a'], y=data['b']" in response["choices"][0]["text"]
+
+
+def test_fake_provider_latency():
+    provider = FakeProvider(latency=0.05, sql=" 1")
+    start = time.perf_counter()
+    provider.complete("model", "SELECT", None, 10)
+    assert time.perf_counter() - start >= 0.05
+
+
+def test_send_to_openai_uses_provider(monkeypatch):
+    monkeypatch.setattr(api, "_provider", FakeProvider(latency=0, sql=" 42"))
+    response = send_to_openai("### A query\nSELECT", [";"], use_cache=False)
+    assert response["choices"][0]["text"] == " 42"
@@ -0,0 +1,228 @@
+""" tests in pytest for the registry module """
+
+import os
+
+import pandas as pd
+import pytest
+
+from dashboardai.registry import (
+    DatasetRegistry,
+    DiskStore,
+    EngineCache,
+    FileCache,
+    get_dataframe_nbytes,
+    get_dataset_store,
+)
+
+
+def make_tables(rows):
+    return {"table1": pd.DataFrame({"id": range(rows), "name": ["x"] * rows})}
+
+
+def test_put_and_get():
+    """test that tables are returned by session id"""
+    registry = DatasetRegistry(max_bytes=10**9)
+    tables = make_tables(3)
+    registry.put("a", tables)
+    assert "a" in registry
+    assert registry.get("a")["table1"] is tables["table1"]
+    assert registry.get("unknown") is None
+
+
+def test_put_replaces_session_data():
+    """test that a new upload replaces the tables of the session"""
+    registry = DatasetRegistry(max_bytes=10**9)
+    registry.put("a", make_tables(3))
+    registry.put("a", make_tables(5))
+    assert len(registry) == 1
+    assert len(registry.get("a")["table1"]) == 5
+
+
+def test_lru_eviction():
+    """test that the least recently used session is evicted when the budget is exceeded"""
+    size = get_dataframe_nbytes(make_tables(100)["table1"])
+    registry = DatasetRegistry(max_bytes=int(size * 2.5))
+    registry.put("a", make_tables(100))
+    registry.put("b", make_tables(100))
+    # touch a so that b becomes the least recently used session
+    registry.get("a")
+    registry.put("c", make_tables(100))
+    assert "a" in registry
+    assert "b" not in registry
+    assert "c" in registry
+    assert registry.evictions == 1
+    assert registry.nbytes <= registry.max_bytes
+
+
+def test_newest_dataset_is_kept_when_over_budget():
+    """test that a dataset larger than the budget is still kept on its own"""
+    registry = DatasetRegistry(max_bytes=1)
+    registry.put("a", make_tables(10))
+    registry.put("b", make_tables(10))
+    assert "a" not in registry
+    assert "b" in registry
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeEngine:
+    def __init__(self, nbytes=0):
+        self.disposed = False
+        self._nbytes = nbytes
+
+    def nbytes(self):
+        return self._nbytes
+
+    def dispose(self):
+        self.disposed = True
+
+
+def test_engine_cache_hit_and_miss():
+    """test that the engine is built once per content hash"""
+    cache = EngineCache(idle_seconds=60)
+    first = cache.get("a", "hash1", FakeEngine)
+    assert cache.get("a", "hash1", FakeEngine) is first
+    assert cache.stats() == {
+        "hits": 1,
+        "misses": 1,
+        "evictions": 0,
+        "size": 1,
+        "bytes": 0,
+    }
+
+
+def test_engine_cache_invalidated_by_content_hash():
+    """test that a new upload rebuilds the engine and disposes the old one"""
+    cache = EngineCache(idle_seconds=60)
+    first = cache.get("a", "hash1", FakeEngine)
+    second = cache.get("a", "hash2", FakeEngine)
+    assert second is not first
+    assert first.disposed
+    assert cache.misses == 2
+
+
+def test_engine_cache_idle_eviction():
+    """test that unused engines are dropped after the idle timeout"""
+    clock = FakeClock()
+    cache = EngineCache(idle_seconds=10, clock=clock)
+    first = cache.get("a", "hash1", FakeEngine)
+    clock.now = 5
+    cache.get("b", "hash1", FakeEngine)
+    clock.now = 12
+    cache.evict_idle()
+    assert "a" not in cache
+    assert "b" in cache
+    assert first.disposed
+    assert cache.evictions == 1
+
+
+def test_engine_cache_byte_budget():
+    """test that the least recently used engines are dropped over the byte budget"""
+    clock = FakeClock()
+    cache = EngineCache(idle_seconds=60, clock=clock, max_bytes=250)
+    first = cache.get("a", "hash1", lambda: FakeEngine(100))
+    clock.now = 1
+    second = cache.get("b", "hash1", lambda: FakeEngine(100))
+    clock.now = 2
+    cache.get("a", "hash1", FakeEngine)
+    clock.now = 3
+    cache.get("c", "hash1", lambda: FakeEngine(100))
+    assert "a" in cache and "c" in cache
+    assert "b" not in cache
+    assert second.disposed and not first.disposed
+    assert cache.nbytes() == 200
+    assert cache.evictions == 1
+    # a single engine over the budget is kept
+    cache.get("d", "hash1", lambda: FakeEngine(1000))
+    assert len(cache) == 1 and "d" in cache
+
+
+def test_engine_cache_update():
+    """test that an engine is updated in place for a new content hash"""
+    cache = EngineCache(idle_seconds=60)
+    assert not cache.update("a", "hash2", lambda engine: None)
+    first = cache.get("a", "hash1", FakeEngine)
+    updated = []
+    assert cache.update("a", "hash2", updated.append)
+    assert updated == [first]
+    assert cache.get("a", "hash2", FakeEngine) is first
+    assert not first.disposed
+
+
+def test_file_cache_eviction():
+    """test that the least recently used files are evicted over the byte budget"""
+    df = pd.DataFrame({"a": range(100)})
+    nbytes = get_dataframe_nbytes(df)
+    cache = FileCache(max_bytes=2 * nbytes)
+    cache.put("one", [(0, df, {})])
+    cache.put("two", [(0, df, {})])
+    assert cache.get("one")[0][1] is df
+    cache.put("three", [(0, df, {})])
+    assert cache.get("two") is None
+    assert cache.get("one") is not None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == 2 * nbytes
+
+
+def test_disk_store_put_and_get(tmp_path):
+    """test that stored tables are read back and survive a new store on the same directory"""
+    store = DiskStore(str(tmp_path))
+    tables = make_tables(3)
+    store.put("a", tables)
+    assert "a" in store
+    assert store.get("unknown") is None
+    restarted = DiskStore(str(tmp_path))
+    pd.testing.assert_frame_equal(
+        restarted.get("a")["table1"].to_pandas(), tables["table1"]
+    )
+    store.discard("a")
+    assert restarted.get("a") is None
+
+
+def test_disk_store_shares_keyed_tables(tmp_path):
+    """test that a table with a known key is written once for every session"""
+    store = DiskStore(str(tmp_path))
+    store.put("a", make_tables(3), keys={"table1": "hash1"})
+    store.put("b", make_tables(3), keys={"table1": "hash1"})
+    assert len(store) == 2
+    assert os.listdir(tmp_path / "tables") == ["hash1.arrow"]
+
+
+def test_disk_store_eviction(tmp_path):
+    """test that the least recently used sessions and their files are removed over the disk quota"""
+    store = DiskStore(str(tmp_path), max_bytes=10**9, grace_seconds=0)
+    store.put("a", make_tables(100), keys={"table1": "hash_a"})
+    store.put("b", make_tables(100), keys={"table1": "hash_b"})
+    # b is the least recently used session
+    os.utime(tmp_path / "sessions" / "b.json", (0, 0))
+    store.max_bytes = store.nbytes
+    store.put("c", make_tables(100), keys={"table1": "hash_c"})
+    assert "a" in store
+    assert "b" not in store
+    assert "c" in store
+    assert sorted(os.listdir(tmp_path / "tables")) == ["hash_a.arrow", "hash_c.arrow"]
+    assert store.stats()["evictions"] == 1
+
+
+def test_disk_store_rejects_unsafe_session_ids(tmp_path):
+    """test that session ids cannot point outside of the store"""
+    store = DiskStore(str(tmp_path))
+    with pytest.raises(ValueError):
+        store.put("../a", make_tables(3))
+    assert store.get("../a") is None
+
+
+def test_get_dataset_store(monkeypatch, tmp_path):
+    """test that the store is selected with DASHBOARDAI_DATASET_STORE"""
+    assert isinstance(get_dataset_store(), DatasetRegistry)
+    monkeypatch.setenv("DASHBOARDAI_DATASET_STORE", "disk")
+    monkeypatch.setenv("DASHBOARDAI_STORE_PATH", str(tmp_path))
+    assert isinstance(get_dataset_store(), DiskStore)
+    with pytest.raises(ValueError):
+        get_dataset_store("s3")
@@ -0,0 +1,67 @@
+""" tests in pytest for the sandbox module """
+
+import pytest
+
+from dashboardai.sandbox import UnsafeCodeError, compile_code, run_code
+
+NAMES = ("data", "fig")
+
+
+def test_compile_and_run_code():
+    code = "total = 0\nfor value in data:\n    total += value\nfig.append(total)"
+    code_object = compile_code(code, NAMES)
+    namespace = run_code(code_object, {"data": [1, 2, 3], "fig": []})
+    assert namespace["fig"] == [6]
+    # the compiled code is reused on new data
+    namespace = run_code(code_object, {"data": [4], "fig": []})
+    assert namespace["fig"] == [4]
+
+
+@pytest.mark.parametrize(
+    "code",
+    [
+        "import os",
+        "open('secrets.txt')",
+        "data.__class__",
+        "eval('1')",
+        "data.to_csv('out.csv')",
+        "pd.read_csv('http://example.com')",
+        "def f():\n    pass",
+        "while True:\n    pass",
+        "(lambda: 1)()",
+        "r = pd.io.common.os.popen('echo PWNED').read()",
+        "np.lib.npyio.os.listdir('/')",
+        "m = np\nm.lib.npyio.os.listdir('/')",
+        "fig.add_trace(go.layout.XAxis())",
+        "'{0.__class__}'.format(data)",
+        "data.agg('to_csv', 0, '/tmp/pwn_agg.csv')",
+        "data.agg('to_pickle', 0, '/tmp/pwn_agg.pkl')",
+        "data['a'].agg('to_csv', '/tmp/pwn_agg.csv')",
+        "data.agg('eval', 0, 'a + 1')",
+        "data.aggregate('to_csv', 0, '/tmp/pwn_agg.csv')",
+        "data.groupby('a').agg({'b': 'to_csv'})",
+        "data.pivot_table(index='a', aggfunc='to_csv')",
+        "pd.pivot_table(data, index='a', aggfunc='to_csv')",
+    ],
+)
+def test_compile_code_rejects_unsafe_code(code):
+    with pytest.raises(UnsafeCodeError):
+        compile_code(code, NAMES + ("pd", "np", "go"))
+
+
+def test_compile_code_allows_conversions():
+    compile_code("values = data.to_list()\nfig.append(len(values))", NAMES)
+
+
+def test_run_code_hides_builtins():
+    with pytest.raises(NameError):
+        run_code(compile("__import__('os')", "<test>", "exec"), {})
+
+
+def test_compile_code_allows_charts():
+    code = (
+        "counts = data.groupby('c')['v'].sum().reset_index()\n"
+        "fig.add_trace(go.Bar(x=counts['c'], y=np.log10(counts['v'])))\n"
+        "fig.update_layout(title='Counts')"
+    )
+    compile_code(code, NAMES + ("pd", "np", "go"))
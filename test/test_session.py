@@ -0,0 +1,75 @@
+""" tests in pytest for the session module """
+
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from dashboardai import callbacks
+from dashboardai.session import Session, read_files
+
+
+def fake_send_to_openai(text, latency=0.0):
+    def send_to_openai(prompt, stop, max_tokens=1000, use_cache=True):
+        time.sleep(latency)
+        return {"choices": [{"text": text}]}
+
+    return send_to_openai
+
+
+def test_read_files():
+    tables = read_files(["test/cars.csv", "test/gapminder.xlsx"])
+    assert list(tables) == ["cars", "gapminder"]
+    assert len(tables["cars"]) == 963
+
+
+def test_ask(monkeypatch):
+    monkeypatch.setattr(
+        callbacks, "send_to_openai", fake_send_to_openai(" COUNT(*) AS n FROM data")
+    )
+    with Session(pd.DataFrame({"id": [1, 2, 3]})) as session:
+        answer = session.ask("how many rows?")
+    assert answer["query"] == "Select COUNT(*) AS n FROM data"
+    assert answer["result"]["n"].tolist() == [3]
+    assert {"prompt", "llm", "sql"} <= set(answer["timings"])
+    assert answer["seconds"] >= answer["timings"]["llm"]
+
+
+def test_ask_many_runs_concurrently(monkeypatch):
+    # each LLM call waits until the four distinct questions are all in flight, a call made alone
+    # breaks the barrier after its timeout and the question fails
+    barrier = threading.Barrier(4, timeout=10)
+    send = fake_send_to_openai(" COUNT(*) AS n FROM cars")
+
+    def send_to_openai(*args, **kwargs):
+        barrier.wait()
+        return send(*args, **kwargs)
+
+    monkeypatch.setattr(callbacks, "send_to_openai", send_to_openai)
+    session = Session(files=["test/cars.csv"], max_workers=4)
+    questions = ["a", "b", "c", "d", "a"]
+    answers = session.ask_many(questions)
+    assert not barrier.broken
+    assert [answer["question"] for answer in answers] == questions
+    assert all(answer["result"]["n"].tolist() == [963] for answer in answers)
+    # the database is loaded once and shared by the questions
+    assert session.database is session.database
+    session.close()
+
+
+def test_ask_many_reports_errors(monkeypatch):
+    monkeypatch.setattr(
+        callbacks, "send_to_openai", fake_send_to_openai(" * FROM missing")
+    )
+    session = Session({"data": pd.DataFrame({"id": [1]})})
+    answers = session.ask_many(["what?"])
+    assert "error" in answers[0]
+    assert "result" not in answers[0]
+    with pytest.raises(Exception):
+        session.ask("what?")
+
+
+def test_session_needs_tables():
+    with pytest.raises(ValueError):
+        Session()
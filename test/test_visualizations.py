@@ -1,9 +1,11 @@
 """ tests in pytest for the visualizations module"""
 
+import numpy as np
 import pandas as pd
+import plotly.graph_objs as go
 from dash import dash_table
 
-from dashboardai.visualizations import generate_table
+from dashboardai.visualizations import bin_points, generate_table, lttb, optimize_figure
 
 
 def test_generate_table():
@@ -29,3 +31,71 @@ def test_generate_table():
     assert table.filter_action == "native"
     # check if the table has the correct sort action
     assert table.sort_action == "native"
+
+
+def test_generate_table_custom():
+    """test that only the first page is serialized in custom mode"""
+    dataframe = pd.DataFrame({"col1": range(25)})
+    table = generate_table(dataframe, max_rows=10, mode="custom", row_count=25)
+    assert table.data == [{"col1": i} for i in range(10)]
+    assert table.page_action == "custom"
+    assert table.sort_action == "custom"
+    assert table.filter_action == "custom"
+    assert table.page_count == 3
+    assert generate_table(dataframe, mode="custom").page_count is None
+
+
+def test_lttb_keeps_extremes():
+    x = np.arange(1000)
+    y = np.zeros(1000)
+    y[500] = 10
+    y[700] = -10
+    indices = lttb(x, y, 20)
+    assert len(indices) == 20
+    assert indices[0] == 0 and indices[-1] == 999
+    assert 500 in indices and 700 in indices
+    assert list(indices) == sorted(indices)
+
+
+def test_bin_points():
+    rng = np.random.default_rng(0)
+    x = np.concatenate([rng.normal(size=10000), [100]])
+    y = np.concatenate([rng.normal(size=10000), [100]])
+    indices = bin_points(x, y, 100)
+    assert len(indices) <= 100
+    # the outlier is kept
+    assert 10000 in indices
+
+
+def test_optimize_figure_downsamples_lines():
+    n = 20000
+    fig = go.Figure(go.Scatter(x=np.arange(n), y=np.sin(np.arange(n)), mode="lines"))
+    fig = optimize_figure(fig, max_points=1000, webgl_points=500)
+    assert isinstance(fig.data[0], go.Scattergl)
+    assert len(fig.data[0].x) == 1000
+    assert "1,000 of 20,000" in fig.layout.annotations[0].text
+
+
+def test_optimize_figure_subsets_marker_arrays():
+    n = 5000
+    fig = go.Figure(
+        go.Scatter(
+            x=np.arange(n),
+            y=np.arange(n) % 7,
+            mode="markers",
+            marker={"color": np.arange(n)},
+        )
+    )
+    fig = optimize_figure(fig, max_points=100, webgl_points=0)
+    trace = fig.data[0]
+    assert isinstance(trace, go.Scatter)
+    assert len(trace.x) == len(trace.marker.color) <= 100
+
+
+def test_optimize_figure_small_figure_unchanged():
+    fig = go.Figure(go.Bar(x=["a", "b"], y=[1, 2]))
+    fig.add_trace(go.Scatter(x=[1, 2, 3], y=[3, 1, 2]))
+    fig = optimize_figure(fig, max_points=1000, webgl_points=500)
+    assert isinstance(fig.data[1], go.Scatter)
+    assert list(fig.data[1].x) == [1, 2, 3]
+    assert not fig.layout.annotations